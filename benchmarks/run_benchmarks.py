@@ -0,0 +1,237 @@
+"""
+Times energy, gradient, Hessian, eigendecomposition and minimization on
+synthetic systems of increasing size, fits the scaling exponent of each
+operation and writes the results as JSON.
+
+    python run_benchmarks.py --sizes 50 100 200 400 --output results.json
+    python run_benchmarks.py --compare results.json
+"""
+
+import json
+import platform
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from timeit import default_timer
+import numpy
+import scipy
+from numpy import log, polyfit, float32
+from sardine.universe import UniverseFactory
+from sardine.energy import BondEnergyFactory, AngleEnergyFactory,\
+                           VDWEnergyFactory, EnergyFunctionFactory,\
+                           EnergyGradientFunctionFactory,\
+                           HessianFunctionFactory
+from sardine.nma import compute_force_constant_matrix, compute_normal_modes,\
+                        compute_lowest_normal_modes
+from sardine.minimize import create_minimizer
+from sardine.instrument import get_peak_rss
+from systems import SYSTEMS
+
+OPERATIONS = ('energy', 'gradient', 'hessian', 'eigen', 'minimization')
+DEFAULT_SIZES = [50, 100, 200, 400]
+# above this many coordinates only the lowest modes are computed, from
+# the sparse Hessian
+MAX_DENSE_EIGEN_COORDS = 1500
+NUM_SPARSE_MODES = 10
+# coordinate type of the energy and gradient evaluations; the Hessian is
+# always double precision
+PRECISIONS = {'double': None, 'single': float32}
+
+
+def time_call(func, args, num_repeats):
+    """
+    Best wall time of `num_repeats` calls, and the last result.
+    """
+    best = None
+    for i in xrange(num_repeats):
+        start = default_timer()
+        result = func(*args)
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def build_functions(pdb_filename, sf_filename, cutoff, dtype=None):
+    uf = UniverseFactory()
+    uf.load_atoms_from_file(pdb_filename)
+    universe = uf.create_universe()
+    num_atoms = len(universe)
+
+    bond_energy = BondEnergyFactory()
+    bond_energy.load_bonds_from_file(sf_filename)
+    angle_energy = AngleEnergyFactory()
+    angle_energy.load_angles_from_file(sf_filename)
+    vdw_energy = VDWEnergyFactory()
+    vdw_energy.load_vdw_from_file(sf_filename)
+    if cutoff is not None:
+        vdw_energy.set_cutoff(cutoff)
+    term_factories = [('bonds', bond_energy), ('angles', angle_energy),
+                      ('vdw', vdw_energy)]
+    term_names = [name for name, factory in term_factories]
+
+    eff = EnergyFunctionFactory()
+    egff = EnergyGradientFunctionFactory()
+    hff = HessianFunctionFactory()
+    for name, factory in term_factories:
+        if name == 'bonds':
+            eff.add_energy_term(name, factory.create_energy_func(num_atoms))
+        else:
+            eff.add_energy_term(name, factory.create_energy_func())
+        egff.add_energy_gradient_term(
+            name, factory.create_energy_and_gradient_func())
+        hff.add_hessian_term(name, factory.create_hessian_func())
+    energy_func = eff.create_energy_func(term_names, num_atoms, dtype=dtype)
+    energy_and_gradient_func = egff.create_energy_and_gradient_func(
+                                    term_names, num_atoms, dtype=dtype)
+    hessian_func = hff.create_hessian_func(term_names, num_atoms, sparse=True)
+    return universe, energy_func, energy_and_gradient_func, hessian_func
+
+def compute_modes(H, M):
+    F = compute_force_constant_matrix(H, M)
+    if F.shape[0] <= MAX_DENSE_EIGEN_COORDS:
+        return compute_normal_modes(F.toarray())
+    return compute_lowest_normal_modes(F, NUM_SPARSE_MODES)
+
+def run_case(system, num_atoms, num_repeats, maxiter, cutoff, precision):
+    """
+    Benchmark one system size. Runs in a fresh worker process, so that the
+    peak memory it reports is its own.
+    """
+    start_rss = get_peak_rss()
+    work_dir = tempfile.mkdtemp()
+    try:
+        pdb_filename, sf_filename = SYSTEMS[system](work_dir, num_atoms)
+        universe, energy_func, energy_and_gradient_func, hessian_func = \
+            build_functions(pdb_filename, sf_filename, cutoff,
+                            PRECISIONS[precision])
+    finally:
+        shutil.rmtree(work_dir)
+    X = universe.get_coords().flatten()
+
+    timings = {}
+    timings['energy'], E = time_call(energy_func, (X,), num_repeats)
+    timings['gradient'], EG = time_call(energy_and_gradient_func, (X,),
+                                        num_repeats)
+    timings['hessian'], H = time_call(hessian_func, (X,), num_repeats)
+    timings['eigen'], modes = time_call(
+        compute_modes, (H, universe.get_inv_sqrt_mass_vector()), 1)
+    minimizer = create_minimizer(num_atoms, maxiter=maxiter)
+    timings['minimization'], result = time_call(
+        minimizer.run_minimization,
+        (energy_and_gradient_func, None, X, num_atoms, False, False, True), 1)
+    status = minimizer.get_status()
+    peak_rss = get_peak_rss()
+    return {'system': system, 'num_atoms': num_atoms,
+            'timings': timings, 'energy': float(E),
+            'minimizer': type(minimizer).__name__,
+            'num_iterations': status.num_iterations,
+            'num_evaluations': status.num_energy_evals,
+            'peak_rss': peak_rss, 'rss_growth': peak_rss - start_rss}
+
+def run_case_in_new_process(args):
+    pool = Pool(1)
+    try:
+        return pool.apply(run_case, args)
+    finally:
+        pool.close()
+        pool.join()
+
+def fit_scaling_exponents(results):
+    """
+    Exponent p of time ~ N^p for every system and operation, from a least
+    squares fit in log-log space over the benchmarked sizes.
+    """
+    scaling = {}
+    for system in sorted(set(r['system'] for r in results)):
+        system_results = [r for r in results if r['system'] == system]
+        if len(system_results) < 2:
+            continue
+        sizes = [r['num_atoms'] for r in system_results]
+        scaling[system] = {}
+        for op in OPERATIONS:
+            times = [max(r['timings'][op], 1e-9) for r in system_results]
+            slope, intercept = polyfit(log(sizes), log(times), 1)
+            scaling[system][op] = float(slope)
+    return scaling
+
+def results_to_str(results, scaling):
+    lines = ["%-8s %8s " % ('system', 'atoms') +
+             " ".join("%12s" % op for op in OPERATIONS) +
+             " %12s" % 'peak MB']
+    for r in results:
+        lines.append("%-8s %8d " % (r['system'], r['num_atoms']) +
+                     " ".join("%12.5f" % r['timings'][op] for op in OPERATIONS) +
+                     " %12.1f" % (r['peak_rss'] / 2.0**20))
+    for system, exponents in sorted(scaling.iteritems()):
+        lines.append("%-8s %8s " % (system, 'N^p') +
+                     " ".join("%12.2f" % exponents[op] for op in OPERATIONS))
+    return "\n".join(lines)
+
+def compare_to_str(results, previous):
+    """
+    Ratio of each timing to the matching one in a previous run.
+    """
+    previous_timings = dict( ((r['system'], r['num_atoms']), r['timings'])
+                             for r in previous['results'] )
+    lines = ["%-8s %8s " % ('system', 'atoms') +
+             " ".join("%12s" % op for op in OPERATIONS) + "   (new / old)"]
+    for r in results:
+        old = previous_timings.get( (r['system'], r['num_atoms']) )
+        if old is None:
+            continue
+        lines.append("%-8s %8d " % (r['system'], r['num_atoms']) +
+                     " ".join("%12.2f" % (r['timings'][op] / max(old[op], 1e-9))
+                              for op in OPERATIONS))
+    return "\n".join(lines)
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('--systems', nargs='+', default=sorted(SYSTEMS),
+                        choices=sorted(SYSTEMS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES)
+    parser.add_argument('--repeats', type=int, default=3,
+                        help="calls per timing; the best is kept")
+    parser.add_argument('--maxiter', type=int, default=50,
+                        help="minimizer iterations")
+    parser.add_argument('--cutoff', type=float, default=None,
+                        help="VDW cutoff in angstroms (default: all pairs)")
+    parser.add_argument('--precision', default='double',
+                        choices=sorted(PRECISIONS),
+                        help="precision of energy and gradient evaluations")
+    parser.add_argument('--output', default=None,
+                        help="write the results to this JSON file")
+    parser.add_argument('--compare', default=None,
+                        help="JSON file of an earlier run to compare with")
+    options = parser.parse_args()
+
+    results = []
+    for system in options.systems:
+        for num_atoms in sorted(options.sizes):
+            results.append(run_case_in_new_process(
+                (system, num_atoms, options.repeats, options.maxiter,
+                 options.cutoff, options.precision)))
+            r = results[-1]
+            print "%s %d: %s" % (system, num_atoms,
+                                 " ".join("%s %.4fs" % (op, r['timings'][op])
+                                          for op in OPERATIONS))
+    scaling = fit_scaling_exponents(results)
+    print
+    print results_to_str(results, scaling)
+
+    report = {'platform': platform.platform(),
+              'python': platform.python_version(),
+              'numpy': numpy.__version__, 'scipy': scipy.__version__,
+              'options': vars(options), 'results': results,
+              'scaling': scaling}
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print "Wrote %s" % options.output
+    if options.compare is not None:
+        with open(options.compare) as f:
+            previous = json.load(f)
+        print
+        print compare_to_str(results, previous)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Synthetic systems of any size for the benchmarks, written as .pdb/.sf
+pairs that load the same way as the examples' inputs.
+"""
+
+from os.path import join
+from numpy import array, arange, zeros, ones, cos, sin, pi, ceil, indices,\
+                  concatenate, column_stack
+from numpy.random import RandomState
+from sardine.universe import UniverseFactory
+from sardine.trajectory import universe_to_str
+
+CARBON_MASS = 12.0
+CARBON_RADIUS = 1.7
+BOND_FORCE_CONST = 635.8
+ANGLE_FORCE_CONST = 64.71
+VDW_WELL_DISTANCE = 3.4
+VDW_WELL_DEPTH = 0.1
+
+
+def create_universe(coords):
+    num_atoms = len(coords)
+    columns = {'coords': coords,
+               'mass': CARBON_MASS * ones(num_atoms),
+               'charge': zeros(num_atoms),
+               'radius': CARBON_RADIUS * ones(num_atoms),
+               'serial_num': arange(1, num_atoms + 1),
+               'res_num': arange(1, num_atoms + 1) % 10000,
+               'atom_name': array(['C'] * num_atoms),
+               'res_name': array(['CH2'] * num_atoms),
+               'chain_id': array(['A'] * num_atoms)}
+    uf = UniverseFactory()
+    uf.add_columns(columns)
+    return uf.create_universe()
+
+def write_system(directory, name, coords, bonds=(), angles=()):
+    """
+    Write `coords` to <name>.pdb and the bonds (i, j, r_0), angles
+    (i, j, k, theta_0 in degrees) and a VDW record to <name>.sf. Atom
+    indices are 0-based here and written as serial numbers.
+    """
+    universe = create_universe(coords)
+    pdb_filename = join(directory, "%s.pdb" % name)
+    sf_filename = join(directory, "%s.sf" % name)
+    with open(pdb_filename, 'w') as f:
+        f.write("HEADER    synthetic benchmark system %s\n" % name)
+        f.write(universe_to_str(universe, coords))
+        f.write("END\n")
+    with open(sf_filename, 'w') as f:
+        for i, j, r_0 in bonds:
+            f.write("BOND\t%d\t%d\t%.1f\t%.3f\n" %
+                    (i + 1, j + 1, BOND_FORCE_CONST, r_0))
+        for i, j, k, theta_0 in angles:
+            f.write("ANGLE\t%d\t%d\t%d\t%.2f\t%.1f\n" %
+                    (i + 1, j + 1, k + 1, ANGLE_FORCE_CONST, theta_0))
+        f.write("VDW\t%.2f\t%.2f\n" % (VDW_WELL_DISTANCE, VDW_WELL_DEPTH))
+    return pdb_filename, sf_filename
+
+def make_chain(directory, num_atoms, bond_length=1.54, theta_0=109.5):
+    """
+    Planar zig-zag chain with bonds and angles between consecutive atoms.
+    """
+    half_angle = 0.5 * theta_0 * pi / 180.
+    step = arange(num_atoms)
+    coords = column_stack( (step * bond_length * sin(half_angle),
+                            (step % 2) * bond_length * cos(half_angle),
+                            zeros(num_atoms)) )
+    bonds = [(i, i + 1, bond_length) for i in xrange(num_atoms - 1)]
+    angles = [(i, i + 1, i + 2, theta_0) for i in xrange(num_atoms - 2)]
+    return write_system(directory, "chain%d" % num_atoms, coords, bonds,
+                        angles)
+
+def make_lattice(directory, num_atoms, spacing=1.54):
+    """
+    The first `num_atoms` points of a simple cubic lattice, bonded to
+    their nearest neighbors along each axis.
+    """
+    side = int(ceil(num_atoms ** (1. / 3)))
+    grid = indices((side, side, side)).reshape((3, -1)).T[:num_atoms]
+    coords = spacing * grid.astype(float)
+    index = dict( (tuple(p), i) for i, p in enumerate(grid) )
+    bonds = []
+    for i, p in enumerate(grid):
+        for axis in xrange(3):
+            q = p.copy()
+            q[axis] += 1
+            j = index.get(tuple(q))
+            if j is not None:
+                bonds.append( (i, j, spacing) )
+    return write_system(directory, "lattice%d" % num_atoms, coords, bonds)
+
+def make_lj_cluster(directory, num_atoms, density=0.02, seed=0):
+    """
+    Lennard-Jones cluster: atoms placed at random in a sphere with
+    `density` atoms per cubic angstrom, no closer than 0.8 times the VDW
+    well distance, and no bonded terms.
+    """
+    random_state = RandomState(seed)
+    radius = (3 * num_atoms / (4 * pi * density)) ** (1. / 3)
+    min_distance_sq = (0.8 * VDW_WELL_DISTANCE) ** 2
+    coords = zeros((0, 3))
+    while len(coords) < num_atoms:
+        trial = random_state.uniform(-radius, radius, (num_atoms, 3))
+        trial = trial[(trial * trial).sum(axis=1) < radius * radius]
+        for x in trial:
+            if len(coords) == num_atoms:
+                break
+            dX = coords - x
+            if len(coords) == 0 or \
+               (dX * dX).sum(axis=1).min() > min_distance_sq:
+                coords = concatenate( (coords, x[None,:]) )
+    return write_system(directory, "lj%d" % num_atoms, coords)
+
+SYSTEMS = {'chain': make_chain, 'lattice': make_lattice,
+           'lj': make_lj_cluster}
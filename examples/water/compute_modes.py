@@ -7,10 +7,12 @@ from os.path import exists, join
 from sardine.universe import UniverseFactory
 from sardine.energy import BondEnergyFactory, AngleEnergyFactory, VDWEnergyFactory
 from sardine.energy import EnergyFunctionFactory, GradientFunctionFactory
-from sardine.nma import compute_hessian, compute_force_constant_matrix,\
-                        compute_normal_modes, generate_mode_trajectory
-from sardine.trajectory import save_trajectory_to_pdb
+from sardine.energy import HessianFunctionFactory
+from sardine.nma import compute_force_constant_matrix,\
+                        compute_normal_modes, stream_mode_trajectories
+from sardine.trajectory import save_trajectory_to_pdb, PdbTrajectoryWriter
 from sardine.minimize import BFGSMinimizer
+from sardine.parsers import StructureParser
 from sardine.util import coords_1d_to_2d
 
 
@@ -27,13 +29,15 @@ def main():
     uf.load_atoms_from_file(PDB_FILENAME)
     universe = uf.create_universe()
 
+    structure = StructureParser().read_sf_file(SF_FILENAME)
+
     bond_energy_factory = BondEnergyFactory()
-    bond_energy_factory.load_bonds_from_file(SF_FILENAME)
+    bond_energy_factory.load_bonds_from_structure(structure)
     bond_energy_func = bond_energy_factory.create_energy_func(num_atoms=len(universe))
     bond_gradient_func = bond_energy_factory.create_gradient_func(num_atoms=len(universe))
 
     angle_energy_factory = AngleEnergyFactory()
-    angle_energy_factory.load_angles_from_file(SF_FILENAME)
+    angle_energy_factory.load_angles_from_structure(structure)
     angle_energy_func = angle_energy_factory.create_energy_func()
     angle_gradient_func = angle_energy_factory.create_gradient_func()
 
@@ -49,6 +53,12 @@ def main():
     gradient_func = gff.create_gradient_func(['bonds', 'angles'],
                                              num_atoms=len(universe))
 
+    hff = HessianFunctionFactory()
+    hff.add_hessian_term('bonds', bond_energy_factory.create_hessian_func())
+    hff.add_hessian_term('angles', angle_energy_factory.create_hessian_func())
+    hessian_func = hff.create_hessian_func(['bonds', 'angles'],
+                                           num_atoms=len(universe))
+
     # ======================
     # = Minimize structure =
     # ======================
@@ -71,23 +81,21 @@ def main():
     # ========================
     # = Compute normal modes =
     # ========================
-    M = universe.get_inv_sqrt_mass_matrix()
-    H = compute_hessian(energy_func, X_min)
+    M = universe.get_inv_sqrt_mass_vector()
+    H = hessian_func(X_min.flatten())
     F = compute_force_constant_matrix(H, M)
     normal_modes = compute_normal_modes(F, discard_trans_and_rot=True)
-    mode_freqs = normal_modes.get_frequencies()
 
     with open(join(OUTPUT_DIR, 'eigen_values.txt'), 'w') as f:
         f.write("%s" % normal_modes.freq_to_str())
 
-    for i in xrange(len(mode_freqs)):
-        mode_trajectory = generate_mode_trajectory(
-                            normal_modes, initial_coords=X_min,
-                            mode_number=i, peak_scale_factor=0.5)
-        save_trajectory_to_pdb(
-            join(OUTPUT_DIR, 'water_mode%02d.pdb') % (i+1),
-            mode_trajectory, universe, bond_energy_factory)
-        print "Wrote water_mode%02d.pdb" % (i+1)
+    def create_mode_writer(i):
+        mode_filename = 'water_mode%02d.pdb' % (i+1)
+        print "Writing %s" % mode_filename
+        return PdbTrajectoryWriter(join(OUTPUT_DIR, mode_filename),
+                                   universe, bond_energy_factory)
+    stream_mode_trajectories(normal_modes, X_min, create_mode_writer,
+                             peak_scale_factor=0.5)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -8,3 +8,10 @@ python -m unittest sardine.test.test_util
 python -m unittest sardine.test.test_min
 python -m unittest sardine.test.test_triatomic
 python -m unittest sardine.test.test_ethane
+python -m unittest sardine.test.test_neighbor_list
+python -m unittest sardine.test.test_hessian
+python -m unittest sardine.test.test_parsers
+python -m unittest sardine.test.test_cache
+python -m unittest sardine.test.test_trajectory
+python -m unittest sardine.test.test_batch
+python -m unittest sardine.test.test_instrument
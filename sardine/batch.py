@@ -0,0 +1,126 @@
+"""
+Minimize many conformers of one system in parallel.
+
+The energy and gradient functions close over the topology arrays built by
+the energy factories. They are handed to the worker processes through the
+pool initializer, so on fork-based platforms the workers inherit them (and
+the arrays they hold) instead of receiving a pickled copy per task. The
+conformer coordinates go in and come out through shared-memory arrays;
+only each conformer's energy and status are sent back.
+"""
+
+from multiprocessing import Pool, cpu_count
+from multiprocessing.sharedctypes import RawArray
+from numpy import frombuffer, zeros
+from .minimize import BFGSMinimizer
+
+# set in each worker by init_worker
+worker_state = {}
+
+
+def create_shared_array(shape):
+    """
+    Zeroed float array in shared memory, as (raw array, numpy view).
+    """
+    size = 1
+    for n in shape:
+        size *= n
+    raw_array = RawArray('d', max(size, 1))
+    return raw_array, frombuffer(raw_array, dtype=float)[:size].reshape(shape)
+
+def init_worker(energy_fcn, gradient_fcn, jac, minimizer, raw_coords_in,
+                raw_coords_out, shape):
+    worker_state['energy_fcn'] = energy_fcn
+    worker_state['gradient_fcn'] = gradient_fcn
+    worker_state['jac'] = jac
+    worker_state['minimizer'] = minimizer
+    size = shape[0] * shape[1] * shape[2]
+    worker_state['coords_in'] = \
+        frombuffer(raw_coords_in, dtype=float)[:size].reshape(shape)
+    worker_state['coords_out'] = \
+        frombuffer(raw_coords_out, dtype=float)[:size].reshape(shape)
+
+def minimize_conformer(i):
+    """
+    Minimize conformer `i` of the shared coordinate stack, writing the
+    result to the shared output stack.
+    """
+    minimizer = worker_state['minimizer']
+    X = worker_state['coords_in'][i].flatten()
+    num_atoms = len(worker_state['coords_in'][i])
+    X_min, energy = minimizer.run_minimization(
+                        worker_state['energy_fcn'],
+                        worker_state['gradient_fcn'], X, num_atoms,
+                        jac=worker_state['jac'])
+    worker_state['coords_out'][i] = X_min.reshape((num_atoms, 3))
+    return energy, minimizer.get_status()
+
+def minimize_conformers(energy_fcn, coords, gradient_fcn=None, jac=True,
+                        minimizer=None, num_processes=None, chunksize=1):
+    """
+    Minimize a stack of conformers that share one topology.
+
+    Parameters
+    ----------
+    energy_fcn : callable
+        Energy function of the flat coordinate vector or, with `jac`, a
+        function returning `(energy, gradient)`, e.g. from
+        EnergyGradientFunctionFactory.
+    coords : ndarray
+        (num_conformers, num_atoms, 3) starting coordinates.
+    gradient_fcn : callable, optional
+        Gradient function, when `jac` is False.
+    jac : bool, optional
+    minimizer : Minimizer, optional
+        Backend used for every conformer; BFGSMinimizer by default.
+    num_processes : int, optional
+        Number of worker processes; all cores by default. With 1, the
+        conformers are minimized in this process.
+    chunksize : int, optional
+        Conformers handed to a worker at a time.
+
+    Returns
+    -------
+    X_min : ndarray
+        (num_conformers, num_atoms, 3) minimized coordinates.
+    energies : ndarray
+        Energy of each minimized conformer.
+    statuses : list of MinimizationStatus
+        In conformer order.
+    """
+    if minimizer is None:
+        minimizer = BFGSMinimizer()
+    if num_processes is None:
+        num_processes = cpu_count()
+    shape = coords.shape
+    assert len(shape) == 3 and shape[2] == 3, \
+        "Expected (num_conformers, num_atoms, 3) coordinates"
+    raw_coords_in, coords_in = create_shared_array(shape)
+    raw_coords_out, coords_out = create_shared_array(shape)
+    coords_in[:] = coords
+    initargs = (energy_fcn, gradient_fcn, jac, minimizer, raw_coords_in,
+                raw_coords_out, shape)
+
+    num_conformers = shape[0]
+    if num_processes == 1:
+        init_worker(*initargs)
+        results = [minimize_conformer(i) for i in xrange(num_conformers)]
+    else:
+        pool = Pool(min(num_processes, max(num_conformers, 1)),
+                    initializer=init_worker, initargs=initargs)
+        try:
+            results = list(pool.imap(minimize_conformer,
+                                     xrange(num_conformers), chunksize))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    energies = zeros(num_conformers)
+    statuses = []
+    for i, (energy, status) in enumerate(results):
+        energies[i] = energy
+        statuses.append(status)
+    return coords_out.copy(), energies, statuses
@@ -3,6 +3,12 @@ from collections import namedtuple
 Bond = namedtuple("Bond", ['serial_num_1', 'serial_num_2', 'force_const', 'r_0'])
 Angle = namedtuple("Angle", ['serial_num_1', 'serial_num_2', 'serial_num_3',
                              'force_const', 'theta_0'])
+Torsion = namedtuple("Torsion", ['serial_num_1', 'serial_num_2', 'serial_num_3',
+                                 'serial_num_4', 'force_const', 'periodicity',
+                                 'phase'])
+Improper = namedtuple("Improper", ['serial_num_1', 'serial_num_2',
+                                   'serial_num_3', 'serial_num_4',
+                                   'force_const', 'psi_0'])
 
 
 class BondFactory(object):
@@ -25,3 +31,22 @@ class AngleFactory(object):
         return Angle(serial_num_1=serial_num_1, serial_num_2=serial_num_2,
                      serial_num_3=serial_num_3, force_const=force_const,
                      theta_0=theta_0)
+
+
+class TorsionFactory(object):
+    """docstring for TorsionFactory"""
+    def __init__(self):
+        super(TorsionFactory, self).__init__()
+
+    def create_torsion(self, serial_num_1, serial_num_2, serial_num_3,
+                       serial_num_4, force_const, periodicity, phase):
+        return Torsion(serial_num_1=serial_num_1, serial_num_2=serial_num_2,
+                       serial_num_3=serial_num_3, serial_num_4=serial_num_4,
+                       force_const=force_const, periodicity=periodicity,
+                       phase=phase)
+
+    def create_improper(self, serial_num_1, serial_num_2, serial_num_3,
+                        serial_num_4, force_const, psi_0):
+        return Improper(serial_num_1=serial_num_1, serial_num_2=serial_num_2,
+                        serial_num_3=serial_num_3, serial_num_4=serial_num_4,
+                        force_const=force_const, psi_0=psi_0)
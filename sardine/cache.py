@@ -0,0 +1,100 @@
+"""
+Compiled-topology cache for parsed input files.
+
+The arrays parsed out of a .pdb or .sf file are saved next to it as an .npz
+file, together with the SHA-1 of the source file's contents. Later loads
+check the hash and use the cached arrays instead of parsing the text again,
+as long as the source is unchanged.
+"""
+
+import os
+import hashlib
+import tempfile
+from numpy import load, savez, array
+
+# bump when the layout of the cached arrays changes
+CACHE_FORMAT_VERSION = 3
+CACHE_SUFFIX = ".npz"
+HASH_KEY = '__source_sha1__'
+VERSION_KEY = '__format_version__'
+
+
+def compute_file_hash(filename, block_size=1 << 20):
+    """
+    SHA-1 hex digest of the contents of `filename`.
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def get_cache_filename(filename, cache_dir=None):
+    """
+    Name of the compiled file for `filename`: alongside it, or in
+    `cache_dir` if given.
+    """
+    if cache_dir is None:
+        return filename + CACHE_SUFFIX
+    return os.path.join(cache_dir, os.path.basename(filename) + CACHE_SUFFIX)
+
+def load_cached_arrays(filename, source_hash=None, cache_dir=None):
+    """
+    Arrays cached for `filename`, or None if there is no cache or it was
+    written for different file contents or by another format version.
+    """
+    cache_filename = get_cache_filename(filename, cache_dir)
+    if not os.path.exists(cache_filename):
+        return None
+    if source_hash is None:
+        source_hash = compute_file_hash(filename)
+    try:
+        with load(cache_filename) as cached:
+            if str(cached[HASH_KEY]) != source_hash or \
+               int(cached[VERSION_KEY]) != CACHE_FORMAT_VERSION:
+                return None
+            return dict( (name, cached[name]) for name in cached.files
+                         if name not in (HASH_KEY, VERSION_KEY) )
+    except (IOError, ValueError, KeyError):
+        # unreadable or partial cache file; it will be rewritten
+        return None
+
+def save_cached_arrays(filename, arrays, source_hash=None, cache_dir=None):
+    """
+    Write `arrays` (a dict of ndarray) as the cache of `filename`. The file
+    is written under a temporary name and renamed into place, so readers
+    never see a partial cache.
+    """
+    if source_hash is None:
+        source_hash = compute_file_hash(filename)
+    cache_filename = get_cache_filename(filename, cache_dir)
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(cache_filename)),
+        suffix=CACHE_SUFFIX)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            entries = dict(arrays)
+            entries[HASH_KEY] = array(source_hash)
+            entries[VERSION_KEY] = array(CACHE_FORMAT_VERSION)
+            savez(f, **entries)
+        os.rename(tmp_filename, cache_filename)
+    except (IOError, OSError):
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+def read_with_cache(filename, read_func, cache_dir=None):
+    """
+    Return `read_func(filename)`, a dict of ndarray, from the cache when it
+    is fresh, and parse and cache it otherwise.
+    """
+    source_hash = compute_file_hash(filename)
+    arrays = load_cached_arrays(filename, source_hash, cache_dir)
+    if arrays is None:
+        arrays = read_func(filename)
+        try:
+            save_cached_arrays(filename, arrays, source_hash, cache_dir)
+        except (IOError, OSError):
+            # read-only location; just go without the cache
+            pass
+    return arrays
@@ -1,2 +1,6 @@
 # v = 108 * sqrt(k/m) cm^-1
 CM_CONVERSION_FACTOR = 108.46435
+
+# E = COULOMB_CONSTANT * q_i * q_j / r in kcal/mol, with charges in units of
+# the elementary charge and r in angstroms
+COULOMB_CONSTANT = 332.0637
@@ -1,144 +1,870 @@
 from collections import namedtuple
-from numpy import zeros, zeros_like, triu_indices, seterr, dot, pi, cos, sin
-from numpy.linalg import norm
-from .util import compute_distance_vector, compute_distance_matrix_from_vector,\
-                  compute_angle
+from numpy import zeros, zeros_like, seterr, dot, pi, cos, sin,\
+                  array, newaxis, sqrt, maximum, clip, where, identity,\
+                  concatenate, einsum, indices, absolute, asarray, floor,\
+                  around, exp, float64, array_equal
+from scipy.special import erfc, erfcinv
+from .util import compute_angles, compute_dihedrals, compute_pair_vectors,\
+                  accumulate_rows, assemble_hessian, assemble_sparse_hessian
 from .parsers import StructureParser
+from .cache import read_with_cache
+from .bonded_terms import Bond, Angle, Torsion, Improper
+from .neighbor_list import ExclusionList, find_pairs, create_pair_list
+from .pme import create_reciprocal_func, get_grid_shape
+from .const import COULOMB_CONSTANT
+from .instrument import wrap_terms, wrap_function
 
-# numpy complains about division by zero when computing vdw energy because
-# the distance matrix has zeros along the diagonal. We only include the terms
-# above the diagonal when computing the energy, so we'll suppress these
-# warnings.
+# numpy complains about division by zero when computing vdw energy for
+# atoms that sit on top of each other, so we'll suppress these warnings.
 seterr(divide='ignore')
 
+# lower bound on sin(theta) used by the angle gradient for linear angles
+MIN_SIN_THETA = 1e-8
+
+# working memory per chunk of frames in the batch energy functions
+BATCH_CHUNK_BYTES = 64 * 2**20
+# bytes of temporaries per pair and frame: about four (3,) float64 arrays
+PAIR_TEMPORARY_BYTES = 4 * 3 * 8
+
+
+class GeometryCache(object):
+    """
+    Geometry shared by the terms of a single energy-and-gradient evaluation.
+
+    Pair displacements, distances and inverse distances are computed once
+    per pair list and handed to every term that asks for the same pairs,
+    e.g. VDW and electrostatic terms given one pair list with
+    `set_pair_list`.
+    """
+    def __init__(self, X, profiler=None):
+        super(GeometryCache, self).__init__()
+        self.X = X
+        self.pair_vectors = {}
+        self.inverse_distances = {}
+        self.compute_pair_vectors = wrap_function(profiler, 'geometry',
+                                                  compute_pair_vectors)
+
+    def get_pair_vectors(self, I, J):
+        # the index arrays are stored with the result so their ids can't
+        # be reused while the cache is alive
+        key = (id(I), id(J))
+        if key not in self.pair_vectors:
+            dX, r = self.compute_pair_vectors(self.X, I, J)
+            self.pair_vectors[key] = (I, J, dX, r)
+        return self.pair_vectors[key][2:]
+
+    def get_inverse_distances(self, I, J):
+        key = (id(I), id(J))
+        if key not in self.inverse_distances:
+            dX, r = self.get_pair_vectors(I, J)
+            self.inverse_distances[key] = 1.0 / r
+        return self.inverse_distances[key]
+
+
+def get_pair_vectors(X, I, J, geometry=None):
+    """
+    Displacements and distances for the pairs (I, J), taken from `geometry`
+    when a GeometryCache is given.
+    """
+    if geometry is None:
+        return compute_pair_vectors(X, I, J)
+    return geometry.get_pair_vectors(I, J)
+
+def get_inverse_distances(X, I, J, geometry=None):
+    """
+    Inverse distances for the pairs (I, J), taken from `geometry` when a
+    GeometryCache is given.
+    """
+    if geometry is None:
+        dX, r = compute_pair_vectors(X, I, J)
+        return 1.0 / r
+    return geometry.get_inverse_distances(I, J)
+
+def compute_pair_hessian_blocks(I, J, dX, r, dE_dr, d2E_dr2):
+    """
+    Hessian blocks of a sum of pair terms E(r_ij).
+
+    With u the unit vector along the pair,
+    d2E/dx_i dx_i = d2E/dr2 * u u^T + (dE/dr / r) * (1 - u u^T),
+    which is also the (j, j) block; the (i, j) and (j, i) blocks are its
+    negative.
+
+    Returns
+    -------
+    rows, cols : ndarray of int
+    blocks : ndarray, shape (4 * num_pairs, 3, 3)
+    """
+    u = dX / r[:,newaxis]
+    uuT = u[:,:,newaxis] * u[:,newaxis,:]
+    dE_dr_over_r = (dE_dr / r)[:,newaxis,newaxis]
+    B = (d2E_dr2[:,newaxis,newaxis] - dE_dr_over_r) * uuT + \
+        dE_dr_over_r * identity(3)
+    rows = concatenate( [I, J, I, J] )
+    cols = concatenate( [I, J, J, I] )
+    blocks = concatenate( [B, B, -B, -B] )
+    return rows, cols, blocks
+
+def create_finite_difference_hessian_func(gradient_func, step=1e-5):
+    """
+    Hessian blocks from central differences of a gradient term
+    `gradient_func(X, D)`, for terms without an analytic Hessian.
+    Costs 6N gradient evaluations.
+    """
+    def finite_difference_hessian_func(X, geometry=None):
+        num_atoms = X.shape[0]
+        n = 3 * num_atoms
+        H = zeros((n, n))
+        X_step = array(X, dtype=float)
+        for m in xrange(n):
+            i, p = divmod(m, 3)
+            x_orig = X_step[i,p]
+            X_step[i,p] = x_orig + step
+            G_plus = gradient_func(X_step, None)
+            X_step[i,p] = x_orig - step
+            G_minus = gradient_func(X_step, None)
+            X_step[i,p] = x_orig
+            H[m,:] = ((G_plus - G_minus) / (2 * step)).ravel()
+        H = 0.5 * (H + H.T)
+        rows, cols = indices((num_atoms, num_atoms))
+        blocks = H.reshape((num_atoms, 3, num_atoms, 3)).transpose((0,2,1,3))
+        blocks = blocks.reshape((-1, 3, 3))
+        # keep only the blocks of interacting atoms, so that sparse
+        # assembly stays sparse
+        nonzero = absolute(blocks).reshape((-1, 9)).max(axis=1) > 0.0
+        return rows.ravel()[nonzero], cols.ravel()[nonzero], blocks[nonzero]
+    return finite_difference_hessian_func
+
+def get_batch_chunk_size(num_atoms, chunk_size=None, dtype=None):
+    """
+    Number of frames evaluated together by the batch functions. Unless
+    given, it is chosen so that the per-pair temporaries of an all-pairs
+    term, a few (num_pairs, 3) arrays per frame, stay near
+    BATCH_CHUNK_BYTES. Single precision fits twice the frames.
+    """
+    if chunk_size is not None:
+        return chunk_size
+    num_pairs = max(num_atoms * (num_atoms - 1) // 2, num_atoms)
+    bytes_per_frame = PAIR_TEMPORARY_BYTES * num_pairs
+    if dtype is not None:
+        bytes_per_frame = bytes_per_frame * zeros(0, dtype).itemsize // 8
+    return max(1, BATCH_CHUNK_BYTES // bytes_per_frame)
+
+def iter_frame_chunks(num_frames, chunk_size):
+    for start in xrange(0, num_frames, chunk_size):
+        yield slice(start, min(start + chunk_size, num_frames))
+
+def create_param_cache(*params):
+    """
+    Returns a function of a dtype that gives the parameter arrays `params`
+    cast to it. Each dtype is cast once, so term kernels handed float32
+    coordinates compute in float32 without converting parameters on every
+    call.
+    """
+    cast_params = {}
+    def get_params(dtype):
+        if dtype not in cast_params:
+            cast_params[dtype] = tuple(asarray(p, dtype=dtype) for p in params)
+        return cast_params[dtype]
+    return get_params
+
+def cast_coords(X, dtype=None):
+    """
+    `X`, converted to `dtype` if one is given.
+    """
+    if dtype is None:
+        return X
+    return asarray(X, dtype=dtype)
+
+def check_pair_list_cutoff(pair_list, cutoff):
+    """
+    Assert that `pair_list` holds every pair within `cutoff` (None for all
+    pairs).
+    """
+    list_cutoff = getattr(pair_list, 'cutoff', None)
+    assert list_cutoff is None or \
+        (cutoff is not None and list_cutoff >= cutoff), \
+        "Pair list cutoff %s is shorter than the term cutoff %s" % \
+        (list_cutoff, cutoff)
+
+def read_structure(sf_parser, filename, use_cache=False, cache_dir=None):
+    """
+    Packed arrays of a .sf file, taken from its compiled cache when
+    `use_cache` is set and the cache is fresh.
+    """
+    if use_cache:
+        return read_with_cache(filename, sf_parser.read_sf_file, cache_dir)
+    return sf_parser.read_sf_file(filename)
+
+
 class BondEnergyFactory(object):
     """docstring for BondEnergyFactory"""
     def __init__(self):
         self.bonds = []
+        self.bond_blocks = []
         self.sf_parser = StructureParser()
 
     def __len__(self):
-        return len(self.bonds)
+        return len(self.bonds) + sum(len(b[1]) for b in self.bond_blocks)
 
     def __iter__(self):
-        for b in self.bonds:
-            yield b
+        serial_nums, K, R_0 = self.get_packed_bonds()
+        for (serial_num_1, serial_num_2), force_const, r_0 in \
+            zip(serial_nums, K, R_0):
+            yield Bond(serial_num_1, serial_num_2, force_const, r_0)
 
     def add_bond(self, bond):
         self.bonds.append( bond )
 
-    def load_bonds_from_file(self, filename):
+    def add_bonds(self, serial_nums, force_consts, r_0s):
+        """
+        Add a block of bonds given as arrays: (num_bonds, 2) atom serial
+        numbers, force constants and equilibrium lengths.
+        """
+        self.flush_bonds()
+        self.bond_blocks.append( (asarray(serial_nums, dtype=int).reshape((-1, 2)),
+                                  asarray(force_consts, dtype=float),
+                                  asarray(r_0s, dtype=float)) )
+
+    def flush_bonds(self):
+        if self.bonds:
+            serial_nums = [(b.serial_num_1, b.serial_num_2) for b in self.bonds]
+            force_consts = [b.force_const for b in self.bonds]
+            r_0s = [b.r_0 for b in self.bonds]
+            self.bonds = []
+            self.add_bonds(serial_nums, force_consts, r_0s)
+
+    def load_bonds_from_structure(self, structure):
+        """
+        Add the bonds of a structure read with StructureParser.read_sf_file.
+        """
+        self.add_bonds(structure['bond_serial_nums'],
+                       structure['bond_force_consts'],
+                       structure['bond_r_0s'])
+
+    def load_bonds_from_file(self, filename, use_cache=False, cache_dir=None):
         if filename.endswith(".sf"):
-            for b in self.sf_parser.iter_bonds_in_sf_file(filename):
-                self.add_bond(b)
+            structure = read_structure(self.sf_parser, filename, use_cache,
+                                       cache_dir)
+            self.load_bonds_from_structure(structure)
         else:
             print "Expected a .sf file, got %s" % filename
             return
 
+    def get_packed_bonds(self):
+        """
+        All bonds as (num_bonds, 2) serial numbers, force constants and
+        equilibrium lengths.
+        """
+        self.flush_bonds()
+        if not self.bond_blocks:
+            return zeros((0, 2), dtype=int), zeros(0), zeros(0)
+        if len(self.bond_blocks) > 1:
+            self.bond_blocks = [tuple( concatenate(arrays) for arrays in
+                                       zip(*self.bond_blocks) )]
+        return self.bond_blocks[0]
+
+    def get_bond_arrays(self):
+        """
+        Pack the bonds into contiguous arrays.
+
+        Returns
+        -------
+        I, J : ndarray of int
+            0-indexed atom indices of the bonded pairs.
+        K, R_0 : ndarray of float
+            Force constant and equilibrium length of each bond.
+        """
+        serial_nums, K, R_0 = self.get_packed_bonds()
+        I = serial_nums[:,0] - 1 # convert to 0-indexing
+        J = serial_nums[:,1] - 1 # convert to 0-indexing
+        return I, J, K, R_0
+
+    def create_exclusion_list(self, num_atoms):
+        """
+        ExclusionList of the 1-2, 1-3 and 1-4 pairs of the bond graph, for
+        VDWEnergyFactory.set_exclusions.
+        """
+        I, J, K, R_0 = self.get_bond_arrays()
+        return ExclusionList(I, J, num_atoms)
+
     def create_energy_func(self, num_atoms):
-        K = zeros([num_atoms, num_atoms])
-        R = zeros([num_atoms, num_atoms])
-        for b in self.bonds:
-            i = b.serial_num_1 - 1 # convert to 0-indexing
-            j = b.serial_num_2 - 1 # convert to 0-indexing
-            K[i,j] = b.force_const
-            R[i,j] = b.r_0
+        I, J, K, R_0 = self.get_bond_arrays()
+        params = create_param_cache(K, R_0)
         def bond_energy_func(X, D):
-            E = 0.5 * K * (D - R)**2
-            return E.sum()
+            K, R_0 = params(X.dtype)
+            dX, r = compute_pair_vectors(X, I, J)
+            E = 0.5 * K * (r - R_0)**2
+            return E.sum(axis=-1, dtype=float64)
         return bond_energy_func
 
     def create_gradient_func(self, num_atoms):
-        K = zeros([num_atoms, num_atoms])
-        R = zeros([num_atoms, num_atoms])
-        for b in self.bonds:
-            i = b.serial_num_1 - 1 # convert to 0-indexing
-            j = b.serial_num_2 - 1 # convert to 0-indexing
-            K[i,j] = b.force_const
-            R[i,j] = b.r_0
-
+        energy_and_gradient_func = self.create_energy_and_gradient_func()
         def bond_gradient_func(X, D):
-            F = -K * (D - R)
-            G = zeros_like(X)
-            for b in self.bonds:
-                i = b.serial_num_1 - 1 # convert to 0-indexing
-                j = b.serial_num_2 - 1 # convert to 0-indexing
-                dX = (X[j,:] - X[i,:]) / D[j,i]
-                G[i,:] += F[i,j] * dX
-                G[j,:] += -F[i,j] * dX
-            return G
+            return energy_and_gradient_func(X)[1]
         return bond_gradient_func
 
+    def create_energy_and_gradient_func(self, num_atoms=None):
+        I, J, K, R_0 = self.get_bond_arrays()
+        params = create_param_cache(K, R_0)
+        def bond_energy_and_gradient_func(X, geometry=None):
+            K, R_0 = params(X.dtype)
+            dX, r = get_pair_vectors(X, I, J, geometry)
+            E = 0.5 * K * (r - R_0)**2
+            # dE/dX_j = K * (r - r_0) * (X_j - X_i) / r, and the opposite
+            # for atom i
+            F = (K * (r - R_0) / r)[...,newaxis] * dX
+            G = zeros_like(X)
+            accumulate_rows(G, J, F)
+            accumulate_rows(G, I, -F)
+            return E.sum(axis=-1, dtype=float64), G
+        return bond_energy_and_gradient_func
+
+    def create_hessian_func(self, num_atoms=None):
+        I, J, K, R_0 = self.get_bond_arrays()
+        def bond_hessian_func(X, geometry=None):
+            dX, r = get_pair_vectors(X, I, J, geometry)
+            return compute_pair_hessian_blocks(I, J, dX, r, K * (r - R_0), K)
+        return bond_hessian_func
+
 
 class AngleEnergyFactory(object):
     """docstring for AngleEnergyFactory"""
     def __init__(self):
         super(AngleEnergyFactory, self).__init__()
         self.angles = []
+        self.angle_blocks = []
         self.sf_parser = StructureParser()
 
     def __len__(self):
-        return len(self.angles)
+        return len(self.angles) + sum(len(a[1]) for a in self.angle_blocks)
 
     def __iter__(self):
-        for a in self.angles:
-            yield a
+        serial_nums, K_theta, Theta_0 = self.get_packed_angles()
+        for (serial_num_1, serial_num_2, serial_num_3), force_const, theta_0 \
+            in zip(serial_nums, K_theta, Theta_0):
+            yield Angle(serial_num_1, serial_num_2, serial_num_3,
+                        force_const, theta_0)
 
     def add_angle(self, angle):
         self.angles.append( angle )
 
-    def load_angles_from_file(self, filename):
+    def add_angles(self, serial_nums, force_consts, theta_0s):
+        """
+        Add a block of angles given as arrays: (num_angles, 3) atom serial
+        numbers with the vertex in the middle, force constants and
+        equilibrium angles in radians.
+        """
+        self.flush_angles()
+        self.angle_blocks.append( (asarray(serial_nums, dtype=int).reshape((-1, 3)),
+                                   asarray(force_consts, dtype=float),
+                                   asarray(theta_0s, dtype=float)) )
+
+    def flush_angles(self):
+        if self.angles:
+            serial_nums = [(a.serial_num_1, a.serial_num_2, a.serial_num_3)
+                           for a in self.angles]
+            force_consts = [a.force_const for a in self.angles]
+            theta_0s = [a.theta_0 for a in self.angles]
+            self.angles = []
+            self.add_angles(serial_nums, force_consts, theta_0s)
+
+    def load_angles_from_structure(self, structure):
+        """
+        Add the angles of a structure read with StructureParser.read_sf_file.
+        """
+        self.add_angles(structure['angle_serial_nums'],
+                        structure['angle_force_consts'],
+                        structure['angle_theta_0s'])
+
+    def load_angles_from_file(self, filename, use_cache=False, cache_dir=None):
         if filename.endswith(".sf"):
-            for a in self.sf_parser.iter_angles_in_sf_file(filename):
-                self.add_angle(a)
+            structure = read_structure(self.sf_parser, filename, use_cache,
+                                       cache_dir)
+            self.load_angles_from_structure(structure)
         else:
             print "Expected a .sf file, got %s" % filename
             return
 
+    def get_packed_angles(self):
+        """
+        All angles as (num_angles, 3) serial numbers, force constants and
+        equilibrium angles.
+        """
+        self.flush_angles()
+        if not self.angle_blocks:
+            return zeros((0, 3), dtype=int), zeros(0), zeros(0)
+        if len(self.angle_blocks) > 1:
+            self.angle_blocks = [tuple( concatenate(arrays) for arrays in
+                                        zip(*self.angle_blocks) )]
+        return self.angle_blocks[0]
+
+    def get_angle_arrays(self):
+        """
+        Pack the angles into contiguous arrays.
+
+        Returns
+        -------
+        I, J, K : ndarray of int
+            0-indexed atom indices of each angle; `J` is the vertex.
+        K_theta, Theta_0 : ndarray of float
+            Force constant and equilibrium angle (radians) of each angle.
+        """
+        serial_nums, K_theta, Theta_0 = self.get_packed_angles()
+        I = serial_nums[:,0] - 1 # convert to 0-indexing
+        J = serial_nums[:,1] - 1 # convert to 0-indexing
+        K = serial_nums[:,2] - 1 # convert to 0-indexing
+        return I, J, K, K_theta, Theta_0
+
     def create_energy_func(self):
+        I, J, K, K_theta, Theta_0 = self.get_angle_arrays()
+        params = create_param_cache(K_theta, Theta_0)
         def angle_energy_func(X, D):
-            E = 0.0
-            for a in self.angles:
-                i = a.serial_num_1 - 1 # convert to 0-indexing
-                j = a.serial_num_2 - 1 # convert to 0-indexing
-                k = a.serial_num_3 - 1 # convert to 0-indexing
-                vec12 = X[i,:] - X[j,:]
-                vec32 = X[k,:] - X[j,:]
-                theta = compute_angle(vec12, vec32)
-                E += 0.5 * a.force_const * (theta - a.theta_0)**2
-            return E.sum()
+            K_theta, Theta_0 = params(X.dtype)
+            vec12 = X[...,I,:] - X[...,J,:]
+            vec32 = X[...,K,:] - X[...,J,:]
+            theta, sin_theta, cos_theta = compute_angles(vec12, vec32)
+            E = 0.5 * K_theta * (theta - Theta_0)**2
+            return E.sum(axis=-1, dtype=float64)
         return angle_energy_func
 
     def create_gradient_func(self):
+        energy_and_gradient_func = self.create_energy_and_gradient_func()
         def angle_gradient_func(X, D):
-            G = zeros_like(X)
-            for a in self.angles:
-                i = a.serial_num_1 - 1 # convert to 0-indexing
-                j = a.serial_num_2 - 1 # convert to 0-indexing
-                k = a.serial_num_3 - 1 # convert to 0-indexing
-                vec12 = X[i,:] - X[j,:]
-                vec32 = X[k,:] - X[j,:]
-                theta = compute_angle(vec12, vec32)
-                total_G = a.force_const * (theta - a.theta_0) / sin(theta)
-
-                length_vec12 = norm(vec12)
-                length_vec32 = norm(vec32)
-                vec12 /= length_vec12
-                vec32 /= length_vec32
-                cos_theta = cos(theta)
-                G1 = total_G * (vec32 - cos_theta * vec12) / length_vec12
-                G2 = total_G * (vec12 - cos_theta * vec32) / length_vec32
-                G_atom1 = -G1
-                G_atom2 = G1 + G2
-                G_atom3 = -G2
-
-                G = zeros_like(X)
-                G[i,:] = G_atom1
-                G[j,:] = G_atom2
-                G[k,:] = G_atom3
-            return G
+            return energy_and_gradient_func(X)[1]
         return angle_gradient_func
 
+    def create_energy_and_gradient_func(self):
+        I, J, K, K_theta, Theta_0 = self.get_angle_arrays()
+        params = create_param_cache(K_theta, Theta_0)
+        def angle_energy_and_gradient_func(X, geometry=None):
+            K_theta, Theta_0 = params(X.dtype)
+            vec12 = X[...,I,:] - X[...,J,:]
+            vec32 = X[...,K,:] - X[...,J,:]
+            theta, sin_theta, cos_theta = compute_angles(vec12, vec32)
+            E = 0.5 * K_theta * (theta - Theta_0)**2
+            # dtheta/dx diverges as 1/sin(theta) for (near-)linear angles,
+            # while the numerator vanishes; bounding sin(theta) keeps the
+            # gradient finite without a per-angle branch.
+            sin_theta = maximum(sin_theta, MIN_SIN_THETA)
+            total_G = K_theta * (theta - Theta_0) / sin_theta
+
+            length_vec12 = sqrt( (vec12 * vec12).sum(axis=-1) )[...,newaxis]
+            length_vec32 = sqrt( (vec32 * vec32).sum(axis=-1) )[...,newaxis]
+            vec12 /= length_vec12
+            vec32 /= length_vec32
+            cos_theta = cos_theta[...,newaxis]
+            total_G = total_G[...,newaxis]
+            G1 = total_G * (vec32 - cos_theta * vec12) / length_vec12
+            G2 = total_G * (vec12 - cos_theta * vec32) / length_vec32
+
+            G = zeros_like(X)
+            accumulate_rows(G, I, -G1)
+            accumulate_rows(G, J, G1 + G2)
+            accumulate_rows(G, K, -G2)
+            return E.sum(axis=-1, dtype=float64), G
+        return angle_energy_and_gradient_func
+
+    def create_hessian_func(self):
+        I, J, K, K_theta, Theta_0 = self.get_angle_arrays()
+        # d(u, v)/d(x_i, x_j, x_k) for u = x_i - x_j and v = x_k - x_j
+        T = zeros((6, 9))
+        T[0:3,0:3] = identity(3)
+        T[0:3,3:6] = -identity(3)
+        T[3:6,6:9] = identity(3)
+        T[3:6,3:6] = -identity(3)
+        eye = identity(3)[newaxis,:,:]
+        def outer(a, b):
+            return a[:,:,newaxis] * b[:,newaxis,:]
+
+        def angle_hessian_func(X, geometry=None):
+            u = X[I,:] - X[J,:]
+            v = X[K,:] - X[J,:]
+            theta, sin_theta, cos_theta = compute_angles(u, v)
+            sin_theta = maximum(sin_theta, MIN_SIN_THETA)
+            a = sqrt( (u * u).sum(axis=1) )
+            b = sqrt( (v * v).sum(axis=1) )
+            c = cos_theta[:,newaxis,newaxis]
+            a_ = a[:,newaxis,newaxis]
+            b_ = b[:,newaxis,newaxis]
+
+            # first and second derivatives of cos(theta) w.r.t. (u, v)
+            g = zeros((len(theta), 6))
+            g[:,0:3] = (v / b[:,newaxis] - c[:,:,0] * u / a[:,newaxis]) / \
+                       a[:,newaxis]
+            g[:,3:6] = (u / a[:,newaxis] - c[:,:,0] * v / b[:,newaxis]) / \
+                       b[:,newaxis]
+            Hc = zeros((len(theta), 6, 6))
+            Hc[:,0:3,0:3] = -(outer(v,u) + outer(u,v)) / (a_**3 * b_) + \
+                            3 * c * outer(u,u) / a_**4 - c * eye / a_**2
+            Hc[:,3:6,3:6] = -(outer(u,v) + outer(v,u)) / (a_ * b_**3) + \
+                            3 * c * outer(v,v) / b_**4 - c * eye / b_**2
+            Hc[:,0:3,3:6] = eye / (a_ * b_) - outer(v,v) / (a_ * b_**3) - \
+                            outer(u,u) / (a_**3 * b_) + \
+                            c * outer(u,v) / (a_**2 * b_**2)
+            Hc[:,3:6,0:3] = Hc[:,0:3,3:6].transpose((0,2,1))
+
+            # theta = arccos(cos(theta))
+            s_ = sin_theta[:,newaxis,newaxis]
+            g_theta = -g / sin_theta[:,newaxis]
+            H_theta = -Hc / s_ - c * outer(g, g) / s_**3
+            H_uv = K_theta[:,newaxis,newaxis] * outer(g_theta, g_theta) + \
+                   (K_theta * (theta - Theta_0))[:,newaxis,newaxis] * H_theta
+            H_x = einsum('pi,npq,qj->nij', T, H_uv, T)
+
+            atoms = (I, J, K)
+            rows, cols, blocks = [], [], []
+            for p in xrange(3):
+                for q in xrange(3):
+                    rows.append(atoms[p])
+                    cols.append(atoms[q])
+                    blocks.append(H_x[:,3*p:3*p+3,3*q:3*q+3])
+            return concatenate(rows), concatenate(cols), concatenate(blocks)
+        return angle_hessian_func
+
+
+def compute_dihedral_hessian_blocks(P, gradient_func, step=1e-5):
+    """
+    Hessian blocks of a sum of dihedral terms, by central differences of
+    their analytic gradient. All terms are stepped together, so the cost
+    is 24 vectorized gradient evaluations however many terms there are.
+
+    Parameters
+    ----------
+    P : ndarray, shape (num_terms, 4, 3)
+        Coordinates of the four atoms of each term.
+    gradient_func : callable
+        Maps such an array to dE/dP of the same shape.
+
+    Returns
+    -------
+    H : ndarray, shape (num_terms, 12, 12)
+    """
+    P = array(P, dtype=float)
+    H = zeros((len(P), 12, 12))
+    for m in xrange(12):
+        a, p = divmod(m, 3)
+        x_orig = P[:,a,p].copy()
+        P[:,a,p] = x_orig + step
+        G_plus = gradient_func(P)
+        P[:,a,p] = x_orig - step
+        G_minus = gradient_func(P)
+        P[:,a,p] = x_orig
+        H[:,m,:] = ((G_plus - G_minus) / (2 * step)).reshape((-1, 12))
+    return 0.5 * (H + H.transpose((0,2,1)))
+
+
+def create_dihedral_energy_func(atoms, dihedral_func):
+    """
+    Energy term of the dihedrals of the atom index arrays `atoms`
+    (I, J, K, L), with `dihedral_func(phi, order)` giving the energy of
+    each dihedral and, up to `order`, dE/dphi. Shared by the torsion and
+    improper factories.
+    """
+    I, J, K, L = atoms
+    def dihedral_energy_func(X, D):
+        phi = compute_dihedrals(X[...,I,:] - X[...,J,:],
+                                X[...,J,:] - X[...,K,:],
+                                X[...,L,:] - X[...,K,:])
+        E, = dihedral_func(phi)
+        return E.sum(axis=-1, dtype=float64)
+    return dihedral_energy_func
+
+def create_dihedral_energy_and_gradient_func(atoms, dihedral_func):
+    I, J, K, L = atoms
+    def dihedral_energy_and_gradient_func(X, geometry=None):
+        phi, dphi_dx = compute_dihedrals(X[...,I,:] - X[...,J,:],
+                                         X[...,J,:] - X[...,K,:],
+                                         X[...,L,:] - X[...,K,:],
+                                         gradient=True)
+        E, dE_dphi = dihedral_func(phi, order=1)
+        dE_dphi = dE_dphi[...,newaxis]
+        G = zeros_like(X)
+        for atom_indices, dphi in zip(atoms, dphi_dx):
+            accumulate_rows(G, atom_indices, dE_dphi * dphi)
+        return E.sum(axis=-1, dtype=float64), G
+    return dihedral_energy_and_gradient_func
+
+def create_dihedral_hessian_func(atoms, dihedral_func):
+    I, J, K, L = atoms
+    def local_gradient_func(P):
+        phi, dphi_dx = compute_dihedrals(P[:,0] - P[:,1], P[:,1] - P[:,2],
+                                         P[:,3] - P[:,2], gradient=True)
+        E, dE_dphi = dihedral_func(phi, order=1)
+        dphi_dx = array(dphi_dx).transpose((1,0,2))
+        return dE_dphi[:,newaxis,newaxis] * dphi_dx
+
+    def dihedral_hessian_func(X, geometry=None):
+        P = concatenate([X[I,newaxis,:], X[J,newaxis,:], X[K,newaxis,:],
+                         X[L,newaxis,:]], axis=1)
+        H = compute_dihedral_hessian_blocks(P, local_gradient_func)
+        rows, cols, blocks = [], [], []
+        for p in xrange(4):
+            for q in xrange(4):
+                rows.append(atoms[p])
+                cols.append(atoms[q])
+                blocks.append(H[:,3*p:3*p+3,3*q:3*q+3])
+        return concatenate(rows), concatenate(cols), concatenate(blocks)
+    return dihedral_hessian_func
+
+
+class TorsionEnergyFactory(object):
+    """
+    Proper torsions, E = K * (1 + cos(n * phi - delta)).
+    """
+    def __init__(self):
+        super(TorsionEnergyFactory, self).__init__()
+        self.torsions = []
+        self.torsion_blocks = []
+        self.sf_parser = StructureParser()
+
+    def __len__(self):
+        return len(self.torsions) + sum(len(t[1]) for t in self.torsion_blocks)
+
+    def __iter__(self):
+        serial_nums, K_phi, N, Delta = self.get_packed_torsions()
+        for serial_num, force_const, periodicity, phase \
+            in zip(serial_nums, K_phi, N, Delta):
+            yield Torsion(*(tuple(serial_num) +
+                            (force_const, periodicity, phase)))
+
+    def add_torsion(self, torsion):
+        self.torsions.append( torsion )
+
+    def add_torsions(self, serial_nums, force_consts, periodicities, phases):
+        """
+        Add a block of torsions given as arrays: (num_torsions, 4) atom
+        serial numbers, force constants, periodicities and phases in
+        radians.
+        """
+        self.flush_torsions()
+        self.torsion_blocks.append(
+            (asarray(serial_nums, dtype=int).reshape((-1, 4)),
+             asarray(force_consts, dtype=float),
+             asarray(periodicities, dtype=float),
+             asarray(phases, dtype=float)) )
+
+    def flush_torsions(self):
+        if self.torsions:
+            serial_nums = [t[0:4] for t in self.torsions]
+            force_consts = [t.force_const for t in self.torsions]
+            periodicities = [t.periodicity for t in self.torsions]
+            phases = [t.phase for t in self.torsions]
+            self.torsions = []
+            self.add_torsions(serial_nums, force_consts, periodicities, phases)
+
+    def load_torsions_from_structure(self, structure):
+        """
+        Add the torsions of a structure read with
+        StructureParser.read_sf_file.
+        """
+        self.add_torsions(structure['torsion_serial_nums'],
+                          structure['torsion_force_consts'],
+                          structure['torsion_periodicities'],
+                          structure['torsion_phases'])
+
+    def load_torsions_from_file(self, filename, use_cache=False,
+                                cache_dir=None):
+        if filename.endswith(".sf"):
+            structure = read_structure(self.sf_parser, filename, use_cache,
+                                       cache_dir)
+            self.load_torsions_from_structure(structure)
+        else:
+            print "Expected a .sf file, got %s" % filename
+            return
+
+    def get_packed_torsions(self):
+        """
+        All torsions as (num_torsions, 4) serial numbers, force constants,
+        periodicities and phases.
+        """
+        self.flush_torsions()
+        if not self.torsion_blocks:
+            return zeros((0, 4), dtype=int), zeros(0), zeros(0), zeros(0)
+        if len(self.torsion_blocks) > 1:
+            self.torsion_blocks = [tuple( concatenate(arrays) for arrays in
+                                          zip(*self.torsion_blocks) )]
+        return self.torsion_blocks[0]
+
+    def get_dihedral_arrays(self):
+        """
+        0-indexed atom arrays (I, J, K, L) of the torsions.
+        """
+        serial_nums = self.get_packed_torsions()[0]
+        # convert to 0-indexing
+        return tuple(serial_nums[:,n] - 1 for n in xrange(4))
+
+    def create_dihedral_func(self):
+        """
+        Returns a function of the dihedral angles `phi` that computes the
+        energy of each torsion and, up to the requested `order`, dE/dphi.
+        """
+        serial_nums, K_phi, N, Delta = self.get_packed_torsions()
+        params = create_param_cache(K_phi, N, Delta)
+        def torsion_func(phi, order=0):
+            K_phi, N, Delta = params(phi.dtype)
+            angle = N * phi - Delta
+            derivs = [K_phi * (1 + cos(angle))]
+            if order >= 1:
+                derivs.append( -K_phi * N * sin(angle) )
+            return derivs
+        return torsion_func
+
+    def create_energy_func(self):
+        return create_dihedral_energy_func(self.get_dihedral_arrays(),
+                                           self.create_dihedral_func())
+
+    def create_gradient_func(self):
+        energy_and_gradient_func = self.create_energy_and_gradient_func()
+        def torsion_gradient_func(X, D):
+            return energy_and_gradient_func(X)[1]
+        return torsion_gradient_func
+
+    def create_energy_and_gradient_func(self):
+        return create_dihedral_energy_and_gradient_func(
+                    self.get_dihedral_arrays(), self.create_dihedral_func())
+
+    def create_hessian_func(self):
+        return create_dihedral_hessian_func(self.get_dihedral_arrays(),
+                                            self.create_dihedral_func())
+
+
+class ImproperEnergyFactory(object):
+    """
+    Harmonic impropers, E = 0.5 * K * (psi - psi_0)^2, with the difference
+    taken on the circle.
+    """
+    def __init__(self):
+        super(ImproperEnergyFactory, self).__init__()
+        self.impropers = []
+        self.improper_blocks = []
+        self.sf_parser = StructureParser()
+
+    def __len__(self):
+        return len(self.impropers) + \
+               sum(len(t[1]) for t in self.improper_blocks)
+
+    def __iter__(self):
+        serial_nums, K_psi, Psi_0 = self.get_packed_impropers()
+        for serial_num, force_const, psi_0 in zip(serial_nums, K_psi, Psi_0):
+            yield Improper(*(tuple(serial_num) + (force_const, psi_0)))
+
+    def add_improper(self, improper):
+        self.impropers.append( improper )
+
+    def add_impropers(self, serial_nums, force_consts, psi_0s):
+        """
+        Add a block of impropers given as arrays: (num_impropers, 4) atom
+        serial numbers, force constants and equilibrium angles in radians.
+        """
+        self.flush_impropers()
+        self.improper_blocks.append(
+            (asarray(serial_nums, dtype=int).reshape((-1, 4)),
+             asarray(force_consts, dtype=float),
+             asarray(psi_0s, dtype=float)) )
+
+    def flush_impropers(self):
+        if self.impropers:
+            serial_nums = [t[0:4] for t in self.impropers]
+            force_consts = [t.force_const for t in self.impropers]
+            psi_0s = [t.psi_0 for t in self.impropers]
+            self.impropers = []
+            self.add_impropers(serial_nums, force_consts, psi_0s)
+
+    def load_impropers_from_structure(self, structure):
+        """
+        Add the impropers of a structure read with
+        StructureParser.read_sf_file.
+        """
+        self.add_impropers(structure['improper_serial_nums'],
+                           structure['improper_force_consts'],
+                           structure['improper_psi_0s'])
+
+    def load_impropers_from_file(self, filename, use_cache=False,
+                                 cache_dir=None):
+        if filename.endswith(".sf"):
+            structure = read_structure(self.sf_parser, filename, use_cache,
+                                       cache_dir)
+            self.load_impropers_from_structure(structure)
+        else:
+            print "Expected a .sf file, got %s" % filename
+            return
+
+    def get_packed_impropers(self):
+        """
+        All impropers as (num_impropers, 4) serial numbers, force constants
+        and equilibrium angles.
+        """
+        self.flush_impropers()
+        if not self.improper_blocks:
+            return zeros((0, 4), dtype=int), zeros(0), zeros(0)
+        if len(self.improper_blocks) > 1:
+            self.improper_blocks = [tuple( concatenate(arrays) for arrays in
+                                           zip(*self.improper_blocks) )]
+        return self.improper_blocks[0]
+
+    def get_dihedral_arrays(self):
+        serial_nums = self.get_packed_impropers()[0]
+        # convert to 0-indexing
+        return tuple(serial_nums[:,n] - 1 for n in xrange(4))
+
+    def create_dihedral_func(self):
+        """
+        Function of the improper angles `psi` giving each energy and,
+        with `order` 1, dE/dpsi.
+        """
+        serial_nums, K_psi, Psi_0 = self.get_packed_impropers()
+        params = create_param_cache(K_psi, Psi_0)
+        def improper_func(psi, order=0):
+            K_psi, Psi_0 = params(psi.dtype)
+            d_psi = psi - Psi_0
+            d_psi -= 2 * pi * around(d_psi / (2 * pi))
+            derivs = [0.5 * K_psi * d_psi * d_psi]
+            if order >= 1:
+                derivs.append( K_psi * d_psi )
+            return derivs
+        return improper_func
+
+    def create_energy_func(self):
+        return create_dihedral_energy_func(self.get_dihedral_arrays(),
+                                           self.create_dihedral_func())
+
+    def create_gradient_func(self):
+        energy_and_gradient_func = self.create_energy_and_gradient_func()
+        def improper_gradient_func(X, D):
+            return energy_and_gradient_func(X)[1]
+        return improper_gradient_func
+
+    def create_energy_and_gradient_func(self):
+        return create_dihedral_energy_and_gradient_func(
+                    self.get_dihedral_arrays(), self.create_dihedral_func())
+
+    def create_hessian_func(self):
+        return create_dihedral_hessian_func(self.get_dihedral_arrays(),
+                                            self.create_dihedral_func())
+
+
+def compute_switch(r, r_on, r_off):
+    """
+    CHARMM-style switching function that goes smoothly from one at `r_on`
+    to zero at `r_off`.
+
+    Returns
+    -------
+    S, dS_dr, d2S_dr2 : ndarray
+        Switching function and its first and second derivatives at each
+        distance in `r`.
+    """
+    r_sq = clip(r * r, r_on**2, r_off**2)
+    denom = (r_off**2 - r_on**2)**3
+    S = (r_off**2 - r_sq)**2 * (r_off**2 + 2*r_sq - 3*r_on**2) / denom
+    dS_dr = 12 * r * (r_off**2 - r_sq) * (r_on**2 - r_sq) / denom
+    in_switch = (r > r_on) & (r < r_off)
+    d2S_dr2 = where(in_switch,
+                    (12 * (r_off**2 - r_sq) * (r_on**2 - r_sq) +
+                     24 * r_sq * (2*r_sq - r_off**2 - r_on**2)) / denom,
+                    0.0)
+    return S, dS_dr, d2S_dr2
+
 
 class VDWEnergyFactory(object):
     """docstring for VDWEnergyFactory"""
@@ -146,6 +872,18 @@ class VDWEnergyFactory(object):
         super(VDWEnergyFactory, self).__init__()
         self.well_distance = 2.6 # angstroms
         self.well_depth = 0.1 # kcal/mol
+        self.cutoff = None
+        self.skin = 2.0 # angstroms
+        self.truncation = 'shift'
+        self.switch_distance = None
+        self.pair_list = None
+        self.type_names = None
+        self.type_well_distances = None
+        self.type_well_depths = None
+        self.atom_types = None
+        self.combining_rule = 'lorentz_berthelot'
+        self.exclusion_list = None
+        self.scale_14 = 1.0
         self.sf_parser = StructureParser()
 
     def set_well_distance(self, well_distance):
@@ -154,47 +892,573 @@ class VDWEnergyFactory(object):
     def set_well_depth(self, well_depth):
         self.well_depth = well_depth
 
-    def load_vdw_from_file(self, filename):
-        if filename.endswith(".sf"):
-            # take parameters from first VDW line encountered in file
-            distance, depth = self.sf_parser.get_first_vdw_in_sf_file(filename)
+    def set_type_params(self, well_distances, well_depths, type_names=None):
+        """
+        Per-atom-type parameters, which replace the single well distance
+        and depth once atom types are set.
+
+        Parameters
+        ----------
+        well_distances, well_depths : sequence of float
+            Well distance (angstroms) and depth (kcal/mol) of each type.
+        type_names : sequence of str, optional
+            Name of each type, for `load_atom_types_from_universe`.
+        """
+        self.type_well_distances = asarray(well_distances, dtype=float)
+        self.type_well_depths = asarray(well_depths, dtype=float)
+        assert self.type_well_distances.shape == self.type_well_depths.shape
+        self.type_names = None if type_names is None else list(type_names)
+
+    def set_atom_types(self, atom_types):
+        """
+        Index into the type parameters of each atom.
+        """
+        self.atom_types = asarray(atom_types, dtype=int)
+
+    def load_atom_types_from_universe(self, universe):
+        """
+        Type each atom by its atom name, which must match a type name.
+        """
+        type_index = dict( (name, t) for t, name in
+                           enumerate(self.type_names) )
+        atom_names = universe.get_atom_names()
+        missing = set(atom_names) - set(type_index)
+        assert not missing, "No VDW parameters for atom types %s" % \
+                            ", ".join(sorted(missing))
+        self.set_atom_types([type_index[name] for name in atom_names])
+
+    def set_combining_rule(self, combining_rule):
+        """
+        'lorentz_berthelot' takes the arithmetic mean of the well distances
+        of a pair of types, 'geometric' the geometric mean. Well depths are
+        combined by geometric mean under both rules.
+        """
+        assert combining_rule in ('lorentz_berthelot', 'geometric'), \
+            "Expected combining rule 'lorentz_berthelot' or 'geometric', " \
+            "got %s" % combining_rule
+        self.combining_rule = combining_rule
+
+    def get_pair_tables(self):
+        """
+        Well distance and depth of every pair of types, as
+        (num_types, num_types) tables.
+        """
+        R = self.type_well_distances
+        eps = self.type_well_depths
+        if self.combining_rule == 'lorentz_berthelot':
+            R_table = 0.5 * (R[:,newaxis] + R[newaxis,:])
+        else:
+            R_table = sqrt(R[:,newaxis] * R[newaxis,:])
+        return R_table, sqrt(eps[:,newaxis] * eps[newaxis,:])
+
+    def create_pair_params_func(self):
+        """
+        Returns a function of the pair indices (I, J) that gives the well
+        distance and depth of each pair, gathered from the type tables by
+        type index, or None without atom types. The gathered arrays are
+        kept until the pair lists change.
+        """
+        if self.atom_types is None:
+            return lambda I, J, dtype=float: None
+        tables = create_param_cache(*self.get_pair_tables())
+        atom_types = self.atom_types
+        # one entry each for the neighbor list and the 1-4 pairs; the
+        # index arrays are stored so their ids can't be reused
+        gathered = {}
+        def pair_params_func(I, J, dtype=float):
+            key = (id(I), id(J), dtype)
+            if key not in gathered:
+                if len(gathered) > 1:
+                    gathered.clear()
+                R_table, eps_table = tables(dtype)
+                type_I = atom_types[I]
+                type_J = atom_types[J]
+                gathered[key] = (I, J, (R_table[type_I, type_J],
+                                        eps_table[type_I, type_J]))
+            return gathered[key][2]
+        return pair_params_func
+
+    def set_exclusions(self, exclusion_list, scale_14=1.0):
+        """
+        Leave the 1-2 and 1-3 pairs of `exclusion_list` (see
+        BondEnergyFactory.create_exclusion_list) out of the pair lists,
+        and scale the energy of its 1-4 pairs by `scale_14`. None removes
+        the exclusions.
+        """
+        self.exclusion_list = exclusion_list
+        self.scale_14 = scale_14
+        self.pair_list = None
+
+    def get_excluded_keys(self):
+        if self.exclusion_list is None:
+            return None
+        return self.exclusion_list.get_excluded_keys(
+                    include_one_four=(self.scale_14 != 1.0))
+
+    def create_pair_sets_func(self):
+        """
+        Returns a function of `X` that lists the pair index arrays to
+        evaluate with their energy scale: the pair list, and the 1-4 pairs
+        when they are scaled.
+        """
+        pair_list = self.get_pair_list()
+        if self.exclusion_list is None or self.scale_14 == 1.0:
+            return lambda X: [(pair_list.get_pairs(X), 1.0)]
+        one_four_pairs = self.exclusion_list.get_one_four_pairs()
+        scale_14 = self.scale_14
+        def pair_sets_func(X):
+            pair_sets = [(pair_list.get_pairs(X), 1.0)]
+            if scale_14 != 0.0:
+                pair_sets.append( (one_four_pairs, scale_14) )
+            return pair_sets
+        return pair_sets_func
+
+    def set_cutoff(self, cutoff, skin=2.0, truncation='shift',
+                   switch_distance=None):
+        """
+        Only evaluate pairs closer than `cutoff`, found with a neighbor list.
+
+        Parameters
+        ----------
+        cutoff : float or None
+            Cutoff in angstroms. None evaluates every pair of atoms.
+        skin : float, optional
+            Verlet skin of the neighbor list in angstroms.
+        truncation : {'shift', 'switch'}, optional
+            'shift' subtracts the energy at the cutoff so that the energy
+            goes to zero continuously. 'switch' scales the energy smoothly
+            to zero between `switch_distance` and `cutoff`.
+        switch_distance : float, optional
+            Where switching begins. Defaults to 0.8 * `cutoff`.
+        """
+        assert truncation in ('shift', 'switch'), \
+            "Expected truncation 'shift' or 'switch', got %s" % truncation
+        self.cutoff = cutoff
+        self.skin = skin
+        self.truncation = truncation
+        if switch_distance is None and cutoff is not None:
+            switch_distance = 0.8 * cutoff
+        self.switch_distance = switch_distance
+        self.pair_list = None
+
+    def get_pair_list(self):
+        if self.pair_list is None:
+            self.pair_list = create_pair_list(self.cutoff, self.skin,
+                                              self.get_excluded_keys())
+        return self.pair_list
+
+    def set_pair_list(self, pair_list):
+        """
+        Draw pairs from `pair_list`, e.g. this factory's `get_pair_list`
+        handed to an ElectrostaticEnergyFactory too, so that the terms of
+        one system share their pair geometry. It must reach at least the
+        cutoff and leave out the excluded pairs. `set_cutoff` and
+        `set_exclusions` go back to a list of this factory's own.
+        """
+        check_pair_list_cutoff(pair_list, self.cutoff)
+        excluded_keys = self.get_excluded_keys()
+        assert excluded_keys is None or \
+            (pair_list.excluded_keys is not None and
+             array_equal(pair_list.excluded_keys, excluded_keys)), \
+            "Pair list must leave out the pairs excluded from the VDW term"
+        self.pair_list = pair_list
+
+    def load_vdw_from_structure(self, structure):
+        """
+        Take the parameters of a structure read with
+        StructureParser.read_sf_file: the single well distance and depth
+        from its first untyped VDW record, and the type parameters from
+        its typed VDW records.
+        """
+        vdw_params = structure['vdw_params']
+        if len(vdw_params):
+            distance, depth = vdw_params[0]
             self.set_well_distance(distance)
             self.set_well_depth(depth)
+        type_params = structure.get('vdw_type_params')
+        if type_params is not None and len(type_params):
+            self.set_type_params(type_params[:,0], type_params[:,1],
+                                 structure['vdw_type_names'])
+
+    def load_vdw_from_file(self, filename, use_cache=False, cache_dir=None):
+        if filename.endswith(".sf"):
+            structure = read_structure(self.sf_parser, filename, use_cache,
+                                       cache_dir)
+            self.load_vdw_from_structure(structure)
         else:
             print "Expected a .sf file, got %s" % filename
             return
 
-    def create_energy_func(self):
-        well_distance = self.well_distance
-        well_depth = self.well_depth
-        def vdw_energy_func(X, D):
-            separation_ratio = well_distance / D
+    def create_pair_func(self):
+        """
+        Returns a function of the pair distances `r` that computes the
+        energy of each pair and, up to the requested `order`, dE/dr and
+        d2E/dr2, with the cutoff treatment applied. Precomputed inverse
+        distances may be passed as `inv_r`, and per-pair well distances
+        and depths as `params` (see `create_pair_params_func`).
+        """
+        default_params = (self.well_distance, self.well_depth)
+        cutoff = self.cutoff
+        truncation = self.truncation
+        switch_distance = self.switch_distance
+
+        def vdw_pair_func(r, order=0, inv_r=None, params=None):
+            if params is None:
+                well_distance, well_depth = default_params
+            else:
+                well_distance, well_depth = params
+            if inv_r is None:
+                inv_r = 1.0 / r
+            separation_ratio = well_distance * inv_r
             sr6 = separation_ratio ** 6
             sr12 = sr6 * sr6
-            E = well_depth * (sr12 - (2 * sr6))
-            # only sum terms above diagonal to avoid double counting
-            inds = triu_indices( E.shape[0], 1 )
-            return E[inds].sum()
+            derivs = [well_depth * (sr12 - (2 * sr6))]
+            if order >= 1:
+                # dE/dr = -12 * well depth * ( (r_min^12/r^13) - (r_min^6/r^7) )
+                derivs.append( -12 * well_depth * (sr12 - sr6) * inv_r )
+            if order >= 2:
+                derivs.append( well_depth * (156 * sr12 - 84 * sr6) *
+                               inv_r * inv_r )
+            if cutoff is None:
+                return derivs
+
+            if truncation == 'shift':
+                inside = r < cutoff
+                sr6 = (well_distance / cutoff) ** 6
+                derivs[0] = derivs[0] - well_depth * (sr6 * sr6 - (2 * sr6))
+                derivs = [where(inside, d, 0.0) for d in derivs]
+            else:
+                S, dS_dr, d2S_dr2 = compute_switch(r, switch_distance, cutoff)
+                switched = [derivs[0] * S]
+                if order >= 1:
+                    switched.append( derivs[1] * S + derivs[0] * dS_dr )
+                if order >= 2:
+                    switched.append( derivs[2] * S + 2 * derivs[1] * dS_dr +
+                                     derivs[0] * d2S_dr2 )
+                derivs = switched
+            return derivs
+        return vdw_pair_func
+
+    def create_energy_func(self):
+        pair_sets_func = self.create_pair_sets_func()
+        pair_func = self.create_pair_func()
+        pair_params_func = self.create_pair_params_func()
+        def vdw_energy_func(X, D):
+            E = 0.0
+            for (I, J), scale in pair_sets_func(X):
+                dX, r = compute_pair_vectors(X, I, J)
+                E_pairs, = pair_func(r, params=pair_params_func(I, J, r.dtype))
+                E = E + scale * E_pairs.sum(axis=-1, dtype=float64)
+            return E
         return vdw_energy_func
 
     def create_gradient_func(self):
-        well_distance = self.well_distance
-        well_depth = self.well_depth
+        energy_and_gradient_func = self.create_energy_and_gradient_func()
         def vdw_gradient_func(X, D):
-            G = zeros_like(X)
-            separation_ratio = well_distance / D
-            sr6 = separation_ratio ** 6
-            sr12 = sr6 * sr6
-            # F = 12* well depth * ( (r_min^12/r^13) - (r_min^6/r^7) )
-            F = 12 * well_depth * (sr12 - sr6) / D
-            for i in xrange(X.shape[0]):
-                for j in xrange(i+1, X.shape[0]):
-                    dX = (X[j,:] - X[i,:]) / D[j,i]
-                    G[i,:] += F[i,j] * dX
-                    G[j,:] += -F[i,j] * dX
-            return G
+            return energy_and_gradient_func(X)[1]
         return vdw_gradient_func
 
+    def create_energy_and_gradient_func(self):
+        pair_sets_func = self.create_pair_sets_func()
+        pair_func = self.create_pair_func()
+        pair_params_func = self.create_pair_params_func()
+        def vdw_energy_and_gradient_func(X, geometry=None):
+            E = 0.0
+            G = zeros_like(X)
+            for (I, J), scale in pair_sets_func(X):
+                dX, r = get_pair_vectors(X, I, J, geometry)
+                inv_r = get_inverse_distances(X, I, J, geometry)
+                E_pairs, dE_dr = pair_func(r, order=1, inv_r=inv_r,
+                                           params=pair_params_func(I, J,
+                                                                   r.dtype))
+                F = (scale * dE_dr * inv_r)[...,newaxis] * dX
+                accumulate_rows(G, J, F)
+                accumulate_rows(G, I, -F)
+                E = E + scale * E_pairs.sum(axis=-1, dtype=float64)
+            return E, G
+        return vdw_energy_and_gradient_func
+
+    def create_hessian_func(self):
+        pair_sets_func = self.create_pair_sets_func()
+        pair_func = self.create_pair_func()
+        pair_params_func = self.create_pair_params_func()
+        def vdw_hessian_func(X, geometry=None):
+            rows, cols, blocks = [], [], []
+            for (I, J), scale in pair_sets_func(X):
+                dX, r = get_pair_vectors(X, I, J, geometry)
+                inv_r = get_inverse_distances(X, I, J, geometry)
+                E, dE_dr, d2E_dr2 = pair_func(r, order=2, inv_r=inv_r,
+                                              params=pair_params_func(I, J))
+                pair_blocks = compute_pair_hessian_blocks(
+                                I, J, dX, r, scale * dE_dr, scale * d2E_dr2)
+                for parts, part in zip((rows, cols, blocks), pair_blocks):
+                    parts.append(part)
+            return concatenate(rows), concatenate(cols), concatenate(blocks)
+        return vdw_hessian_func
+
+
+class ElectrostaticEnergyFactory(object):
+    """
+    Coulomb energy of the atomic partial charges.
+
+    By default every pair of atoms interacts through the plain Coulomb law.
+    `set_cutoff` limits the sum to a neighbor list with a shifted or
+    reaction-field potential, and `set_pme` treats a periodic box with
+    particle-mesh Ewald.
+    """
+    def __init__(self):
+        super(ElectrostaticEnergyFactory, self).__init__()
+        self.charges = None
+        self.dielectric = 1.0
+        self.method = 'coulomb'
+        self.cutoff = None
+        self.skin = 2.0 # angstroms
+        self.solvent_dielectric = 78.5
+        self.box = None
+        self.ewald_tolerance = 1e-5
+        self.grid_spacing = 1.0 # angstroms
+        self.spline_order = 4
+        self.pair_list = None
+
+    def set_charges(self, charges):
+        self.charges = asarray(charges, dtype=float)
+
+    def load_charges_from_universe(self, universe):
+        self.set_charges(universe.get_charges())
+
+    def set_dielectric(self, dielectric):
+        self.dielectric = dielectric
+
+    def set_cutoff(self, cutoff, skin=2.0, method='shift',
+                   solvent_dielectric=78.5):
+        """
+        Only evaluate pairs closer than `cutoff`, found with a neighbor list.
+
+        Parameters
+        ----------
+        cutoff : float or None
+            Cutoff in angstroms. None restores plain Coulomb over every
+            pair of atoms.
+        skin : float, optional
+            Verlet skin of the neighbor list in angstroms.
+        method : {'shift', 'reaction_field'}, optional
+            'shift' subtracts the energy at the cutoff. 'reaction_field'
+            treats everything beyond the cutoff as a continuum of
+            dielectric `solvent_dielectric`; the energy also goes to zero
+            at the cutoff.
+        solvent_dielectric : float, optional
+        """
+        assert method in ('shift', 'reaction_field'), \
+            "Expected method 'shift' or 'reaction_field', got %s" % method
+        self.cutoff = cutoff
+        self.skin = skin
+        self.method = method if cutoff is not None else 'coulomb'
+        self.solvent_dielectric = solvent_dielectric
+        self.box = None
+        self.pair_list = None
+
+    def set_pme(self, box, cutoff=9.0, ewald_tolerance=1e-5, grid_spacing=1.0,
+                spline_order=4):
+        """
+        Particle-mesh Ewald summation in a periodic orthorhombic box.
+
+        Parameters
+        ----------
+        box : sequence of float
+            Side lengths of the box in angstroms.
+        cutoff : float, optional
+            Real-space cutoff in angstroms, at most half the shortest side.
+        ewald_tolerance : float, optional
+            Relative size of the real-space interaction at the cutoff,
+            which sets the Ewald splitting parameter.
+        grid_spacing : float, optional
+            Largest spacing of the charge grid in angstroms.
+        spline_order : int, optional
+            Order of the B-splines that spread charges onto the grid.
+        """
+        box = array(box, dtype=float)
+        assert box.shape == (3,), "Expected three box side lengths"
+        assert cutoff <= 0.5 * box.min(), \
+            "Real-space cutoff must be at most half the shortest box side"
+        self.method = 'pme'
+        self.box = box
+        self.cutoff = cutoff
+        self.ewald_tolerance = ewald_tolerance
+        self.grid_spacing = grid_spacing
+        self.spline_order = spline_order
+        self.pair_list = None
+
+    def get_ewald_alpha(self):
+        """
+        Splitting parameter with erfc(alpha * cutoff) = ewald_tolerance.
+        """
+        return erfcinv(self.ewald_tolerance) / self.cutoff
+
+    def get_pair_list(self):
+        if self.pair_list is None:
+            self.pair_list = create_pair_list(self.cutoff, self.skin)
+        return self.pair_list
+
+    def set_pair_list(self, pair_list):
+        """
+        Draw the pairs of the plain, shifted or reaction-field Coulomb sum
+        from `pair_list`, e.g. that of a VDWEnergyFactory of the same
+        system, whose exclusions then apply here too. `set_cutoff` and
+        `set_pme` go back to a list of this factory's own.
+        """
+        check_pair_list_cutoff(pair_list, self.cutoff)
+        self.pair_list = pair_list
+
+    def create_pair_func(self):
+        """
+        Returns a function of the pair distances `r` that computes the
+        energy of each pair per unit charge product and, up to the
+        requested `order`, dE/dr and d2E/dr2. Precomputed inverse distances
+        may be passed as `inv_r`.
+        """
+        assert self.method != 'pme', "PME has no pair function"
+        prefactor = COULOMB_CONSTANT / self.dielectric
+        method = self.method
+        cutoff = self.cutoff
+        if method == 'reaction_field':
+            eps = self.dielectric
+            eps_rf = self.solvent_dielectric
+            k_rf = (eps_rf - eps) / ((2 * eps_rf + eps) * cutoff**3)
+            c_rf = 1.0 / cutoff + k_rf * cutoff**2
+
+        def coulomb_pair_func(r, order=0, inv_r=None):
+            if inv_r is None:
+                inv_r = 1.0 / r
+            derivs = [prefactor * inv_r]
+            if order >= 1:
+                derivs.append( -prefactor * inv_r * inv_r )
+            if order >= 2:
+                derivs.append( 2 * prefactor * inv_r * inv_r * inv_r )
+            if method == 'coulomb':
+                return derivs
+
+            if method == 'shift':
+                derivs[0] = derivs[0] - prefactor / cutoff
+            else:
+                derivs[0] = derivs[0] + prefactor * (k_rf * r * r - c_rf)
+                if order >= 1:
+                    derivs[1] = derivs[1] + 2 * prefactor * k_rf * r
+                if order >= 2:
+                    derivs[2] = derivs[2] + 2 * prefactor * k_rf
+            inside = r < cutoff
+            return [where(inside, d, 0.0) for d in derivs]
+        return coulomb_pair_func
+
+    def create_energy_func(self):
+        if self.method == 'pme':
+            energy_and_gradient_func = self.create_energy_and_gradient_func()
+            def pme_energy_func(X, D):
+                return energy_and_gradient_func(X)[0]
+            return pme_energy_func
+        params = create_param_cache(self.charges)
+        pair_list = self.get_pair_list()
+        pair_func = self.create_pair_func()
+        def coulomb_energy_func(X, D):
+            charges, = params(X.dtype)
+            I, J = pair_list.get_pairs(X)
+            dX, r = compute_pair_vectors(X, I, J)
+            E, = pair_func(r)
+            return (charges[I] * charges[J] * E).sum(axis=-1, dtype=float64)
+        return coulomb_energy_func
+
+    def create_gradient_func(self):
+        energy_and_gradient_func = self.create_energy_and_gradient_func()
+        def coulomb_gradient_func(X, D):
+            return energy_and_gradient_func(X)[1]
+        return coulomb_gradient_func
+
+    def create_energy_and_gradient_func(self):
+        if self.method == 'pme':
+            return self.create_pme_energy_and_gradient_func()
+        params = create_param_cache(self.charges)
+        pair_list = self.get_pair_list()
+        pair_func = self.create_pair_func()
+        def coulomb_energy_and_gradient_func(X, geometry=None):
+            charges, = params(X.dtype)
+            I, J = pair_list.get_pairs(X)
+            dX, r = get_pair_vectors(X, I, J, geometry)
+            inv_r = get_inverse_distances(X, I, J, geometry)
+            E, dE_dr = pair_func(r, order=1, inv_r=inv_r)
+            qq = charges[I] * charges[J]
+            F = (qq * dE_dr * inv_r)[...,newaxis] * dX
+            G = zeros_like(X)
+            accumulate_rows(G, J, F)
+            accumulate_rows(G, I, -F)
+            return (qq * E).sum(axis=-1, dtype=float64), G
+        return coulomb_energy_and_gradient_func
+
+    def create_pme_energy_and_gradient_func(self):
+        """
+        Ewald energy as real-space pairs within the cutoff, the
+        particle-mesh reciprocal sum, and constant self and net-charge
+        terms. Real-space pairs are found afresh on every call, at the
+        nearest image. A stack of frames is evaluated frame by frame. PME
+        always computes in double precision.
+        """
+        charges = self.charges
+        box = self.box
+        cutoff = self.cutoff
+        alpha = self.get_ewald_alpha()
+        prefactor = COULOMB_CONSTANT / self.dielectric
+        grid_shape = get_grid_shape(box, self.grid_spacing, self.spline_order)
+        reciprocal_func = create_reciprocal_func(box, grid_shape, alpha,
+                                                 self.spline_order)
+        E_constant = -prefactor * (
+            alpha / sqrt(pi) * (charges * charges).sum() +
+            pi * charges.sum()**2 / (2 * box.prod() * alpha * alpha))
+
+        def pme_energy_and_gradient_func(X, geometry=None):
+            if X.ndim == 3:
+                results = [pme_energy_and_gradient_func(frame) for frame in X]
+                return (array([E for E, G in results]),
+                        array([G for E, G in results]))
+            X = asarray(X, dtype=float64)
+            X_box = X - box * floor(X / box)
+            X_box = where(X_box >= box, X_box - box, X_box)
+            I, J = find_pairs(X_box, cutoff, box)
+            dX = X_box[J] - X_box[I]
+            dX -= box * around(dX / box)
+            r = sqrt((dX * dX).sum(axis=1))
+            qq = charges[I] * charges[J]
+            erfc_ar = erfc(alpha * r)
+            E_real = (qq * erfc_ar / r).sum()
+            dE_dr = -qq * (erfc_ar / r + 2 * alpha / sqrt(pi) *
+                           exp(-alpha * alpha * r * r)) / r
+            F = (dE_dr / r)[:,newaxis] * dX
+            G = zeros_like(X)
+            accumulate_rows(G, J, F)
+            accumulate_rows(G, I, -F)
+            E_reciprocal, G_reciprocal = reciprocal_func(X_box, charges)
+            E = prefactor * (E_real + E_reciprocal) + E_constant
+            return E, prefactor * (G + G_reciprocal)
+        return pme_energy_and_gradient_func
+
+    def create_hessian_func(self):
+        """
+        Analytic pair Hessian, or finite differences of the gradient with
+        PME.
+        """
+        if self.method == 'pme':
+            return create_finite_difference_hessian_func(
+                        self.create_gradient_func())
+        charges = self.charges
+        pair_list = self.get_pair_list()
+        pair_func = self.create_pair_func()
+        def coulomb_hessian_func(X, geometry=None):
+            I, J = pair_list.get_pairs(X)
+            dX, r = get_pair_vectors(X, I, J, geometry)
+            inv_r = get_inverse_distances(X, I, J, geometry)
+            E, dE_dr, d2E_dr2 = pair_func(r, order=2, inv_r=inv_r)
+            qq = charges[I] * charges[J]
+            return compute_pair_hessian_blocks(I, J, dX, r, qq * dE_dr,
+                                               qq * d2E_dr2)
+        return coulomb_hessian_func
+
 
 class EnergyFunctionFactory(object):
     """docstring for EnergyFunctionFactory"""
@@ -204,16 +1468,44 @@ class EnergyFunctionFactory(object):
     def add_energy_term(self, term_name, term_func):
         self.energy_terms[term_name] = term_func
 
-    def create_energy_func(self, term_names, num_atoms):
+    def create_energy_func(self, term_names, num_atoms, profiler=None,
+                           dtype=None):
+        """
+        With a `profiler` (see `sardine.instrument`), each term and the
+        whole function are timed under 'energy:<term>' and 'energy'.
+
+        With `dtype`, e.g. float32, the coordinates are converted to it and
+        the terms compute in that precision; the total is still summed in
+        float64.
+        """
+        terms = wrap_terms(profiler, 'energy', self.energy_terms, term_names)
         def energy_func(X_vec):
-            X = X_vec.reshape((num_atoms, 3))
-            D_vec = compute_distance_vector(X)
-            D = compute_distance_matrix_from_vector(D_vec)
+            X = cast_coords(X_vec.reshape((num_atoms, 3)), dtype)
+            # each term computes the distances it needs from X, so no
+            # distance matrix is passed along
             E = 0.
             for t in term_names:
-                E += self.energy_terms[t](X, D)
+                E += terms[t](X, None)
+            return E
+        return wrap_function(profiler, 'energy', energy_func)
+
+    def create_batch_energy_func(self, term_names, num_atoms, chunk_size=None,
+                                 profiler=None, dtype=None):
+        """
+        Energy of every frame of a (num_frames, N, 3) or (num_frames, 3N)
+        coordinate stack. The frames go through the terms together, in
+        chunks of `chunk_size` frames (see `get_batch_chunk_size`).
+        """
+        chunk_size = get_batch_chunk_size(num_atoms, chunk_size, dtype)
+        terms = wrap_terms(profiler, 'energy', self.energy_terms, term_names)
+        def batch_energy_func(X_stack):
+            X_stack = cast_coords(X_stack.reshape((-1, num_atoms, 3)), dtype)
+            E = zeros(len(X_stack))
+            for chunk in iter_frame_chunks(len(X_stack), chunk_size):
+                for t in term_names:
+                    E[chunk] += terms[t](X_stack[chunk], None)
             return E
-        return energy_func
+        return wrap_function(profiler, 'batch_energy', batch_energy_func)
 
 
 class GradientFunctionFactory(object):
@@ -224,13 +1516,151 @@ class GradientFunctionFactory(object):
     def add_gradient_term(self, term_name, term_func):
         self.gradient_terms[term_name] = term_func
 
-    def create_gradient_func(self, term_names, num_atoms):
+    def create_gradient_func(self, term_names, num_atoms, profiler=None,
+                             dtype=None):
+        """
+        With `dtype`, the terms compute in that precision and their
+        gradients are summed in float64.
+        """
+        terms = wrap_terms(profiler, 'gradient', self.gradient_terms,
+                           term_names)
         def gradient_func(X_vec):
-            X = X_vec.reshape((num_atoms, 3))
-            D_vec = compute_distance_vector(X)
-            D = compute_distance_matrix_from_vector(D_vec)
-            G = zeros_like(X)
+            X = cast_coords(X_vec.reshape((num_atoms, 3)), dtype)
+            G = zeros(X.shape)
             for t in term_names:
-                G += self.gradient_terms[t](X,D)
+                G += terms[t](X, None)
             return G.flatten()
-        return gradient_func
+        return wrap_function(profiler, 'gradient', gradient_func)
+
+    def create_batch_gradient_func(self, term_names, num_atoms,
+                                   chunk_size=None, profiler=None, dtype=None):
+        """
+        (num_frames, 3N) gradients of a coordinate stack, evaluated in
+        chunks of frames as in
+        `EnergyFunctionFactory.create_batch_energy_func`.
+        """
+        chunk_size = get_batch_chunk_size(num_atoms, chunk_size, dtype)
+        terms = wrap_terms(profiler, 'gradient', self.gradient_terms,
+                           term_names)
+        def batch_gradient_func(X_stack):
+            X_stack = cast_coords(X_stack.reshape((-1, num_atoms, 3)), dtype)
+            G = zeros(X_stack.shape)
+            for chunk in iter_frame_chunks(len(X_stack), chunk_size):
+                for t in term_names:
+                    G[chunk] += terms[t](X_stack[chunk], None)
+            return G.reshape((len(X_stack), -1))
+        return wrap_function(profiler, 'batch_gradient', batch_gradient_func)
+
+
+class EnergyGradientFunctionFactory(object):
+    """
+    Combines terms that return `(energy, gradient)` into a single function
+    of the flattened coordinates, so that the energy and gradient at a
+    point come from one pass that shares the geometry across terms.
+    """
+    def __init__(self):
+        self.energy_gradient_terms = {}
+
+    def add_energy_gradient_term(self, term_name, term_func):
+        self.energy_gradient_terms[term_name] = term_func
+
+    def create_energy_and_gradient_func(self, term_names, num_atoms,
+                                        profiler=None, dtype=None):
+        """
+        With a `profiler`, each term is timed under
+        'energy_and_gradient:<term>', the shared pair geometry under
+        'geometry' and the whole function under 'energy_and_gradient'.
+
+        With `dtype`, e.g. float32, the coordinates are converted to it
+        and the terms, including the shared geometry, compute in that
+        precision. Energies and gradients are accumulated in float64, so
+        the minimizers see double precision values.
+        """
+        terms = wrap_terms(profiler, 'energy_and_gradient',
+                           self.energy_gradient_terms, term_names)
+        def energy_and_gradient_func(X_vec):
+            X = cast_coords(X_vec.reshape((num_atoms, 3)), dtype)
+            geometry = GeometryCache(X, profiler)
+            E = 0.
+            G = zeros(X.shape)
+            for t in term_names:
+                term_E, term_G = terms[t](X, geometry)
+                E += term_E
+                G += term_G
+            return E, G.flatten()
+        return wrap_function(profiler, 'energy_and_gradient',
+                             energy_and_gradient_func)
+
+    def create_batch_energy_and_gradient_func(self, term_names, num_atoms,
+                                              chunk_size=None, profiler=None,
+                                              dtype=None):
+        """
+        Energies (num_frames,) and gradients (num_frames, 3N) of every
+        frame of a coordinate stack. Each chunk of frames goes through all
+        terms in one pass that shares its geometry; see
+        `get_batch_chunk_size` for the chunk size.
+        """
+        chunk_size = get_batch_chunk_size(num_atoms, chunk_size, dtype)
+        terms = wrap_terms(profiler, 'energy_and_gradient',
+                           self.energy_gradient_terms, term_names)
+        def batch_energy_and_gradient_func(X_stack):
+            X_stack = cast_coords(X_stack.reshape((-1, num_atoms, 3)), dtype)
+            E = zeros(len(X_stack))
+            G = zeros(X_stack.shape)
+            for chunk in iter_frame_chunks(len(X_stack), chunk_size):
+                X = X_stack[chunk]
+                geometry = GeometryCache(X, profiler)
+                for t in term_names:
+                    term_E, term_G = terms[t](X, geometry)
+                    E[chunk] += term_E
+                    G[chunk] += term_G
+            return E, G.reshape((len(X_stack), -1))
+        return wrap_function(profiler, 'batch_energy_and_gradient',
+                             batch_energy_and_gradient_func)
+
+
+class HessianFunctionFactory(object):
+    """
+    Combines Hessian terms into a function that returns the full
+    (3N, 3N) Hessian of the flattened coordinates.
+
+    Each term returns `(rows, cols, blocks)`, the 3x3 second-derivative
+    blocks between pairs of atoms, and all blocks are summed in one pass,
+    either into a dense array or into a scipy.sparse CSR matrix.
+    """
+    def __init__(self):
+        self.hessian_terms = {}
+
+    def add_hessian_term(self, term_name, term_func):
+        self.hessian_terms[term_name] = term_func
+
+    def add_gradient_term(self, term_name, term_func, step=1e-5):
+        """
+        Add a term that has only an analytic gradient `term_func(X, D)`;
+        its Hessian comes from finite differences of the gradient.
+        """
+        self.hessian_terms[term_name] = \
+            create_finite_difference_hessian_func(term_func, step)
+
+    def create_hessian_func(self, term_names, num_atoms, sparse=False,
+                            profiler=None):
+        """
+        With a `profiler`, each term is timed under 'hessian:<term>', the
+        assembly under 'hessian_assembly' and the whole function under
+        'hessian'.
+        """
+        assemble = assemble_sparse_hessian if sparse else assemble_hessian
+        assemble = wrap_function(profiler, 'hessian_assembly', assemble)
+        terms = wrap_terms(profiler, 'hessian', self.hessian_terms, term_names)
+        def hessian_func(X_vec):
+            X = X_vec.reshape((num_atoms, 3))
+            geometry = GeometryCache(X, profiler)
+            rows, cols, blocks = [], [], []
+            for t in term_names:
+                term_rows, term_cols, term_blocks = terms[t](X, geometry)
+                rows.append(term_rows)
+                cols.append(term_cols)
+                blocks.append(term_blocks)
+            return assemble(concatenate(rows), concatenate(cols),
+                            concatenate(blocks), num_atoms)
+        return wrap_function(profiler, 'hessian', hessian_func)
@@ -0,0 +1,153 @@
+"""
+Opt-in timing and memory instrumentation.
+
+A Profiler passed to the function factories (and to
+`Minimizer.run_minimization`) wraps each term when the function is
+created, so unprofiled functions carry no extra cost. Every call adds to
+the named entry's call count, wall time and, with `track_memory`, memory
+growth; callbacks registered with `add_callback` see each call as it
+happens.
+"""
+
+from collections import namedtuple
+from timeit import default_timer
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+TimingStats = namedtuple("TimingStats", ['num_calls', 'total_time',
+                                         'mean_time', 'memory'])
+
+
+def get_peak_rss():
+    """
+    Peak resident set size of this process in bytes, or 0 where the
+    resource module is missing.
+    """
+    if resource is None:
+        return 0
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Profiler(object):
+    """
+    Per-name call counts, cumulative wall time and memory growth.
+
+    Parameters
+    ----------
+    track_memory : bool, optional
+        Also record memory. Uses tracemalloc where available (bytes
+        allocated during the call) and otherwise the growth of the peak
+        resident set size, which is coarser and only sees new peaks.
+    """
+    def __init__(self, track_memory=False):
+        super(Profiler, self).__init__()
+        self.track_memory = track_memory
+        self.enabled = True
+        self.callbacks = []
+        self.reset()
+        if track_memory and tracemalloc is not None and \
+           not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def reset(self):
+        self.num_calls = {}
+        self.total_time = {}
+        self.memory = {}
+
+    def add_callback(self, callback_fcn):
+        """
+        Call `callback_fcn(name, elapsed, memory)` after every profiled
+        call.
+        """
+        self.callbacks.append(callback_fcn)
+
+    def get_memory(self):
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            return tracemalloc.get_traced_memory()[0]
+        return get_peak_rss()
+
+    def record(self, name, elapsed, memory=0):
+        self.num_calls[name] = self.num_calls.get(name, 0) + 1
+        self.total_time[name] = self.total_time.get(name, 0.0) + elapsed
+        self.memory[name] = self.memory.get(name, 0) + memory
+        for callback_fcn in self.callbacks:
+            callback_fcn(name, elapsed, memory)
+
+    def count(self, name):
+        """
+        Count a call to `name` without timing it.
+        """
+        self.record(name, 0.0)
+
+    def wrap(self, name, func):
+        """
+        `func` with every call recorded under `name`.
+        """
+        def profiled_func(*args, **kwargs):
+            if not self.enabled:
+                return func(*args, **kwargs)
+            start_memory = self.get_memory() if self.track_memory else 0
+            start = default_timer()
+            result = func(*args, **kwargs)
+            elapsed = default_timer() - start
+            memory = self.get_memory() - start_memory \
+                     if self.track_memory else 0
+            self.record(name, elapsed, max(memory, 0))
+            return result
+        return profiled_func
+
+    def get_report(self):
+        """
+        TimingStats for each recorded name.
+        """
+        report = {}
+        for name, num_calls in self.num_calls.iteritems():
+            total_time = self.total_time[name]
+            report[name] = TimingStats(num_calls, total_time,
+                                       total_time / num_calls,
+                                       self.memory[name])
+        return report
+
+    def report_to_str(self):
+        """
+        Table of the report, slowest entries first.
+        """
+        report = self.get_report()
+        names = sorted(report, key=lambda n: report[n].total_time,
+                       reverse=True)
+        lines = ["%-32s %10s %12s %12s %12s" % ('name', 'calls', 'total (s)',
+                                                'mean (s)', 'memory (B)')]
+        for name in names:
+            stats = report[name]
+            lines.append("%-32s %10d %12.6f %12.6f %12d" %
+                         (name, stats.num_calls, stats.total_time,
+                          stats.mean_time, stats.memory))
+        return "\n".join(lines) + "\n"
+
+
+def wrap_terms(profiler, prefix, terms, term_names):
+    """
+    Terms of `terms` (a dict of functions) named in `term_names`, wrapped
+    by `profiler` under '<prefix>:<term name>', or unchanged without a
+    profiler.
+    """
+    if profiler is None:
+        return dict( (t, terms[t]) for t in term_names )
+    return dict( (t, profiler.wrap("%s:%s" % (prefix, t), terms[t]))
+                 for t in term_names )
+
+def wrap_function(profiler, name, func):
+    """
+    `func` timed under `name` by `profiler`, or `func` itself without a
+    profiler.
+    """
+    if profiler is None:
+        return func
+    return profiler.wrap(name, func)
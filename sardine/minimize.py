@@ -1,30 +1,77 @@
-from scipy.optimize import fmin_bfgs
+from abc import ABCMeta, abstractmethod
+from collections import namedtuple
+from timeit import default_timer
+from numpy import array_equal, absolute, dot, sqrt, zeros_like, newaxis,\
+                  minimum, asarray
+from scipy.optimize import fmin_bfgs, fmin_l_bfgs_b, fmin_cg
 from .trajectory import Trajectory
+from .instrument import wrap_function
 
+# above this many atoms create_minimizer switches from BFGS, whose dense
+# inverse Hessian takes O(N^2) memory, to limited-memory BFGS
+MAX_BFGS_ATOMS = 1000
 
-class BFGSMinimizer(object):
+# messages for the warnflag returned by fmin_bfgs and fmin_cg
+SCIPY_MESSAGES = {0: "Optimization terminated successfully",
+                  1: "Maximum number of iterations exceeded",
+                  2: "Gradient and/or function calls not changing"}
+
+def scipy_message(warnflag):
+    return SCIPY_MESSAGES.get(warnflag, "Warning flag %d" % warnflag)
+
+MinimizationStatus = namedtuple("MinimizationStatus",
+                                ['converged', 'message', 'num_iterations',
+                                 'num_energy_evals', 'num_gradient_evals',
+                                 'energy', 'max_gradient'])
+
+
+def split_energy_and_gradient(energy_and_gradient_fcn):
     """
-    Attributes
-    ----------
-    optimization_fcn : callable f(func, x0, *args)
-        A function that optimizes parameters based on scores computed
-        from a scoring function.
+    Split a function returning `(energy, gradient)` into separate energy
+    and gradient functions. The last evaluation is cached, so asking for
+    the energy and the gradient at the same point evaluates it only once.
+    """
+    last = {'X': None, 'E': None, 'G': None}
+    def evaluate(X):
+        if last['X'] is None or not array_equal(X, last['X']):
+            last['E'], last['G'] = energy_and_gradient_fcn(X)
+            last['X'] = X.copy()
+    def energy_fcn(X):
+        evaluate(X)
+        return last['E']
+    def gradient_fcn(X):
+        evaluate(X)
+        return last['G']
+    return energy_fcn, gradient_fcn
+
+
+class Minimizer(object):
+    """
+    Shared driver for the minimizer backends. Subclasses implement the
+    abstract `minimize` and can't be created without it; this class
+    handles fused energy/gradient functions, trajectory callbacks,
+    evaluation counting and the convergence report returned by
+    `get_status`.
 
     Parameters
     ----------
     gtol : float, optional
-    epsilon : float, optional
+        Converged once no gradient component exceeds this.
     maxiter : int, optional
     """
-    def __init__(self, gtol=1e-6, epsilon=0.01, maxiter=200):
-        super(BFGSMinimizer, self).__init__()
+    __metaclass__ = ABCMeta
+
+    def __init__(self, gtol=1e-6, maxiter=200):
+        super(Minimizer, self).__init__()
         self.gtol = gtol
-        self.epsilon = epsilon
         self.maxiter = maxiter
         self.traj = None
+        self.status = None
 
     def run_minimization(self, energy_fcn, gradient_fcn, X, num_atoms,
-                         save_trajectory=False, noisy=False):
+                         save_trajectory=False, noisy=False, jac=False,
+                         trajectory_writer=None, profiler=None,
+                         trajectory_dtype=float):
         """
         Optimize parameters based on a scoring function.
 
@@ -32,10 +79,28 @@ class BFGSMinimizer(object):
         ----------
         energy_fcn : callable f(x, *args)
             A function that computes the energy, given `x`, an array of parameters.
+        gradient_fcn : callable f(x, *args)
+            A function that computes the gradient of the energy. Ignored
+            when `jac` is True.
         X : ndarray
             Initial coordinates to pass to the energy function.
         noisy : bool, optional
             Whether to write minimizer messages to stdout.
+        jac : bool, optional
+            If True, `energy_fcn` returns `(energy, gradient)` and both
+            are taken from one evaluation per point.
+        trajectory_writer : PdbTrajectoryWriter or DCDTrajectoryWriter, optional
+            Frames are streamed to this writer as the minimization runs,
+            instead of being kept in memory.
+        profiler : Profiler, optional
+            Times the evaluations under 'minimizer:energy_and_gradient',
+            or 'minimizer:energy' and 'minimizer:gradient', the whole run
+            under 'minimization', and the time spent outside evaluations
+            under 'minimizer_overhead'.
+        trajectory_dtype : dtype, optional
+            Storage type of the saved trajectory, e.g. float32 to halve
+            its size. The minimization itself always runs on float64
+            coordinates.
 
         Returns
         -------
@@ -44,24 +109,292 @@ class BFGSMinimizer(object):
         energy : float
             The energy at the minimized position.
         """
-        if save_trajectory:
-            callback_fcn = self.make_callback_fcn(num_atoms)
-            callback_fcn(X) # save initial coords to trajectory
+        X = asarray(X, dtype=float)
+        num_evals = {'E': 0, 'G': 0}
+        # unprofiled and uncounted, for the final gradient check
+        unwrapped_energy_fcn, unwrapped_gradient_fcn = energy_fcn, gradient_fcn
+        if jac:
+            energy_and_gradient_fcn = wrap_function(
+                profiler, 'minimizer:energy_and_gradient', energy_fcn)
+            eval_names = ['minimizer:energy_and_gradient']
+            def counted_energy_and_gradient_fcn(X):
+                num_evals['E'] += 1
+                num_evals['G'] += 1
+                return energy_and_gradient_fcn(X)
+            energy_fcn, gradient_fcn = split_energy_and_gradient(
+                                            counted_energy_and_gradient_fcn)
+            counted_energy_fcn, counted_gradient_fcn = energy_fcn, gradient_fcn
+        else:
+            energy_fcn = wrap_function(profiler, 'minimizer:energy',
+                                       energy_fcn)
+            gradient_fcn = wrap_function(profiler, 'minimizer:gradient',
+                                         gradient_fcn)
+            eval_names = ['minimizer:energy', 'minimizer:gradient']
+            def counted_energy_fcn(X):
+                num_evals['E'] += 1
+                return energy_fcn(X)
+            def counted_gradient_fcn(X):
+                num_evals['G'] += 1
+                return gradient_fcn(X)
 
-        results = fmin_bfgs(f=energy_fcn, fprime=gradient_fcn, x0=X,
-                            gtol=self.gtol, epsilon=self.epsilon,
-                            maxiter=self.maxiter, full_output=noisy,
-                            callback=callback_fcn)
-        X_min = results[0]
-        energy = results[1]
+        num_iterations = [0]
+        record_fcn = None
+        if save_trajectory or trajectory_writer is not None:
+            record_fcn = self.make_callback_fcn(num_atoms, save_trajectory,
+                                                trajectory_writer,
+                                                trajectory_dtype)
+            record_fcn(X) # save initial coords to trajectory
+        def callback_fcn(X_vec):
+            num_iterations[0] += 1
+            if record_fcn is not None:
+                record_fcn(X_vec)
+
+        if profiler is not None:
+            start_eval_time = sum(profiler.total_time.get(name, 0.0)
+                                  for name in eval_names)
+            start = default_timer()
+        X_min, energy, converged, message = self.minimize(
+            counted_energy_fcn, counted_gradient_fcn, X, callback_fcn, noisy)
+        if profiler is not None:
+            elapsed = default_timer() - start
+            eval_time = sum(profiler.total_time.get(name, 0.0)
+                            for name in eval_names) - start_eval_time
+            profiler.record('minimization', elapsed)
+            profiler.record('minimizer_overhead', elapsed - eval_time)
+        num_energy_evals, num_gradient_evals = num_evals['E'], num_evals['G']
+        # checking the final gradient is not part of the minimization
+        if jac:
+            final_gradient = unwrapped_energy_fcn(X_min)[1]
+        else:
+            final_gradient = unwrapped_gradient_fcn(X_min)
+        max_gradient = absolute(final_gradient).max()
+        self.status = MinimizationStatus(converged, message, num_iterations[0],
+                                         num_energy_evals, num_gradient_evals,
+                                         energy, max_gradient)
         return X_min, energy
 
-    def make_callback_fcn(self, num_atoms):
-        self.traj = Trajectory()
+    @abstractmethod
+    def minimize(self, energy_fcn, gradient_fcn, X, callback_fcn, noisy):
+        """
+        Run the backend. Returns the minimized coordinates, their energy,
+        whether the minimization converged and a message.
+        """
+
+    def make_callback_fcn(self, num_atoms, save_trajectory=True,
+                          trajectory_writer=None, trajectory_dtype=float):
+        self.traj = Trajectory(num_atoms, dtype=trajectory_dtype) \
+                    if save_trajectory else None
         def callback_fcn(X_vec):
             X = X_vec.reshape((num_atoms, 3))
-            self.traj.add_frame(X)
+            if self.traj is not None:
+                self.traj.add_frame(X)
+            if trajectory_writer is not None:
+                trajectory_writer.write_frame(X)
         return callback_fcn
 
     def get_trajectory(self):
         return self.traj
+
+    def get_status(self):
+        """
+        MinimizationStatus of the last run.
+        """
+        return self.status
+
+
+class BFGSMinimizer(Minimizer):
+    """
+    BFGS from `scipy.optimize.fmin_bfgs`. Keeps a dense 3N x 3N inverse
+    Hessian, so it suits small systems.
+
+    Parameters
+    ----------
+    gtol : float, optional
+    epsilon : float, optional
+    maxiter : int, optional
+    """
+    def __init__(self, gtol=1e-6, epsilon=0.01, maxiter=200):
+        super(BFGSMinimizer, self).__init__(gtol, maxiter)
+        self.epsilon = epsilon
+
+    def minimize(self, energy_fcn, gradient_fcn, X, callback_fcn, noisy):
+        results = fmin_bfgs(f=energy_fcn, fprime=gradient_fcn, x0=X,
+                            gtol=self.gtol, epsilon=self.epsilon,
+                            maxiter=self.maxiter, full_output=True,
+                            disp=noisy, callback=callback_fcn)
+        X_min, energy, warnflag = results[0], results[1], results[6]
+        return X_min, energy, warnflag == 0, scipy_message(warnflag)
+
+
+class LBFGSMinimizer(Minimizer):
+    """
+    Limited-memory BFGS from `scipy.optimize.fmin_l_bfgs_b`. Stores only
+    `num_corrections` vector pairs, so memory is O(N).
+
+    Parameters
+    ----------
+    gtol : float, optional
+    maxiter : int, optional
+    num_corrections : int, optional
+        Number of past steps used to approximate the Hessian.
+    """
+    def __init__(self, gtol=1e-6, maxiter=200, num_corrections=10):
+        super(LBFGSMinimizer, self).__init__(gtol, maxiter)
+        self.num_corrections = num_corrections
+
+    def minimize(self, energy_fcn, gradient_fcn, X, callback_fcn, noisy):
+        X_min, energy, info = fmin_l_bfgs_b(
+                                func=energy_fcn, x0=X, fprime=gradient_fcn,
+                                m=self.num_corrections, pgtol=self.gtol,
+                                factr=0.0, maxiter=self.maxiter,
+                                disp=1 if noisy else 0,
+                                callback=callback_fcn)
+        return X_min, energy, info['warnflag'] == 0, str(info['task'])
+
+
+class CGMinimizer(Minimizer):
+    """
+    Nonlinear conjugate gradient (Polak-Ribiere) from
+    `scipy.optimize.fmin_cg`. O(N) memory.
+    """
+    def minimize(self, energy_fcn, gradient_fcn, X, callback_fcn, noisy):
+        results = fmin_cg(f=energy_fcn, x0=X, fprime=gradient_fcn,
+                          gtol=self.gtol, maxiter=self.maxiter,
+                          full_output=True, disp=noisy,
+                          callback=callback_fcn)
+        X_min, energy, warnflag = results[0], results[1], results[4]
+        return X_min, energy, warnflag == 0, scipy_message(warnflag)
+
+
+def limit_atom_steps(dX, max_step):
+    """
+    Scale the displacement of each atom in the flat vector `dX` down to at
+    most `max_step`.
+    """
+    dX = dX.reshape((-1, 3))
+    step_lengths = sqrt( (dX * dX).sum(axis=1) )
+    scale = minimum(1.0, max_step / (step_lengths + 1e-300))
+    return (dX * scale[:,newaxis]).reshape(-1)
+
+
+class FIREMinimizer(Minimizer):
+    """
+    Fast inertial relaxation engine (Bitzek et al., PRL 97, 170201). A
+    damped molecular dynamics descent that only needs gradients and takes
+    bounded steps, so it copes with badly strained starting structures.
+
+    Parameters
+    ----------
+    gtol : float, optional
+    maxiter : int, optional
+    dt : float, optional
+        Initial time step.
+    dt_max : float, optional
+    max_step : float, optional
+        Largest displacement of any atom in one step, in angstroms.
+    """
+    def __init__(self, gtol=1e-6, maxiter=1000, dt=0.1, dt_max=1.0,
+                 max_step=0.2):
+        super(FIREMinimizer, self).__init__(gtol, maxiter)
+        self.dt = dt
+        self.dt_max = dt_max
+        self.max_step = max_step
+        self.alpha_start = 0.1
+        self.n_min = 5
+        self.f_inc = 1.1
+        self.f_dec = 0.5
+        self.f_alpha = 0.99
+
+    def minimize(self, energy_fcn, gradient_fcn, X, callback_fcn, noisy):
+        X = X.copy()
+        V = zeros_like(X)
+        dt = self.dt
+        alpha = self.alpha_start
+        num_steps_downhill = 0
+        for i in xrange(self.maxiter):
+            F = -gradient_fcn(X)
+            max_force = absolute(F).max()
+            if noisy:
+                # FIRE needs no energies, so the force already at hand is
+                # reported rather than paying for an energy evaluation
+                print "FIRE step %d: max force %f" % (i + 1, max_force)
+            if max_force < self.gtol:
+                return X, energy_fcn(X), True, "Converged"
+            if dot(F, V) > 0.0:
+                V = (1 - alpha) * V + \
+                    alpha * sqrt(dot(V, V) / dot(F, F)) * F
+                if num_steps_downhill > self.n_min:
+                    dt = min(dt * self.f_inc, self.dt_max)
+                    alpha *= self.f_alpha
+                num_steps_downhill += 1
+            else:
+                V[:] = 0.0
+                dt *= self.f_dec
+                alpha = self.alpha_start
+                num_steps_downhill = 0
+            V += dt * F
+            X += limit_atom_steps(dt * V, self.max_step)
+            callback_fcn(X)
+        converged = absolute(gradient_fcn(X)).max() < self.gtol
+        return X, energy_fcn(X), converged, \
+               "Converged" if converged else SCIPY_MESSAGES[1]
+
+
+class SteepestDescentMinimizer(Minimizer):
+    """
+    Steepest descent with an adaptive step: a step that lowers the energy
+    is taken and the step grows; otherwise it is rejected and the step
+    shrinks. Robust but slow, for cleaning up badly strained structures
+    before another backend takes over.
+
+    Parameters
+    ----------
+    gtol : float, optional
+    maxiter : int, optional
+    step_size : float, optional
+        Initial step, in angstroms per unit gradient.
+    max_step : float, optional
+        Largest displacement of any atom in one step, in angstroms.
+    """
+    def __init__(self, gtol=1e-6, maxiter=1000, step_size=0.01, max_step=0.2):
+        super(SteepestDescentMinimizer, self).__init__(gtol, maxiter)
+        self.step_size = step_size
+        self.max_step = max_step
+
+    def minimize(self, energy_fcn, gradient_fcn, X, callback_fcn, noisy):
+        step_size = self.step_size
+        E = energy_fcn(X)
+        G = gradient_fcn(X)
+        for i in xrange(self.maxiter):
+            if absolute(G).max() < self.gtol:
+                return X, E, True, "Converged"
+            X_new = X - limit_atom_steps(step_size * G, self.max_step)
+            E_new = energy_fcn(X_new)
+            if E_new < E:
+                X, E = X_new, E_new
+                G = gradient_fcn(X)
+                step_size *= 1.2
+                callback_fcn(X)
+                if noisy:
+                    print "Steepest descent step %d: energy %f" % (i + 1, E)
+            else:
+                step_size *= 0.5
+        converged = absolute(G).max() < self.gtol
+        return X, E, converged, \
+               "Converged" if converged else SCIPY_MESSAGES[1]
+
+
+MINIMIZERS = {'bfgs': BFGSMinimizer, 'lbfgs': LBFGSMinimizer,
+              'cg': CGMinimizer, 'fire': FIREMinimizer,
+              'sd': SteepestDescentMinimizer}
+
+def create_minimizer(num_atoms, method=None, **kwargs):
+    """
+    Minimizer for a system of `num_atoms` atoms. Unless `method` (one of
+    the keys of MINIMIZERS) is given, BFGS is used for small systems and
+    L-BFGS above MAX_BFGS_ATOMS. Keyword arguments go to the minimizer.
+    """
+    if method is None:
+        method = 'bfgs' if num_atoms <= MAX_BFGS_ATOMS else 'lbfgs'
+    assert method in MINIMIZERS, "Unknown minimizer %s" % method
+    return MINIMIZERS[method](**kwargs)
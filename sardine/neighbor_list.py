@@ -0,0 +1,200 @@
+from numpy import triu_indices, array, lexsort, int64, unique, concatenate,\
+                  minimum, maximum, ones, asarray, searchsorted, setdiff1d,\
+                  union1d, array_equal
+from scipy.sparse import coo_matrix, triu
+from scipy.spatial import cKDTree
+
+
+def find_pairs(X, radius, box=None):
+    """
+    Pairs (i < j) of rows of `X` within `radius` of each other, sorted by
+    i and then j. With `box`, the side lengths of a periodic orthorhombic
+    box, distances are taken to the nearest image and `X` must lie inside
+    the box.
+    """
+    if box is None:
+        tree = cKDTree(X)
+    else:
+        tree = cKDTree(X, boxsize=box)
+    try:
+        pairs = tree.query_pairs(radius, output_type='ndarray')
+    except TypeError:
+        # older scipy only returns a set of (i, j) tuples
+        pairs = array(sorted(tree.query_pairs(radius)), dtype=int64)
+    pairs = pairs.reshape((-1, 2))
+    order = lexsort( (pairs[:,1], pairs[:,0]) )
+    return pairs[order,0], pairs[order,1]
+
+def get_pair_keys(I, J, num_atoms):
+    """
+    Sortable key i * num_atoms + j of each pair (i < j).
+    """
+    I = asarray(I, dtype=int64)
+    J = asarray(J, dtype=int64)
+    return minimum(I, J) * num_atoms + maximum(I, J)
+
+def create_pair_list(cutoff=None, skin=2.0, excluded_keys=None):
+    """
+    AllPairsList without a `cutoff`, otherwise a NeighborList.
+    """
+    if cutoff is None:
+        return AllPairsList(excluded_keys)
+    return NeighborList(cutoff, skin, excluded_keys)
+
+def remove_pairs(I, J, num_atoms, excluded_keys):
+    """
+    The pairs (I, J) whose keys are not in the sorted `excluded_keys`.
+    """
+    if excluded_keys is None or len(excluded_keys) == 0 or len(I) == 0:
+        return I, J
+    keys = get_pair_keys(I, J, num_atoms)
+    position = searchsorted(excluded_keys, keys)
+    position[position == len(excluded_keys)] = 0
+    keep = excluded_keys[position] != keys
+    return I[keep], J[keep]
+
+
+class ExclusionList(object):
+    """
+    Pairs of bonded atoms that the nonbonded terms leave out or scale.
+
+    Atoms one or two bonds apart (1-2 and 1-3 pairs) are excluded; atoms
+    three bonds apart are the 1-4 pairs. Each set is stored as a sorted
+    array of pair keys (see `get_pair_keys`).
+
+    Parameters
+    ----------
+    I, J : ndarray of int
+        0-indexed atoms of each bond.
+    num_atoms : int
+    """
+    def __init__(self, I, J, num_atoms):
+        super(ExclusionList, self).__init__()
+        self.num_atoms = num_atoms
+        A = coo_matrix( (ones(len(I), dtype=int64), (I, J)),
+                        shape=(num_atoms, num_atoms) ).tocsr()
+        A = ((A + A.T) > 0).astype(int64)
+        A2 = A * A
+        A3 = A2 * A
+        one_two = self.get_upper_keys(A)
+        one_three = setdiff1d(self.get_upper_keys(A2), one_two)
+        self.excluded_keys = union1d(one_two, one_three)
+        self.one_four_keys = setdiff1d(self.get_upper_keys(A3),
+                                       self.excluded_keys)
+
+    def get_upper_keys(self, A):
+        A = triu(A, 1).tocoo()
+        return unique(get_pair_keys(A.row, A.col, self.num_atoms))
+
+    def get_excluded_keys(self, include_one_four=False):
+        """
+        Keys of the pairs to leave out of the pair lists; with
+        `include_one_four` also the 1-4 pairs, when those are evaluated
+        separately with a scale factor.
+        """
+        if include_one_four:
+            return union1d(self.excluded_keys, self.one_four_keys)
+        return self.excluded_keys
+
+    def get_one_four_pairs(self):
+        return self.one_four_keys // self.num_atoms, \
+               self.one_four_keys % self.num_atoms
+
+
+class AllPairsList(object):
+    """
+    Every pair of atoms (i < j). Used when no cutoff is set.
+
+    The pair indices depend only on the number of atoms, so they are built
+    once and reused on every call. `X` may be a single (N, 3) frame or a
+    (num_frames, N, 3) stack. Pairs with keys in the sorted
+    `excluded_keys` are left out.
+    """
+    def __init__(self, excluded_keys=None):
+        super(AllPairsList, self).__init__()
+        self.excluded_keys = excluded_keys
+        self.num_atoms = None
+        self.I = None
+        self.J = None
+
+    def get_pairs(self, X):
+        num_atoms = X.shape[-2]
+        if num_atoms != self.num_atoms:
+            I, J = triu_indices(num_atoms, 1)
+            self.I, self.J = remove_pairs(I, J, num_atoms, self.excluded_keys)
+            self.num_atoms = num_atoms
+        return self.I, self.J
+
+
+class NeighborList(object):
+    """
+    Verlet neighbor list of the pairs (i < j) within `cutoff + skin`.
+
+    The list is built with a KD-tree and only rebuilt once some atom has
+    moved more than half the skin since the last build, so that no pair
+    can come within `cutoff` without being in the list.
+
+    Parameters
+    ----------
+    cutoff : float
+        Interaction cutoff in angstroms.
+    skin : float, optional
+        Extra buffer distance in angstroms.
+    excluded_keys : ndarray, optional
+        Sorted keys of pairs to leave out, e.g. from an ExclusionList.
+    """
+    def __init__(self, cutoff, skin=2.0, excluded_keys=None):
+        super(NeighborList, self).__init__()
+        self.cutoff = cutoff
+        self.skin = skin
+        self.excluded_keys = excluded_keys
+        self.X_ref = None
+        self.I = None
+        self.J = None
+        self.num_builds = 0
+        self.stack_ref = None
+        self.stack_pairs = None
+
+    def __len__(self):
+        if self.I is None:
+            return 0
+        return len(self.I)
+
+    def needs_update(self, X):
+        if self.X_ref is None or X.shape != self.X_ref.shape:
+            return True
+        dX = X - self.X_ref
+        max_displacement_sq = (dX * dX).sum(axis=1).max()
+        return max_displacement_sq > (0.5 * self.skin)**2
+
+    def update(self, X):
+        I, J = find_pairs(X, self.cutoff + self.skin)
+        self.I, self.J = remove_pairs(I, J, X.shape[0], self.excluded_keys)
+        self.X_ref = X.copy()
+        self.num_builds += 1
+
+    def get_pairs_in_frames(self, X):
+        """
+        Pairs within the cutoff in any frame of a (num_frames, N, 3) stack.
+        Built for each new stack and kept until the next, so the terms
+        sharing this list get the same pairs for it; the list kept for
+        single frames is left alone.
+        """
+        if self.stack_ref is not None and \
+           self.stack_ref.shape == X.shape and array_equal(self.stack_ref, X):
+            return self.stack_pairs
+        num_atoms = X.shape[1]
+        keys = [I * num_atoms + J for I, J in
+                (find_pairs(frame, self.cutoff) for frame in X)]
+        keys = unique(concatenate(keys + [array([], dtype=int64)]))
+        self.stack_pairs = remove_pairs(keys // num_atoms, keys % num_atoms,
+                                        num_atoms, self.excluded_keys)
+        self.stack_ref = X.copy()
+        return self.stack_pairs
+
+    def get_pairs(self, X):
+        if X.ndim == 3:
+            return self.get_pairs_in_frames(X)
+        if self.needs_update(X):
+            self.update(X)
+        return self.I, self.J
@@ -1,83 +1,287 @@
-from numpy import dot, argsort, linspace, concatenate, sqrt
-from scipy.linalg import eig
-from numdifftools import Hessian
+from numpy import argsort, linspace, concatenate, sqrt, newaxis,\
+                  array, asarray, ones, ascontiguousarray, empty, arange,\
+                  savez, load
+from scipy.linalg import eigh
+from scipy.sparse import issparse, diags
+from scipy.sparse.linalg import eigsh
 from .trajectory import Trajectory
 from .const import CM_CONVERSION_FACTOR
+from .util import load_npz_memmap
 
-def compute_hessian(energy_func, X):
-    """docstring for compute_hessian"""
+def compute_hessian(energy_func, X, jac=False):
+    """
+    Numerical Hessian of `energy_func` at `X`, computed with numdifftools.
+    If `jac` is True, `energy_func` returns `(energy, gradient)`, e.g. a
+    function from EnergyGradientFunctionFactory, and only the energy is
+    used.
+
+    This takes O(N^2) energy evaluations. A function from
+    `energy.HessianFunctionFactory` computes the Hessian analytically
+    and is much faster.
+    """
+    from numdifftools import Hessian
+    if jac:
+        energy_and_gradient_func = energy_func
+        energy_func = lambda X_vec: energy_and_gradient_func(X_vec)[0]
     h = Hessian(energy_func)
     return h(X.flatten())
 
 def compute_force_constant_matrix(H, M):
-    """docstring for compute_force_constant_matrix"""
-    return dot( dot(M, H), M )
-
-def compute_normal_modes(F, discard_trans_and_rot=True):
-    eig_vals, eig_vecs = eig(F)
-    eig_vals = eig_vals.real
-    inds = argsort(eig_vals)
-
-    if discard_trans_and_rot:
-        # option to remove translational and rotational modes
-        # there are six such modes for for a system with 3N coords
-        inds = inds[6:]
-
-    eig_vals = eig_vals[inds]
-    eig_vecs = eig_vecs[:,inds]
-    modes = NormalModes(eig_vals, eig_vecs)
+    """
+    Mass-weighted Hessian, M H M.
+
+    `M` may be the diagonal inverse square root mass matrix or just its
+    diagonal (`Universe.get_inv_sqrt_mass_vector`). Either way the rows
+    and columns of `H` are scaled by broadcasting instead of two dense
+    matrix products. If `H` is a scipy.sparse matrix the result stays
+    sparse.
+    """
+    if M.ndim == 2:
+        M = M.diagonal()
+    if issparse(H):
+        M = diags(M, 0)
+        return M.dot(H).dot(M).tocsr()
+    return H * M[:,newaxis] * M[newaxis,:]
+
+def compute_normal_modes(F, discard_trans_and_rot=True, num_modes=None,
+                         dtype=None):
+    """
+    Normal modes of the force constant matrix `F` from the symmetric
+    eigensolver, lowest frequency first.
+
+    Parameters
+    ----------
+    F : ndarray
+        Mass-weighted Hessian.
+    discard_trans_and_rot : bool, optional
+        Whether to skip the six translational and rotational modes.
+    num_modes : int, optional
+        Only compute this many modes (after any discarded ones) instead
+        of the full spectrum.
+    dtype : dtype, optional
+        Storage type of the eigenvectors; see NormalModes.
+    """
+    if issparse(F):
+        F = F.toarray()
+    # option to remove translational and rotational modes
+    # there are six such modes for for a system with 3N coords
+    first_mode = 6 if discard_trans_and_rot else 0
+    if num_modes is None:
+        eig_vals, eig_vecs = eigh(F)
+        eig_vals = eig_vals[first_mode:]
+        eig_vecs = eig_vecs[:,first_mode:]
+    else:
+        last_mode = min(first_mode + num_modes, F.shape[0]) - 1
+        eig_vals, eig_vecs = eigh(F, eigvals=(first_mode, last_mode))
+
+    modes = NormalModes(eig_vals, eig_vecs, dtype=dtype)
     return modes
 
-def generate_mode_trajectory(normal_modes, initial_coords, mode_number,
-                             peak_scale_factor=1.0, num_steps_per_peak=10):
+def compute_lowest_normal_modes(F, num_modes, sigma=-0.01,
+                                discard_trans_and_rot=True, dtype=None):
+    """
+    Compute only the `num_modes` lowest-frequency normal modes of a
+    (usually sparse) force constant matrix, using the shift-invert mode
+    of the sparse symmetric eigensolver.
+
+    Parameters
+    ----------
+    F : scipy.sparse matrix or ndarray
+        Mass-weighted Hessian.
+    num_modes : int
+        Number of modes to return.
+    sigma : float, optional
+        Shift for shift-invert. It must lie below the lowest eigenvalue
+        but not on it; the default suits F in the package's units
+        (kcal/mol/A^2/amu), where 0.01 corresponds to ~10 cm^-1.
+    discard_trans_and_rot : bool, optional
+        Whether to skip the six translational and rotational modes.
+    dtype : dtype, optional
+        Storage type of the eigenvectors; see NormalModes.
+    """
+    num_trans_rot = 6 if discard_trans_and_rot else 0
+    eig_vals, eig_vecs = eigsh(F, k=num_modes + num_trans_rot, sigma=sigma,
+                               which='LM')
+    inds = argsort(eig_vals)[num_trans_rot:]
+    modes = NormalModes(eig_vals[inds], eig_vecs[:,inds], dtype=dtype)
+    return modes
+
+def compute_mode_scale_factors(peak_scale_factor=1.0, num_steps_per_peak=10):
+    """
+    Scale factors for one period of a mode animation: 0 up to the peak,
+    back to 0, down to -peak and back to 0.
+    """
     zero_to_max = linspace(0.0, peak_scale_factor, num_steps_per_peak)
     max_to_zero = linspace(peak_scale_factor, 0.0, num_steps_per_peak)[1:]
     zero_to_min = linspace(0.0, -peak_scale_factor, num_steps_per_peak)[1:]
     min_to_zero = linspace(-peak_scale_factor, 0.0, num_steps_per_peak)[1:]
-    scale_factors = concatenate( [zero_to_max, max_to_zero, zero_to_min,
-                                  min_to_zero] )
+    return concatenate( [zero_to_max, max_to_zero, zero_to_min, min_to_zero] )
 
-    trajectory = Trajectory()
-    freq, amplitude = normal_modes.get_mode(mode_number)
-    assert amplitude.shape[1] == 3, "Cartesian mode amplitude should have" \
-                                    "three columns (xyz)."
+def generate_mode_trajectories(normal_modes, initial_coords, mode_numbers=None,
+                               peak_scale_factor=1.0, num_steps_per_peak=10):
+    """
+    Animate several modes at once.
 
-    for this_scale_factor in scale_factors:
-        new_coords = initial_coords * (1 + this_scale_factor * amplitude)
-        trajectory.add_frame(new_coords)
+    Parameters
+    ----------
+    normal_modes : NormalModes
+    initial_coords : ndarray
+        (N, 3) coordinates the modes are applied to.
+    mode_numbers : sequence of int, optional
+        Modes to animate; all modes by default.
+    peak_scale_factor : float or sequence of float, optional
+        Peak scale of the displacement, either shared by all modes or one
+        per mode.
+    num_steps_per_peak : int, optional
 
-    return trajectory
+    Returns
+    -------
+    coords : ndarray
+        (num_modes, num_frames, N, 3) coordinates, from one broadcast
+        expression.
+    """
+    if mode_numbers is None:
+        mode_numbers = range(len(normal_modes))
+    mode_numbers = asarray(mode_numbers, dtype=int)
+    amplitudes = normal_modes.get_amplitudes()[mode_numbers]
+    assert amplitudes.shape[-1] == 3, "Cartesian mode amplitude should have" \
+                                      "three columns (xyz)."
+    peak_scale_factors = asarray(peak_scale_factor, dtype=float) * \
+                         ones(len(mode_numbers))
+    scale_factors = peak_scale_factors[:,newaxis] * \
+                    compute_mode_scale_factors(1.0, num_steps_per_peak)
+    return initial_coords * \
+           (1 + scale_factors[:,:,newaxis,newaxis] * amplitudes[:,newaxis])
+
+def stream_mode_trajectories(normal_modes, initial_coords, create_writer,
+                             mode_numbers=None, peak_scale_factor=1.0,
+                             num_steps_per_peak=10):
+    """
+    Like `generate_mode_trajectories`, but each mode's frames are written
+    to `create_writer(mode_number)` (e.g. a PdbTrajectoryWriter), so only
+    one mode is held in memory at a time.
+    """
+    if mode_numbers is None:
+        mode_numbers = range(len(normal_modes))
+    peak_scale_factors = asarray(peak_scale_factor, dtype=float) * \
+                         ones(len(mode_numbers))
+    for mode_number, this_peak_scale_factor in zip(mode_numbers,
+                                                   peak_scale_factors):
+        coords = generate_mode_trajectories(
+                    normal_modes, initial_coords, [mode_number],
+                    this_peak_scale_factor, num_steps_per_peak)
+        writer = create_writer(mode_number)
+        try:
+            for frame_coords in coords[0]:
+                writer.write_frame(frame_coords)
+        finally:
+            writer.close()
+
+def generate_mode_trajectory(normal_modes, initial_coords, mode_number,
+                             peak_scale_factor=1.0, num_steps_per_peak=10):
+    coords = generate_mode_trajectories(normal_modes, initial_coords,
+                                        [mode_number], peak_scale_factor,
+                                        num_steps_per_peak)
+    return Trajectory.from_array(coords[0])
 
 
 class NormalModes(object):
-    """docstring for NormalModes"""
-    def __init__(self, eig_vals, eig_vecs, reshape_eig_vecs=True):
-        cm_freqs = sqrt(eig_vals) * CM_CONVERSION_FACTOR
-        self.frequencies = list(cm_freqs)
-        self.amplitudes = []
-        for i in xrange(eig_vecs.shape[1]):
-            this_eig_vec = eig_vecs[:,i]
-            if reshape_eig_vecs:
-                this_mode_amplitude = this_eig_vec.reshape((len(this_eig_vec)/3,3))
-            else:
-                this_mode_amplitude = this_eig_vec
-            self.amplitudes.append(this_mode_amplitude)
+    """
+    Normal modes stored as one eigenvalue vector and one contiguous
+    (num_modes, 3N) eigenvector array, mode-major so that each mode is a
+    contiguous row. Frequencies are computed once, as an array, and
+    per-mode amplitudes are views into the eigenvector array.
+
+    Parameters
+    ----------
+    eig_vals : ndarray
+        Eigenvalues of the force constant matrix, one per mode.
+    eig_vecs : ndarray
+        (3N, num_modes) eigenvectors, one per column, as returned by the
+        eigensolvers.
+    reshape_eig_vecs : bool, optional
+        Whether amplitudes are given as (N, 3) arrays instead of (3N,).
+    dtype : dtype, optional
+        Storage type of the eigenvectors, e.g. float32 to halve the
+        memory used by large mode sets.
+    """
+    def __init__(self, eig_vals, eig_vecs, reshape_eig_vecs=True, dtype=None):
+        self.eig_vals = asarray(eig_vals)
+        self.frequencies = sqrt(self.eig_vals) * CM_CONVERSION_FACTOR
+        self.mode_array = ascontiguousarray(asarray(eig_vecs).T, dtype=dtype)
+        self.reshape_eig_vecs = reshape_eig_vecs
+
+    @classmethod
+    def from_mode_array(cls, eig_vals, mode_array, reshape_eig_vecs=True):
+        """
+        NormalModes over an existing (num_modes, 3N) array, e.g. a memmap,
+        without copying it.
+        """
+        normal_modes = cls.__new__(cls)
+        normal_modes.eig_vals = asarray(eig_vals)
+        normal_modes.frequencies = sqrt(normal_modes.eig_vals) * \
+                                   CM_CONVERSION_FACTOR
+        normal_modes.mode_array = mode_array
+        normal_modes.reshape_eig_vecs = reshape_eig_vecs
+        return normal_modes
 
     def __str__(self):
-        return "\n%s\n%s" % (self.frequencies, self.amplitudes)
+        return "\n%s\n%s" % (self.frequencies, self.get_amplitudes())
+
+    def __len__(self):
+        return len(self.eig_vals)
 
     def get_mode(self, mode_num):
-        return self.frequencies[mode_num], self.amplitudes[mode_num]
+        return self.frequencies[mode_num], self.get_amplitudes()[mode_num]
 
     def get_frequencies(self):
         return self.frequencies
 
+    def get_eigenvalues(self):
+        return self.eig_vals
+
+    def get_eigenvectors(self):
+        """
+        (num_modes, 3N) eigenvector array, one mode per row.
+        """
+        return self.mode_array
+
     def get_amplitudes(self):
-        return self.amplitudes
+        """
+        Amplitudes of all modes as one array, (num_modes, N, 3) or
+        (num_modes, 3N); indexing it gives a view of a single mode.
+        """
+        if self.reshape_eig_vecs:
+            return self.mode_array.reshape((len(self), -1, 3))
+        return self.mode_array
 
     def freq_to_str(self):
-        freqs = self.get_frequencies()
-        freq_str = ""
-        for i, frequency in enumerate(freqs):
-            freq_str += "%d\t%.1f\n" % (i, frequency)
-        return freq_str
+        num_modes = len(self)
+        lines = empty((num_modes, 2), dtype=object)
+        lines[:,0] = arange(num_modes)
+        lines[:,1] = self.frequencies
+        return ("%d\t%.1f\n" * num_modes) % tuple(lines.ravel())
+
+def save_normal_modes(filename, normal_modes):
+    """
+    Write normal modes to an uncompressed .npz file, which
+    `load_normal_modes` can map instead of read.
+    """
+    savez(filename, eig_vals=normal_modes.get_eigenvalues(),
+          mode_array=normal_modes.get_eigenvectors(),
+          reshape_eig_vecs=array(normal_modes.reshape_eig_vecs))
+
+def load_normal_modes(filename, mmap_mode=None):
+    """
+    Read normal modes saved with `save_normal_modes`. With `mmap_mode`
+    (e.g. 'r') the eigenvector array is memory-mapped from the file.
+    """
+    if mmap_mode is None:
+        with load(filename) as stored:
+            return NormalModes.from_mode_array(
+                        stored['eig_vals'], stored['mode_array'],
+                        bool(stored['reshape_eig_vecs']))
+    stored = load_npz_memmap(filename, mmap_mode)
+    return NormalModes.from_mode_array(
+                array(stored['eig_vals']), stored['mode_array'],
+                bool(stored['reshape_eig_vecs']))
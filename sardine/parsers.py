@@ -1,7 +1,18 @@
+import re
+import mmap
+from numpy import array, zeros, empty
 from .atom import AtomFactory
-from .bonded_terms import BondFactory, AngleFactory
+from .bonded_terms import BondFactory, AngleFactory, TorsionFactory
 from .util import deg2rad
 
+# number of fields after the record name of each .sf record type
+SF_RECORD_FIELDS = {'BOND': 4, 'ANGLE': 5, 'TORSION': 7, 'IMPROPER': 6,
+                    'VDW': 2}
+
+# whole ATOM lines of a pdb file
+ATOM_RECORD_PATTERN = re.compile(r'^[ \t]*ATOM[ \t].*$', re.MULTILINE)
+NUM_PDB_FIELDS = 14
+
 class PdbParser(object):
     """
     Expected format
@@ -15,9 +26,9 @@ class PdbParser(object):
 
     def iter_atoms_in_pdb_file(self, filename):
         with open(filename, 'r') as f:
-            lines = [line.split() for line in f.readlines()]
-            for L in lines:
-                if L[0] == 'ATOM':
+            for line in f:
+                L = line.split()
+                if L and L[0] == 'ATOM':
                     serial_num = int(L[1])
                     atom_name = L[2]
                     res_name = L[3]
@@ -40,6 +51,82 @@ class PdbParser(object):
                 else:
                     continue
 
+    def read_pdb_columns(self, filename, use_mmap=False):
+        """
+        Read all ATOM records of a pdb file at once into column arrays.
+
+        The ATOM lines are picked out of the whole file with one regular
+        expression and split in a single call, then converted column by
+        column, so there is no per-atom Python work.
+
+        Parameters
+        ----------
+        filename : str
+        use_mmap : bool, optional
+            Scan a memory map of the file instead of reading it into a
+            string first.
+
+        Returns
+        -------
+        columns : dict
+            'coords' as an (N, 3) array plus 'mass', 'charge', 'radius',
+            'serial_num', 'res_num', 'atom_name', 'res_name' and
+            'chain_id' arrays, as taken by `UniverseFactory.add_columns`.
+        """
+        with open(filename, 'rb') as f:
+            if use_mmap:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    records = ATOM_RECORD_PATTERN.findall(data)
+                finally:
+                    data.close()
+            else:
+                records = ATOM_RECORD_PATTERN.findall(f.read())
+
+        num_records = len(records)
+        tokens = ' '.join(records).split()
+        fields = None
+        if num_records and len(tokens) % num_records == 0:
+            fields = array(tokens).reshape((num_records, -1))
+            if fields.shape[1] < NUM_PDB_FIELDS or \
+               not (fields[:,0] == 'ATOM').all():
+                fields = None
+        if fields is None:
+            # records don't all have the same number of fields
+            fields = array([r.split()[:NUM_PDB_FIELDS] for r in records])
+        fields = fields.reshape((num_records, -1))
+
+        columns = {}
+        if num_records == 0:
+            columns['coords'] = zeros((0, 3))
+            for name in ('mass', 'charge', 'radius'):
+                columns[name] = zeros(0)
+            for name in ('serial_num', 'res_num'):
+                columns[name] = zeros(0, dtype=int)
+            for name in ('atom_name', 'res_name', 'chain_id'):
+                columns[name] = empty(0, dtype=str)
+            return columns
+
+        columns['serial_num'] = fields[:,1].astype(int)
+        columns['atom_name'] = fields[:,2].copy()
+        columns['res_name'] = fields[:,3].copy()
+        columns['chain_id'] = fields[:,4].copy()
+        columns['res_num'] = fields[:,5].astype(int)
+        columns['coords'] = fields[:,6:9].astype(float)
+        columns['mass'] = fields[:,11].astype(float)
+        columns['radius'] = fields[:,12].astype(float)
+        columns['charge'] = fields[:,13].astype(float)
+        return columns
+
+
+def pack_records(records, num_fields):
+    """
+    Convert a list of token lists into a (num_records, num_fields) float
+    array.
+    """
+    packed = array([r[:num_fields] for r in records], dtype=float)
+    return packed.reshape((-1, num_fields))
+
 
 class StructureParser(object):
     """docstring for StructureParser"""
@@ -47,7 +134,7 @@ class StructureParser(object):
         super(StructureParser, self).__init__()
         self.bond_factory = BondFactory()
         self.angle_factory = AngleFactory()
-        # self.torsion_factory = TorsionFactory()
+        self.torsion_factory = TorsionFactory()
 
     def iter_bonds_in_sf_file(self, filename):
         with open(filename, 'r') as f:
@@ -86,13 +173,96 @@ class StructureParser(object):
                 else:
                     continue
 
+    def iter_torsions_in_sf_file(self, filename):
+        """
+        TORSION records: four serial numbers, force constant, periodicity
+        and phase in degrees.
+        """
+        with open(filename, 'r') as f:
+            for L in (line.split() for line in f):
+                if L and L[0] == 'TORSION':
+                    yield self.torsion_factory.create_torsion(
+                            int(L[1]), int(L[2]), int(L[3]), int(L[4]),
+                            force_const=float(L[5]),
+                            periodicity=float(L[6]),
+                            phase=deg2rad( float(L[7]) ))
+
+    def iter_impropers_in_sf_file(self, filename):
+        """
+        IMPROPER records: four serial numbers, force constant and
+        equilibrium improper angle in degrees.
+        """
+        with open(filename, 'r') as f:
+            for L in (line.split() for line in f):
+                if L and L[0] == 'IMPROPER':
+                    yield self.torsion_factory.create_improper(
+                            int(L[1]), int(L[2]), int(L[3]), int(L[4]),
+                            force_const=float(L[5]),
+                            psi_0=deg2rad( float(L[6]) ))
+
     def get_first_vdw_in_sf_file(self, filename):
         with open(filename, 'r') as f:
             lines = [line.split() for line in f.readlines()]
             for L in lines:
-                if L[0] == 'VDW':
+                if L[0] == 'VDW' and len(L) == 3:
                     well_distance = float(L[1])
                     well_depth = float(L[2])
                     return (well_distance, well_depth)
                 else:
                     continue
+
+    def read_sf_file(self, filename):
+        """
+        Read all records of a structure file in a single pass and pack them
+        into arrays.
+
+        Returns
+        -------
+        structure : dict of ndarray
+            'bond_serial_nums' (num_bonds, 2), 'bond_force_consts' and
+            'bond_r_0s'; 'angle_serial_nums' (num_angles, 3),
+            'angle_force_consts' and 'angle_theta_0s' (radians);
+            'torsion_serial_nums' (num_torsions, 4),
+            'torsion_force_consts', 'torsion_periodicities' and
+            'torsion_phases' (radians); 'improper_serial_nums'
+            (num_impropers, 4), 'improper_force_consts' and
+            'improper_psi_0s' (radians); 'vdw_params' (num_vdw, 2) of
+            (well distance, well depth) of the untyped VDW records in file
+            order; and 'vdw_type_names' and 'vdw_type_params'
+            (num_types, 2) of the typed records, `VDW type distance depth`.
+        """
+        records = dict( (name, []) for name in SF_RECORD_FIELDS )
+        with open(filename, 'r') as f:
+            for line in f:
+                L = line.split()
+                if L and L[0] in records:
+                    records[L[0]].append(L[1:])
+
+        bonds = pack_records(records['BOND'], SF_RECORD_FIELDS['BOND'])
+        angles = pack_records(records['ANGLE'], SF_RECORD_FIELDS['ANGLE'])
+        structure = {}
+        structure['bond_serial_nums'] = bonds[:,0:2].astype(int)
+        structure['bond_force_consts'] = bonds[:,2]
+        structure['bond_r_0s'] = bonds[:,3]
+        structure['angle_serial_nums'] = angles[:,0:3].astype(int)
+        structure['angle_force_consts'] = angles[:,3]
+        structure['angle_theta_0s'] = deg2rad(angles[:,4])
+        torsions = pack_records(records['TORSION'], SF_RECORD_FIELDS['TORSION'])
+        structure['torsion_serial_nums'] = torsions[:,0:4].astype(int)
+        structure['torsion_force_consts'] = torsions[:,4]
+        structure['torsion_periodicities'] = torsions[:,5]
+        structure['torsion_phases'] = deg2rad(torsions[:,6])
+        impropers = pack_records(records['IMPROPER'],
+                                 SF_RECORD_FIELDS['IMPROPER'])
+        structure['improper_serial_nums'] = impropers[:,0:4].astype(int)
+        structure['improper_force_consts'] = impropers[:,4]
+        structure['improper_psi_0s'] = deg2rad(impropers[:,5])
+        untyped_vdw = [r for r in records['VDW'] if len(r) == 2]
+        typed_vdw = [r for r in records['VDW'] if len(r) > 2]
+        structure['vdw_params'] = pack_records(untyped_vdw,
+                                               SF_RECORD_FIELDS['VDW'])
+        structure['vdw_type_names'] = array([r[0] for r in typed_vdw],
+                                            dtype=str)
+        structure['vdw_type_params'] = pack_records([r[1:] for r in typed_vdw],
+                                                    SF_RECORD_FIELDS['VDW'])
+        return structure
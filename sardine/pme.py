@@ -0,0 +1,138 @@
+"""
+Reciprocal-space part of smooth particle-mesh Ewald (Essmann et al.,
+J. Chem. Phys. 103, 8577 (1995)) for orthorhombic periodic boxes.
+
+Charges are spread onto a regular grid with cardinal B-splines, the grid
+is convolved with the Ewald influence function by FFT, and the energy and
+its gradient are read back off the grid through the same splines.
+"""
+
+from numpy import array, zeros, arange, floor, exp, pi, cos, sin, ceil,\
+                  bincount, einsum, newaxis, outer
+from numpy.fft import fftn, ifftn, fftfreq
+
+# smallest FFT grid, in points per dimension
+MIN_GRID_POINTS = 8
+
+
+def compute_bspline_weights(w, order):
+    """
+    Cardinal B-spline weights of the `order` grid points around each
+    fractional grid offset `w` (0 <= w < 1), and their derivatives with
+    respect to `w`. Column k belongs to grid point floor(u) - order + 1 + k
+    of a grid coordinate u.
+
+    Returns
+    -------
+    M, dM : ndarray, shape (len(w), order)
+    """
+    assert order >= 3, "B-spline order must be at least 3"
+    M = zeros((len(w), order))
+    dM = zeros((len(w), order))
+    M[:,0] = 1 - w
+    M[:,1] = w
+    for j in xrange(3, order):
+        div = 1.0 / (j - 1)
+        M[:,j-1] = div * w * M[:,j-2]
+        for k in xrange(1, j - 1):
+            M[:,j-k-1] = div * ((w + k) * M[:,j-k-2] +
+                                (j - k - w) * M[:,j-k-1])
+        M[:,0] = div * (1 - w) * M[:,0]
+    # derivatives come from the order - 1 weights
+    dM[:,0] = -M[:,0]
+    dM[:,1:] = M[:,:-1] - M[:,1:]
+    div = 1.0 / (order - 1)
+    M[:,order-1] = div * w * M[:,order-2]
+    for k in xrange(1, order - 1):
+        M[:,order-k-1] = div * ((w + k) * M[:,order-k-2] +
+                                (order - k - w) * M[:,order-k-1])
+    M[:,0] = div * (1 - w) * M[:,0]
+    return M, dM
+
+def compute_bspline_moduli(num_points, order):
+    """
+    |b(m)|^-2 of the Euler exponential splines along one grid dimension.
+    """
+    M, dM = compute_bspline_weights(array([0.0]), order)
+    arg = 2 * pi * outer(arange(num_points), arange(order)) / num_points
+    moduli = (M[0] * cos(arg)).sum(axis=1)**2 + \
+             (M[0] * sin(arg)).sum(axis=1)**2
+    # odd orders vanish at the Nyquist point; interpolate over it
+    for m in xrange(num_points):
+        if moduli[m] < 1e-7:
+            moduli[m] = 0.5 * (moduli[m-1] + moduli[(m+1) % num_points])
+    return moduli
+
+def get_grid_shape(box, grid_spacing, order):
+    """
+    Grid points per dimension for at most `grid_spacing` angstroms between
+    points.
+    """
+    return tuple(max(int(ceil(L / grid_spacing)), MIN_GRID_POINTS, 2 * order)
+                 for L in box)
+
+def create_reciprocal_func(box, grid_shape, alpha, order=4):
+    """
+    Returns a function of coordinates `X` (N, 3), inside the box, and
+    charges `q` that computes the reciprocal-space Ewald energy and its
+    gradient, both in units of charge^2 / angstrom.
+
+    Parameters
+    ----------
+    box : sequence of float
+        Side lengths of the periodic box in angstroms.
+    grid_shape : tuple of int
+        Grid points along each side.
+    alpha : float
+        Ewald splitting parameter in 1 / angstrom.
+    order : int, optional
+        B-spline interpolation order.
+    """
+    box = array(box, dtype=float)
+    K = array(grid_shape)
+    volume = box.prod()
+    num_grid_points = K.prod()
+
+    # influence function theta(m) = B(m) exp(-pi^2 m^2 / alpha^2) /
+    # (pi V m^2), zero at m = 0
+    m_x, m_y, m_z = [fftfreq(K[d]) * K[d] / box[d] for d in xrange(3)]
+    m_sq = m_x[:,newaxis,newaxis]**2 + m_y[newaxis,:,newaxis]**2 + \
+           m_z[newaxis,newaxis,:]**2
+    m_sq[0,0,0] = 1.0
+    moduli = [compute_bspline_moduli(K[d], order) for d in xrange(3)]
+    theta = exp(-pi * pi * m_sq / (alpha * alpha)) / (pi * volume * m_sq) / \
+            (moduli[0][:,newaxis,newaxis] * moduli[1][newaxis,:,newaxis] *
+             moduli[2][newaxis,newaxis,:])
+    theta[0,0,0] = 0.0
+    offsets = arange(order) - order + 1
+
+    def reciprocal_func(X, q):
+        u = X * (K / box)
+        u_floor = floor(u)
+        w = u - u_floor
+        weights = [compute_bspline_weights(w[:,d], order) for d in xrange(3)]
+        Mx, My, Mz = [weights[d][0] for d in xrange(3)]
+        dMx, dMy, dMz = [weights[d][1] for d in xrange(3)]
+        ix, iy, iz = [(u_floor[:,d].astype(int)[:,newaxis] + offsets) % K[d]
+                      for d in xrange(3)]
+        grid_index = ((ix[:,:,newaxis,newaxis] * K[1] +
+                       iy[:,newaxis,:,newaxis]) * K[2] +
+                      iz[:,newaxis,newaxis,:])
+
+        spread = q[:,newaxis,newaxis,newaxis] * \
+                 einsum('np,nq,nr->npqr', Mx, My, Mz)
+        Q = bincount(grid_index.ravel(), weights=spread.ravel(),
+                     minlength=num_grid_points).reshape(K)
+        FQ = fftn(Q)
+        E = 0.5 * (theta * (FQ.real**2 + FQ.imag**2)).sum()
+
+        # dE/dQ on the grid
+        dE_dQ = ifftn(theta * FQ).real * num_grid_points
+        dE_dQ_atoms = dE_dQ.ravel()[grid_index]
+        G = zeros(X.shape)
+        G[:,0] = einsum('np,nq,nr,npqr->n', dMx, My, Mz, dE_dQ_atoms)
+        G[:,1] = einsum('np,nq,nr,npqr->n', Mx, dMy, Mz, dE_dQ_atoms)
+        G[:,2] = einsum('np,nq,nr,npqr->n', Mx, My, dMz, dE_dQ_atoms)
+        G *= q[:,newaxis] * (K / box)
+        return E, G
+    return reciprocal_func
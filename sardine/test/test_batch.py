@@ -0,0 +1,65 @@
+from unittest import TestCase
+from numpy import allclose, array
+from numpy.random import RandomState
+from ..universe import UniverseFactory
+from ..energy import BondEnergyFactory, AngleEnergyFactory,\
+                     EnergyGradientFunctionFactory
+from ..minimize import BFGSMinimizer, LBFGSMinimizer
+from ..batch import minimize_conformers
+
+PDB_FILENAME = "sardine/test/test_data/C2H6_ideal_trans_min_final.pdb"
+SF_FILENAME = "sardine/test/test_data/C2H6.sf"
+
+
+class TestBatchMinimization(TestCase):
+    def setUp(self):
+        uf = UniverseFactory()
+        uf.load_atoms_from_file(PDB_FILENAME)
+        universe = uf.create_universe()
+        self.num_atoms = len(universe)
+
+        bond_energy_factory = BondEnergyFactory()
+        bond_energy_factory.load_bonds_from_file(SF_FILENAME)
+        angle_energy_factory = AngleEnergyFactory()
+        angle_energy_factory.load_angles_from_file(SF_FILENAME)
+        egff = EnergyGradientFunctionFactory()
+        egff.add_energy_gradient_term(
+            'bonds', bond_energy_factory.create_energy_and_gradient_func())
+        egff.add_energy_gradient_term(
+            'angles', angle_energy_factory.create_energy_and_gradient_func())
+        self.energy_and_gradient_func = egff.create_energy_and_gradient_func(
+                                            ['bonds', 'angles'],
+                                            num_atoms=self.num_atoms)
+        random_state = RandomState(0)
+        self.coords = array([universe.get_coords() +
+                             random_state.uniform(-0.1, 0.1, (self.num_atoms, 3))
+                             for i in xrange(5)])
+
+    def test_parallel_results_match_serial_loop(self):
+        minimizer = LBFGSMinimizer(gtol=1e-5)
+        X_min, energies, statuses = minimize_conformers(
+                                        self.energy_and_gradient_func,
+                                        self.coords, minimizer=minimizer,
+                                        num_processes=2)
+        self.assertEqual( X_min.shape, self.coords.shape )
+        self.assertEqual( len(statuses), len(self.coords) )
+        for i, X in enumerate(self.coords):
+            X_expected, energy_expected = minimizer.run_minimization(
+                                            self.energy_and_gradient_func,
+                                            None, X.flatten(), self.num_atoms,
+                                            jac=True)
+            self.assertTrue( allclose(X_min[i].flatten(), X_expected) )
+            self.assertTrue( allclose(energies[i], energy_expected) )
+            self.assertTrue( statuses[i].converged )
+            self.assertTrue( allclose(statuses[i].energy, energies[i]) )
+
+    def test_single_process(self):
+        X_min, energies, statuses = minimize_conformers(
+                                        self.energy_and_gradient_func,
+                                        self.coords[:2], num_processes=1)
+        X_parallel, energies_parallel, statuses_parallel = \
+            minimize_conformers(self.energy_and_gradient_func,
+                                self.coords[:2], minimizer=BFGSMinimizer(),
+                                num_processes=2)
+        self.assertTrue( allclose(X_min, X_parallel) )
+        self.assertTrue( allclose(energies, energies_parallel) )
@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from numpy import allclose, array_equal
+from ..cache import read_with_cache, load_cached_arrays, get_cache_filename
+from ..parsers import PdbParser, StructureParser
+from ..universe import UniverseFactory
+from ..energy import BondEnergyFactory, AngleEnergyFactory
+
+PDB_FILENAME = "sardine/test/test_data/C2H6_ideal_trans_min_final.pdb"
+SF_FILENAME = "sardine/test/test_data/C2H6.sf"
+
+
+class TestTopologyCache(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pdb_filename = os.path.join(self.tmp_dir, "C2H6.pdb")
+        self.sf_filename = os.path.join(self.tmp_dir, "C2H6.sf")
+        shutil.copy(PDB_FILENAME, self.pdb_filename)
+        shutil.copy(SF_FILENAME, self.sf_filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_cached_structure_matches_parsed(self):
+        read_func = StructureParser().read_sf_file
+        parsed = read_func(self.sf_filename)
+        first = read_with_cache(self.sf_filename, read_func)
+        self.assertTrue( os.path.exists(get_cache_filename(self.sf_filename)) )
+        cached = load_cached_arrays(self.sf_filename)
+        self.assertEqual( sorted(cached.keys()), sorted(parsed.keys()) )
+        for name in parsed:
+            self.assertEqual( cached[name].shape, parsed[name].shape )
+            self.assertTrue( array_equal(cached[name], parsed[name]) )
+            self.assertTrue( array_equal(first[name], parsed[name]) )
+
+    def test_stale_cache_is_ignored(self):
+        read_func = PdbParser().read_pdb_columns
+        read_with_cache(self.pdb_filename, read_func)
+        self.assertTrue( load_cached_arrays(self.pdb_filename) is not None )
+        with open(self.pdb_filename, 'a') as f:
+            f.write("END\n")
+        self.assertTrue( load_cached_arrays(self.pdb_filename) is None )
+
+    def test_factories_load_from_cache(self):
+        columns = PdbParser().read_pdb_columns(self.pdb_filename)
+        for i in xrange(2):
+            uf = UniverseFactory()
+            uf.load_atoms_from_file(self.pdb_filename, use_cache=True)
+            universe = uf.create_universe()
+            bond_factory = BondEnergyFactory()
+            bond_factory.load_bonds_from_file(self.sf_filename, use_cache=True)
+            angle_factory = AngleEnergyFactory()
+            angle_factory.load_angles_from_file(self.sf_filename,
+                                                use_cache=True)
+            self.assertEqual( len(universe), 8 )
+            self.assertEqual( list(universe.atom_name_array),
+                              list(columns['atom_name']) )
+            self.assertTrue( allclose(universe.get_coords(),
+                                      columns['coords']) )
+            self.assertEqual( len(bond_factory), 7 )
+            self.assertEqual( len(angle_factory), 12 )
+
+    def test_cache_dir(self):
+        cache_dir = os.path.join(self.tmp_dir, "compiled")
+        os.mkdir(cache_dir)
+        read_with_cache(self.sf_filename, StructureParser().read_sf_file,
+                        cache_dir)
+        self.assertTrue( os.path.exists(
+            get_cache_filename(self.sf_filename, cache_dir)) )
+        self.assertFalse( os.path.exists(get_cache_filename(self.sf_filename)) )
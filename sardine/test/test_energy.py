@@ -1,8 +1,17 @@
 from unittest import TestCase
-from numpy import zeros, allclose, cos, sin, pi
-from ..energy import BondEnergyFactory, AngleEnergyFactory, VDWEnergyFactory
-from ..bonded_terms import BondFactory, AngleFactory
+from itertools import product
+from numpy import zeros, allclose, cos, sin, pi, array, zeros_like, newaxis,\
+                  sqrt, outer, exp, dot, diag_indices, inf, float32, float64
+from scipy.special import erfc
+from numpy.random import RandomState
+from ..universe import UniverseFactory
+from ..energy import BondEnergyFactory, AngleEnergyFactory, VDWEnergyFactory,\
+                     EnergyFunctionFactory, GradientFunctionFactory,\
+                     EnergyGradientFunctionFactory, ElectrostaticEnergyFactory,\
+                     TorsionEnergyFactory, ImproperEnergyFactory
+from ..bonded_terms import BondFactory, AngleFactory, TorsionFactory
 from ..util import deg2rad
+from ..const import COULOMB_CONSTANT
 
 class TestBondEnergy(TestCase):
     def setUp(self):
@@ -55,6 +64,40 @@ class TestAngleEnergy(TestCase):
                          "%.2f\t%.2f" % (E, self.expected_E) )
 
 
+class TestTorsionEnergy(TestCase):
+    def setUp(self):
+        # dihedral of 60 degrees about the x axis
+        X = zeros([4,3])
+        X[0,:] = (0.0, 1.0, 0.0)
+        X[2,:] = (1.5, 0.0, 0.0)
+        X[3,:] = (1.5, cos(pi/3), sin(pi/3))
+        self.X = X
+        tf = TorsionFactory()
+        self.torsion_energy = TorsionEnergyFactory()
+        self.torsion_energy.add_torsion(
+            tf.create_torsion(1, 2, 3, 4, 1.4, 1, 0.0) )
+        self.torsion_energy.add_torsion(
+            tf.create_torsion(1, 2, 3, 4, 0.5, 3, deg2rad(90.0)) )
+        self.improper_energy = ImproperEnergyFactory()
+        self.improper_energy.add_improper(
+            tf.create_improper(1, 2, 3, 4, 10.0, deg2rad(-170.0)) )
+
+    def test_computes_correct_energy(self):
+        E = self.torsion_energy.create_energy_func()(self.X, None)
+        expected_E = 1.4 * (1 + cos(pi/3)) + 0.5 * (1 + cos(pi - pi/2))
+        self.assertTrue( allclose(E, expected_E),
+                         "%.2f\t%.2f" % (E, expected_E) )
+
+    def test_improper_difference_wraps_around(self):
+        # +/-60 degrees is 130 degrees away from -170, not 230
+        E = self.improper_energy.create_energy_func()(self.X, None)
+        X = self.X.copy()
+        X[3,2] *= -1
+        E_mirror = self.improper_energy.create_energy_func()(X, None)
+        self.assertTrue( allclose([E, E_mirror],
+                                  0.5 * 10.0 * deg2rad([130.0, 110.0])**2) )
+
+
 class TestVDWEnergy(TestCase):
     def setUp(self):
         well_distance = 2.6 # angstroms
@@ -80,4 +123,264 @@ class TestVDWEnergy(TestCase):
         E = self.vdw_energy_func(self.X, self.D)
         self.assertTrue( allclose(E, self.expected_E),
                          "%.2f\t%.2f" % (E, self.expected_E) )
-  
\ No newline at end of file
+  
+
+class TestTypedVDWEnergy(TestCase):
+    def setUp(self):
+        X = zeros([3,3])
+        X[1,0] = 3.1
+        X[2,:] = (0.4, 2.9, 0.3)
+        self.X = X
+        self.vdw_energy = VDWEnergyFactory()
+        self.vdw_energy.set_type_params([3.4, 2.4], [0.1, 0.02], ['C', 'H'])
+        self.vdw_energy.set_atom_types([0, 1, 1])
+
+    def compute_expected_energy(self, combine_distances):
+        R = [3.4, 2.4, 2.4]
+        eps = [0.1, 0.02, 0.02]
+        E = 0.0
+        for i, j in ((0, 1), (0, 2), (1, 2)):
+            r = sqrt(((self.X[i] - self.X[j])**2).sum())
+            sr6 = (combine_distances(R[i], R[j]) / r)**6
+            E += sqrt(eps[i] * eps[j]) * (sr6 * sr6 - 2 * sr6)
+        return E
+
+    def test_lorentz_berthelot_energy(self):
+        E = self.vdw_energy.create_energy_func()(self.X, None)
+        expected_E = self.compute_expected_energy(lambda a, b: 0.5 * (a + b))
+        self.assertTrue( allclose(E, expected_E),
+                         "%.4f\t%.4f" % (E, expected_E) )
+
+    def test_geometric_energy(self):
+        self.vdw_energy.set_combining_rule('geometric')
+        E = self.vdw_energy.create_energy_func()(self.X, None)
+        expected_E = self.compute_expected_energy(lambda a, b: sqrt(a * b))
+        self.assertTrue( allclose(E, expected_E),
+                         "%.4f\t%.4f" % (E, expected_E) )
+
+    def test_single_type_matches_global_parameters(self):
+        global_vdw_energy = VDWEnergyFactory()
+        global_vdw_energy.set_cutoff(3.0)
+        E_global = global_vdw_energy.create_energy_and_gradient_func()(self.X)
+        self.vdw_energy.set_cutoff(3.0)
+        self.vdw_energy.set_type_params([2.6], [0.1])
+        self.vdw_energy.set_atom_types([0, 0, 0])
+        E_typed = self.vdw_energy.create_energy_and_gradient_func()(self.X)
+        self.assertTrue( allclose(E_typed[0], E_global[0]) )
+        self.assertTrue( allclose(E_typed[1], E_global[1]) )
+
+    def test_types_from_atom_names(self):
+        uf = UniverseFactory()
+        uf.load_atoms_from_file(
+            "sardine/test/test_data/C2H6_ideal_trans_min_final.pdb")
+        self.vdw_energy.load_atom_types_from_universe(uf.create_universe())
+        self.assertEqual( self.vdw_energy.atom_types.tolist(),
+                          [0, 0, 1, 1, 1, 1, 1, 1] )
+
+
+class TestElectrostaticEnergy(TestCase):
+    def setUp(self):
+        random_state = RandomState(1)
+        self.box = array([10.0, 11.0, 12.0])
+        self.X = random_state.uniform(0.0, 1.0, (8, 3)) * self.box
+        charges = random_state.uniform(-1.0, 1.0, 8)
+        self.charges = charges - charges.mean()
+        self.electrostatic_energy = ElectrostaticEnergyFactory()
+        self.electrostatic_energy.set_charges(self.charges)
+
+    def compute_ewald_sum(self, alpha, num_images=2, num_waves=10):
+        """
+        Ewald energy summed directly over lattice images and wave vectors.
+        """
+        X, q, box = self.X, self.charges, self.box
+        E = 0.0
+        images = range(-num_images, num_images + 1)
+        for n in product(images, images, images):
+            dX = X[newaxis,:,:] - X[:,newaxis,:] + array(n) * box
+            r = sqrt((dX * dX).sum(axis=2))
+            if n == (0, 0, 0):
+                r[diag_indices(len(X))] = inf
+            E += 0.5 * (outer(q, q) * erfc(alpha * r) / r).sum()
+        waves = range(-num_waves, num_waves + 1)
+        for m in product(waves, waves, waves):
+            if m == (0, 0, 0):
+                continue
+            m = array(m) / box
+            m_sq = dot(m, m)
+            S = (q * exp(2j * pi * dot(X, m))).sum()
+            E += exp(-pi * pi * m_sq / (alpha * alpha)) / m_sq * \
+                 abs(S)**2 / (2 * pi * box.prod())
+        E -= alpha / sqrt(pi) * (q * q).sum()
+        return COULOMB_CONSTANT * E
+
+    def assert_gradient_matches_energy(self, step=1e-6):
+        energy_func = self.electrostatic_energy.create_energy_func()
+        gradient_func = self.electrostatic_energy.create_gradient_func()
+        G = gradient_func(self.X, None)
+        expected_G = zeros_like(self.X)
+        for i in xrange(len(self.X)):
+            for p in xrange(3):
+                X = self.X.copy()
+                X[i,p] += step
+                E_plus = energy_func(X, None)
+                X[i,p] -= 2 * step
+                E_minus = energy_func(X, None)
+                expected_G[i,p] = (E_plus - E_minus) / (2 * step)
+        self.assertTrue( allclose(G, expected_G, rtol=1e-5, atol=1e-5),
+                         "\n%s\n%s" % (G, expected_G) )
+
+    def test_computes_correct_energy(self):
+        self.electrostatic_energy.set_charges([0.5, -0.5])
+        X = zeros([2,3])
+        X[1,0] = 2.0
+        energy_func = self.electrostatic_energy.create_energy_func()
+        expected_E = COULOMB_CONSTANT * -0.25 / 2.0
+        E = energy_func(X, None)
+        self.assertTrue( allclose(E, expected_E),
+                         "%.2f\t%.2f" % (E, expected_E) )
+
+    def test_cutoff_energy_vanishes_at_cutoff(self):
+        self.electrostatic_energy.set_charges([0.5, -0.5])
+        X = zeros([2,3])
+        for method in ('shift', 'reaction_field'):
+            self.electrostatic_energy.set_cutoff(5.0, method=method)
+            energy_func = self.electrostatic_energy.create_energy_func()
+            X[1,0] = 5.0 - 1e-6
+            self.assertTrue( abs(energy_func(X, None)) < 1e-4 )
+            X[1,0] = 6.0
+            self.assertEqual( energy_func(X, None), 0.0 )
+
+    def test_gradients_match_energy(self):
+        self.assert_gradient_matches_energy()
+        for method in ('shift', 'reaction_field'):
+            self.electrostatic_energy.set_cutoff(6.0, method=method)
+            self.assert_gradient_matches_energy()
+        self.electrostatic_energy.set_pme(self.box, cutoff=5.0)
+        self.assert_gradient_matches_energy()
+
+    def test_pme_matches_ewald_sum(self):
+        self.electrostatic_energy.set_pme(self.box, cutoff=5.0,
+                                          ewald_tolerance=1e-6,
+                                          grid_spacing=0.5, spline_order=6)
+        alpha = self.electrostatic_energy.get_ewald_alpha()
+        energy_func = self.electrostatic_energy.create_energy_func()
+        E = energy_func(self.X, None)
+        expected_E = self.compute_ewald_sum(alpha)
+        self.assertTrue( allclose(E, expected_E, rtol=1e-4),
+                         "%.6f\t%.6f" % (E, expected_E) )
+        # whole box vectors don't change a periodic energy
+        X = self.X.copy()
+        X[0] += self.box * (1, -2, 3)
+        self.assertTrue( allclose(energy_func(X, None), E) )
+
+
+class TestBatchEnergy(TestCase):
+    def setUp(self):
+        pdb_filename = "sardine/test/test_data/C2H6_ideal_trans_min_final.pdb"
+        sf_filename = "sardine/test/test_data/C2H6.sf"
+        uf = UniverseFactory()
+        uf.load_atoms_from_file(pdb_filename)
+        universe = uf.create_universe()
+        self.num_atoms = len(universe)
+
+        self.bond_energy = BondEnergyFactory()
+        self.bond_energy.load_bonds_from_file(sf_filename)
+        self.angle_energy = AngleEnergyFactory()
+        self.angle_energy.load_angles_from_file(sf_filename)
+        self.vdw_energy = VDWEnergyFactory()
+        self.vdw_energy.load_vdw_from_file(sf_filename)
+        random_state = RandomState(0)
+        self.frames = array([universe.get_coords() +
+                             random_state.uniform(-0.3, 0.3, (self.num_atoms, 3))
+                             for i in xrange(7)])
+
+    def check_batch_matches_frames(self):
+        term_names = ['bonds', 'angles', 'vdw']
+        eff = EnergyFunctionFactory()
+        eff.add_energy_term('bonds',
+            self.bond_energy.create_energy_func(self.num_atoms))
+        eff.add_energy_term('angles', self.angle_energy.create_energy_func())
+        eff.add_energy_term('vdw', self.vdw_energy.create_energy_func())
+        gff = GradientFunctionFactory()
+        gff.add_gradient_term('bonds',
+            self.bond_energy.create_gradient_func(self.num_atoms))
+        gff.add_gradient_term('angles', self.angle_energy.create_gradient_func())
+        gff.add_gradient_term('vdw', self.vdw_energy.create_gradient_func())
+        egff = EnergyGradientFunctionFactory()
+        for name, factory in zip(term_names, [self.bond_energy,
+                                              self.angle_energy,
+                                              self.vdw_energy]):
+            egff.add_energy_gradient_term(
+                name, factory.create_energy_and_gradient_func())
+        energy_func = eff.create_energy_func(term_names, self.num_atoms)
+        gradient_func = gff.create_gradient_func(term_names, self.num_atoms)
+        expected_E = [energy_func(X.flatten()) for X in self.frames]
+        expected_G = [gradient_func(X.flatten()) for X in self.frames]
+
+        for chunk_size in (None, 1, 3):
+            batch_energy_func = eff.create_batch_energy_func(
+                                    term_names, self.num_atoms, chunk_size)
+            batch_gradient_func = gff.create_batch_gradient_func(
+                                    term_names, self.num_atoms, chunk_size)
+            batch_energy_and_gradient_func = \
+                egff.create_batch_energy_and_gradient_func(
+                    term_names, self.num_atoms, chunk_size)
+            self.assertTrue( allclose(batch_energy_func(self.frames),
+                                      expected_E) )
+            self.assertTrue( allclose(batch_gradient_func(self.frames),
+                                      expected_G) )
+            E, G = batch_energy_and_gradient_func(
+                        self.frames.reshape((len(self.frames), -1)))
+            self.assertEqual( G.shape, (len(self.frames), 3 * self.num_atoms) )
+            self.assertTrue( allclose(E, expected_E) )
+            self.assertTrue( allclose(G, expected_G) )
+
+    def test_batch_matches_frames(self):
+        self.check_batch_matches_frames()
+
+    def test_batch_matches_frames_with_cutoff(self):
+        self.vdw_energy.set_cutoff(2.5, skin=0.5)
+        self.check_batch_matches_frames()
+
+
+class TestSinglePrecision(TestCase):
+    def setUp(self):
+        pdb_filename = "sardine/test/test_data/C2H6_ideal_trans_min_final.pdb"
+        sf_filename = "sardine/test/test_data/C2H6.sf"
+        uf = UniverseFactory()
+        uf.load_atoms_from_file(pdb_filename)
+        self.universe = uf.create_universe(dtype=float32)
+        self.num_atoms = len(self.universe)
+
+        bond_energy = BondEnergyFactory()
+        bond_energy.load_bonds_from_file(sf_filename)
+        angle_energy = AngleEnergyFactory()
+        angle_energy.load_angles_from_file(sf_filename)
+        vdw_energy = VDWEnergyFactory()
+        vdw_energy.load_vdw_from_file(sf_filename)
+        self.term_names = ['bonds', 'angles', 'vdw']
+        self.egff = EnergyGradientFunctionFactory()
+        for name, factory in zip(self.term_names, [bond_energy, angle_energy,
+                                                   vdw_energy]):
+            self.egff.add_energy_gradient_term(
+                name, factory.create_energy_and_gradient_func())
+        X = self.universe.get_coords()
+        self.X = X + RandomState(0).uniform(-0.1, 0.1, X.shape).astype(float32)
+
+    def test_terms_compute_in_single_precision(self):
+        for name in self.term_names:
+            E, G = self.egff.energy_gradient_terms[name](self.X)
+            self.assertEqual( G.dtype, float32 )
+
+    def test_matches_double_precision(self):
+        double_func = self.egff.create_energy_and_gradient_func(
+                        self.term_names, self.num_atoms)
+        single_func = self.egff.create_energy_and_gradient_func(
+                        self.term_names, self.num_atoms, dtype=float32)
+        self.assertEqual( self.universe.get_coords().dtype, float32 )
+        expected_E, expected_G = double_func(self.X.astype(float).ravel())
+        E, G = single_func(self.X.ravel())
+        self.assertEqual( G.dtype, float64 )
+        self.assertTrue( allclose(E, expected_E, rtol=1e-5),
+                         "%f\t%f" % (E, expected_E) )
+        self.assertTrue( allclose(G, expected_G, rtol=1e-4, atol=1e-3) )
@@ -2,13 +2,22 @@
 Computes normal modes for ethane.
 """
 
+import os
+import shutil
+import tempfile
 from unittest import TestCase
 from os.path import exists
+from numpy import allclose, memmap, float32, may_share_memory, isnan
+from scipy.sparse import issparse
 from ..universe import UniverseFactory
 from ..energy import BondEnergyFactory, AngleEnergyFactory, VDWEnergyFactory,\
-                     EnergyFunctionFactory
+                     EnergyFunctionFactory, HessianFunctionFactory
 from ..nma import compute_hessian, compute_force_constant_matrix,\
-                  compute_normal_modes
+                  compute_normal_modes, compute_lowest_normal_modes,\
+                  compute_mode_scale_factors, generate_mode_trajectory,\
+                  generate_mode_trajectories, stream_mode_trajectories,\
+                  save_normal_modes, load_normal_modes
+from ..trajectory import Trajectory
 
 PDB_FILENAME = "sardine/test/test_data/C2H6_ideal_trans_min_final.pdb"
 SF_FILENAME = "sardine/test/test_data/C2H6.sf"
@@ -51,3 +60,161 @@ class TestEthaneNMA(TestCase):
         normal_modes = compute_normal_modes(F, discard_trans_and_rot=False)
         mode_freqs = normal_modes.get_frequencies()
         print mode_freqs
+
+
+class TestEthaneSparseNMA(TestCase):
+    def setUp(self):
+        uf = UniverseFactory()
+        uf.load_atoms_from_file(PDB_FILENAME)
+        universe = uf.create_universe()
+        self.universe = universe
+
+        bond_energy = BondEnergyFactory()
+        bond_energy.load_bonds_from_file(SF_FILENAME)
+        angle_energy = AngleEnergyFactory()
+        angle_energy.load_angles_from_file(SF_FILENAME)
+
+        hff = HessianFunctionFactory()
+        hff.add_hessian_term('bonds', bond_energy.create_hessian_func())
+        hff.add_hessian_term('angles', angle_energy.create_hessian_func())
+        self.hessian_func = hff.create_hessian_func(
+                                ['bonds', 'angles'], num_atoms=len(universe))
+        self.sparse_hessian_func = hff.create_hessian_func(
+                                    ['bonds', 'angles'],
+                                    num_atoms=len(universe), sparse=True)
+
+    def test_lowest_sparse_modes_match_dense_modes(self):
+        X = self.universe.get_coords().flatten()
+        H = self.hessian_func(X)
+        sparse_H = self.sparse_hessian_func(X)
+        self.assertTrue( issparse(sparse_H) )
+        self.assertTrue( allclose(sparse_H.toarray(), H) )
+
+        M = self.universe.get_inv_sqrt_mass_matrix()
+        F = compute_force_constant_matrix(H, M)
+        sparse_F = compute_force_constant_matrix(
+                    sparse_H, self.universe.get_inv_sqrt_mass_vector())
+        self.assertTrue( issparse(sparse_F) )
+        self.assertTrue( allclose(sparse_F.toarray(), F) )
+
+        num_modes = 5
+        expected_freqs = compute_normal_modes(F).get_frequencies()[:num_modes]
+        mode_freqs = compute_lowest_normal_modes(
+                        sparse_F, num_modes).get_frequencies()
+        self.assertTrue( allclose(mode_freqs, expected_freqs),
+                         "\n%s\n%s" % (mode_freqs, expected_freqs) )
+
+
+class TestEthaneModeTrajectories(TestCase):
+    def setUp(self):
+        uf = UniverseFactory()
+        uf.load_atoms_from_file(PDB_FILENAME)
+        universe = uf.create_universe()
+        self.X = universe.get_coords()
+
+        bond_energy = BondEnergyFactory()
+        bond_energy.load_bonds_from_file(SF_FILENAME)
+        hff = HessianFunctionFactory()
+        hff.add_hessian_term('bonds', bond_energy.create_hessian_func())
+        hessian_func = hff.create_hessian_func(['bonds'],
+                                               num_atoms=len(universe))
+        F = compute_force_constant_matrix(hessian_func(self.X.flatten()),
+                                          universe.get_inv_sqrt_mass_vector())
+        self.normal_modes = compute_normal_modes(F)
+
+    def expected_frames(self, mode_number, peak_scale_factor):
+        freq, amplitude = self.normal_modes.get_mode(mode_number)
+        return [self.X * (1 + s * amplitude) for s in
+                compute_mode_scale_factors(peak_scale_factor)]
+
+    def test_batched_frames_match_per_frame_formula(self):
+        mode_numbers = [0, 3, 5]
+        peak_scale_factors = [0.5, 1.0, 2.0]
+        coords = generate_mode_trajectories(
+                    self.normal_modes, self.X, mode_numbers,
+                    peak_scale_factor=peak_scale_factors)
+        num_frames = len(compute_mode_scale_factors())
+        self.assertEqual( coords.shape, (3, num_frames, len(self.X), 3) )
+        for i, mode_number in enumerate(mode_numbers):
+            self.assertTrue( allclose(coords[i], self.expected_frames(
+                                mode_number, peak_scale_factors[i])) )
+
+        trajectory = generate_mode_trajectory(self.normal_modes, self.X, 3,
+                                              peak_scale_factor=1.0)
+        self.assertTrue( allclose(trajectory.get_coords(), coords[1]) )
+
+    def test_streams_one_mode_at_a_time(self):
+        trajectories = {}
+        def create_writer(mode_number):
+            trajectory = Trajectory()
+            trajectory.write_frame = trajectory.add_frame
+            trajectories[mode_number] = trajectory
+            return trajectory
+        stream_mode_trajectories(self.normal_modes, self.X, create_writer,
+                                 peak_scale_factor=0.5)
+        num_modes = len(self.normal_modes.get_frequencies())
+        self.assertEqual( sorted(trajectories), range(num_modes) )
+        for mode_number, trajectory in trajectories.iteritems():
+            self.assertTrue( allclose(trajectory.get_coords(),
+                                      self.expected_frames(mode_number, 0.5)) )
+
+
+class TestEthaneNormalModesStorage(TestCase):
+    def setUp(self):
+        uf = UniverseFactory()
+        uf.load_atoms_from_file(PDB_FILENAME)
+        universe = uf.create_universe()
+        bond_energy = BondEnergyFactory()
+        bond_energy.load_bonds_from_file(SF_FILENAME)
+        angle_energy = AngleEnergyFactory()
+        angle_energy.load_angles_from_file(SF_FILENAME)
+        hff = HessianFunctionFactory()
+        hff.add_hessian_term('bonds', bond_energy.create_hessian_func())
+        hff.add_hessian_term('angles', angle_energy.create_hessian_func())
+        hessian_func = hff.create_hessian_func(['bonds', 'angles'],
+                                               num_atoms=len(universe))
+        X = universe.get_coords().flatten()
+        self.F = compute_force_constant_matrix(
+                    hessian_func(X), universe.get_inv_sqrt_mass_vector())
+        self.num_atoms = len(universe)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_modes_are_views_of_one_array(self):
+        normal_modes = compute_normal_modes(self.F)
+        num_modes = 3 * self.num_atoms - 6
+        self.assertEqual( len(normal_modes), num_modes )
+        self.assertEqual( normal_modes.get_eigenvectors().shape,
+                          (num_modes, 3 * self.num_atoms) )
+        freq, amplitude = normal_modes.get_mode(4)
+        self.assertEqual( amplitude.shape, (self.num_atoms, 3) )
+        self.assertTrue( may_share_memory(amplitude,
+                                          normal_modes.get_eigenvectors()) )
+
+        expected_str = ""
+        for i, frequency in enumerate(normal_modes.get_frequencies()):
+            expected_str += "%d\t%.1f\n" % (i, frequency)
+        self.assertEqual( normal_modes.freq_to_str(), expected_str )
+
+        single_modes = compute_normal_modes(self.F, dtype=float32)
+        self.assertEqual( single_modes.get_eigenvectors().dtype, float32 )
+        self.assertTrue( allclose(single_modes.get_eigenvectors(),
+                                  normal_modes.get_eigenvectors(), atol=1e-6) )
+
+    def test_save_and_load(self):
+        normal_modes = compute_normal_modes(self.F)
+        filename = os.path.join(self.tmp_dir, "modes.npz")
+        save_normal_modes(filename, normal_modes)
+        for mmap_mode in (None, 'r'):
+            loaded = load_normal_modes(filename, mmap_mode)
+            self.assertEqual( isinstance(loaded.get_eigenvectors(), memmap),
+                              mmap_mode is not None )
+            freqs = normal_modes.get_frequencies()
+            self.assertTrue( allclose(loaded.get_frequencies()[~isnan(freqs)],
+                                      freqs[~isnan(freqs)]) )
+            self.assertTrue( allclose(loaded.get_eigenvectors(),
+                                      normal_modes.get_eigenvectors()) )
+            self.assertTrue( allclose(loaded.get_mode(2)[1],
+                                      normal_modes.get_mode(2)[1]) )
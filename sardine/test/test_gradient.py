@@ -1,8 +1,9 @@
 from unittest import TestCase
 from numpy import zeros, zeros_like, allclose, cos, sin, pi, dot
 from numpy.linalg import norm
-from ..energy import BondEnergyFactory, AngleEnergyFactory, VDWEnergyFactory
-from ..bonded_terms import BondFactory, AngleFactory
+from ..energy import BondEnergyFactory, AngleEnergyFactory, VDWEnergyFactory,\
+                     TorsionEnergyFactory, ImproperEnergyFactory
+from ..bonded_terms import BondFactory, AngleFactory, TorsionFactory
 from ..util import deg2rad, compute_angle
 
 class TestBondGradient(TestCase):
@@ -44,6 +45,37 @@ class TestBondGradient(TestCase):
                         "\n%s\n%s" % (G, self.expected_G))
 
 
+class TestBondGradientSharedAtom(TestCase):
+    def setUp(self):
+        num_atoms = 3
+        X = zeros([num_atoms,3])
+        X[0,:] = (-1.2, 0.1, 0.0)
+        X[2,:] = (0.9, 0.3, -0.2)
+        self.X = X
+
+        bf = BondFactory()
+        bond_energy = BondEnergyFactory()
+        bond_energy.add_bond( bf.create_bond(1, 2, 0.1, 1.5) )
+        bond_energy.add_bond( bf.create_bond(2, 3, 10.0, 1.0) )
+        self.bond_energy_func = bond_energy.create_energy_func(num_atoms)
+        self.bond_gradient_func = bond_energy.create_gradient_func(num_atoms)
+
+    def test_gradient_matches_finite_difference(self):
+        G = self.bond_gradient_func(self.X, None)
+        h = 1e-6
+        expected_G = zeros_like(self.X)
+        for i in xrange(self.X.shape[0]):
+            for j in xrange(3):
+                X_plus = self.X.copy()
+                X_minus = self.X.copy()
+                X_plus[i,j] += h
+                X_minus[i,j] -= h
+                expected_G[i,j] = (self.bond_energy_func(X_plus, None) -
+                                   self.bond_energy_func(X_minus, None)) / (2*h)
+        self.assertTrue( allclose(G, expected_G, atol=1e-6),
+                         "\n%s\n%s" % (G, expected_G) )
+
+
 class TestAngleGradient(TestCase):
     def setUp(self):
         num_atoms = 3
@@ -56,7 +88,7 @@ class TestAngleGradient(TestCase):
 
         theta_0 = deg2rad(109.5)
         force_const = 64.71
-        total_G = force_const * (theta - theta_0)
+        total_G = force_const * (theta - theta_0) / sin(theta)
         vec12 = X[0,:] - X[1,:]
         vec32 = X[2,:] - X[1,:]
         length_vec12 = norm(vec12)
@@ -89,6 +121,83 @@ class TestAngleGradient(TestCase):
                          "\n%s\n%s" % (G, self.expected_G) )
 
 
+class TestAngleGradientBatch(TestCase):
+    def setUp(self):
+        X = zeros([4,3])
+        X[0,:] = (-1.0, 0.1, 0.0)
+        X[2,:] = (0.3, 0.9, 0.2)
+        X[3,:] = (1.0, 1e-9, 0.0) # nearly linear with atoms 1 and 2
+        self.X = X
+
+        af = AngleFactory()
+        angle_energy_factory = AngleEnergyFactory()
+        angle_energy_factory.add_angle(
+            af.create_angle(1, 2, 3, 64.71, deg2rad(109.5)) )
+        angle_energy_factory.add_angle(
+            af.create_angle(1, 2, 4, 30.0, deg2rad(170.0)) )
+        angle_energy_factory.add_angle(
+            af.create_angle(3, 2, 4, 20.0, deg2rad(90.0)) )
+        self.angle_energy_func = angle_energy_factory.create_energy_func()
+        self.angle_gradient_func = angle_energy_factory.create_gradient_func()
+
+    def test_gradient_matches_finite_difference(self):
+        G = self.angle_gradient_func(self.X, None)
+        h = 1e-6
+        expected_G = zeros_like(self.X)
+        for i in xrange(self.X.shape[0]):
+            for j in xrange(3):
+                X_plus = self.X.copy()
+                X_minus = self.X.copy()
+                X_plus[i,j] += h
+                X_minus[i,j] -= h
+                expected_G[i,j] = (self.angle_energy_func(X_plus, None) -
+                                   self.angle_energy_func(X_minus, None)) / (2*h)
+        self.assertTrue( allclose(G, expected_G, atol=1e-4),
+                         "\n%s\n%s" % (G, expected_G) )
+
+
+class TestDihedralGradient(TestCase):
+    def setUp(self):
+        X = zeros([5,3])
+        X[0,:] = (-1.0, 0.9, 0.1)
+        X[2,:] = (1.5, 0.1, -0.1)
+        X[3,:] = (2.1, -0.8, 0.6)
+        X[4,:] = (-0.4, -0.9, 0.3)
+        self.X = X
+
+        tf = TorsionFactory()
+        self.torsion_energy = TorsionEnergyFactory()
+        self.torsion_energy.add_torsion(
+            tf.create_torsion(1, 2, 3, 4, 1.4, 3, 0.0) )
+        self.torsion_energy.add_torsion(
+            tf.create_torsion(5, 2, 3, 4, 0.3, 2, deg2rad(180.0)) )
+        self.improper_energy = ImproperEnergyFactory()
+        self.improper_energy.add_improper(
+            tf.create_improper(2, 1, 3, 5, 20.0, deg2rad(170.0)) )
+
+    def assert_gradient_matches_finite_difference(self, energy_factory):
+        energy_func = energy_factory.create_energy_func()
+        G = energy_factory.create_gradient_func()(self.X, None)
+        h = 1e-6
+        expected_G = zeros_like(self.X)
+        for i in xrange(self.X.shape[0]):
+            for j in xrange(3):
+                X_plus = self.X.copy()
+                X_minus = self.X.copy()
+                X_plus[i,j] += h
+                X_minus[i,j] -= h
+                expected_G[i,j] = (energy_func(X_plus, None) -
+                                   energy_func(X_minus, None)) / (2*h)
+        self.assertTrue( allclose(G, expected_G, atol=1e-5),
+                         "\n%s\n%s" % (G, expected_G) )
+
+    def test_torsion_gradient_matches_finite_difference(self):
+        self.assert_gradient_matches_finite_difference(self.torsion_energy)
+
+    def test_improper_gradient_matches_finite_difference(self):
+        self.assert_gradient_matches_finite_difference(self.improper_energy)
+
+
 class TestVDWEnergy(TestCase):
     def setUp(self):
         well_distance = 2.6 # angstroms
@@ -0,0 +1,151 @@
+from unittest import TestCase
+from numpy import zeros, allclose
+from numpy.random import RandomState
+from ..energy import BondEnergyFactory, AngleEnergyFactory, VDWEnergyFactory,\
+                     ElectrostaticEnergyFactory, TorsionEnergyFactory,\
+                     ImproperEnergyFactory,\
+                     HessianFunctionFactory, create_finite_difference_hessian_func
+from ..bonded_terms import BondFactory, AngleFactory, TorsionFactory
+from ..util import deg2rad, assemble_hessian
+
+def create_test_coords():
+    X = zeros([4,3])
+    X[0,:] = (-1.3, 0.2, 0.1)
+    X[2,:] = (0.4, 1.1, -0.3)
+    X[3,:] = (1.5, 1.4, 0.6)
+    return X + 0.01 * RandomState(3).randn(4,3)
+
+def finite_difference_hessian(gradient_func, X):
+    rows, cols, blocks = create_finite_difference_hessian_func(
+                            gradient_func, step=1e-6)(X)
+    return assemble_hessian(rows, cols, blocks, X.shape[0])
+
+
+class TestAnalyticHessian(TestCase):
+    def setUp(self):
+        self.X = create_test_coords()
+        bf = BondFactory()
+        self.bond_energy = BondEnergyFactory()
+        self.bond_energy.add_bond( bf.create_bond(1, 2, 635.8, 1.54) )
+        self.bond_energy.add_bond( bf.create_bond(2, 3, 10.0, 1.0) )
+        self.bond_energy.add_bond( bf.create_bond(3, 4, 0.1, 1.2) )
+
+        af = AngleFactory()
+        self.angle_energy = AngleEnergyFactory()
+        self.angle_energy.add_angle(
+            af.create_angle(1, 2, 3, 64.71, deg2rad(109.5)) )
+        self.angle_energy.add_angle(
+            af.create_angle(2, 3, 4, 30.0, deg2rad(150.0)) )
+
+        self.vdw_energy = VDWEnergyFactory()
+        self.vdw_energy.set_well_distance(1.5)
+
+        tf = TorsionFactory()
+        self.torsion_energy = TorsionEnergyFactory()
+        self.torsion_energy.add_torsion(
+            tf.create_torsion(1, 2, 3, 4, 1.4, 3, 0.0) )
+        self.improper_energy = ImproperEnergyFactory()
+        self.improper_energy.add_improper(
+            tf.create_improper(2, 1, 3, 4, 20.0, deg2rad(150.0)) )
+
+        self.electrostatic_energy = ElectrostaticEnergyFactory()
+        self.electrostatic_energy.set_charges([-0.4, 0.3, 0.2, -0.1])
+
+    def assert_hessian_matches_gradient(self, hessian_func, gradient_func):
+        rows, cols, blocks = hessian_func(self.X)
+        H = assemble_hessian(rows, cols, blocks, self.X.shape[0])
+        expected_H = finite_difference_hessian(gradient_func, self.X)
+        self.assertTrue( allclose(H, expected_H, rtol=1e-5, atol=1e-4),
+                         "\n%s\n%s" % (H, expected_H) )
+        self.assertTrue( allclose(H, H.T) )
+
+    def test_bond_hessian(self):
+        self.assert_hessian_matches_gradient(
+            self.bond_energy.create_hessian_func(),
+            self.bond_energy.create_gradient_func(num_atoms=4))
+
+    def test_angle_hessian(self):
+        self.assert_hessian_matches_gradient(
+            self.angle_energy.create_hessian_func(),
+            self.angle_energy.create_gradient_func())
+
+    def test_vdw_hessian(self):
+        self.assert_hessian_matches_gradient(
+            self.vdw_energy.create_hessian_func(),
+            self.vdw_energy.create_gradient_func())
+
+    def test_torsion_hessian(self):
+        self.assert_hessian_matches_gradient(
+            self.torsion_energy.create_hessian_func(),
+            self.torsion_energy.create_gradient_func())
+
+    def test_improper_hessian(self):
+        self.assert_hessian_matches_gradient(
+            self.improper_energy.create_hessian_func(),
+            self.improper_energy.create_gradient_func())
+
+    def test_coulomb_hessian(self):
+        self.assert_hessian_matches_gradient(
+            self.electrostatic_energy.create_hessian_func(),
+            self.electrostatic_energy.create_gradient_func())
+
+    def test_reaction_field_hessian(self):
+        self.electrostatic_energy.set_cutoff(2.5, method='reaction_field')
+        self.assert_hessian_matches_gradient(
+            self.electrostatic_energy.create_hessian_func(),
+            self.electrostatic_energy.create_gradient_func())
+
+    def test_typed_vdw_hessian(self):
+        self.vdw_energy.set_type_params([1.5, 1.2], [0.1, 0.3])
+        self.vdw_energy.set_atom_types([0, 1, 1, 0])
+        self.assert_hessian_matches_gradient(
+            self.vdw_energy.create_hessian_func(),
+            self.vdw_energy.create_gradient_func())
+
+    def test_excluded_vdw_hessian(self):
+        self.vdw_energy.set_exclusions(
+            self.bond_energy.create_exclusion_list(4), scale_14=0.5)
+        self.assert_hessian_matches_gradient(
+            self.vdw_energy.create_hessian_func(),
+            self.vdw_energy.create_gradient_func())
+
+    def test_switched_vdw_hessian(self):
+        self.vdw_energy.set_cutoff(2.5, truncation='switch',
+                                   switch_distance=1.0)
+        self.assert_hessian_matches_gradient(
+            self.vdw_energy.create_hessian_func(),
+            self.vdw_energy.create_gradient_func())
+
+
+class TestHessianFunctionFactory(TestCase):
+    def setUp(self):
+        self.X = create_test_coords()
+        bf = BondFactory()
+        bond_energy = BondEnergyFactory()
+        bond_energy.add_bond( bf.create_bond(1, 2, 0.1, 1.0) )
+        bond_energy.add_bond( bf.create_bond(2, 3, 0.1, 1.0) )
+        bond_energy.add_bond( bf.create_bond(3, 4, 0.1, 1.0) )
+        af = AngleFactory()
+        angle_energy = AngleEnergyFactory()
+        angle_energy.add_angle(
+            af.create_angle(1, 2, 3, 64.71, deg2rad(109.5)) )
+
+        hff = HessianFunctionFactory()
+        hff.add_hessian_term('bonds', bond_energy.create_hessian_func())
+        hff.add_hessian_term('angles', angle_energy.create_hessian_func())
+        self.analytic_hessian_func = hff.create_hessian_func(
+                                        ['bonds', 'angles'], num_atoms=4)
+
+        hff = HessianFunctionFactory()
+        hff.add_gradient_term('bonds', bond_energy.create_gradient_func(4))
+        hff.add_gradient_term('angles', angle_energy.create_gradient_func())
+        self.fallback_hessian_func = hff.create_hessian_func(
+                                        ['bonds', 'angles'], num_atoms=4)
+
+    def test_fallback_matches_analytic_hessian(self):
+        X_vec = self.X.flatten()
+        H = self.analytic_hessian_func(X_vec)
+        expected_H = self.fallback_hessian_func(X_vec)
+        self.assertEqual(H.shape, (12, 12))
+        self.assertTrue( allclose(H, expected_H, atol=1e-5),
+                         "\n%s\n%s" % (H, expected_H) )
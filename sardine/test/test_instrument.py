@@ -0,0 +1,141 @@
+from unittest import TestCase
+from numpy import allclose, array, linspace
+from ..universe import UniverseFactory
+from ..energy import BondEnergyFactory, AngleEnergyFactory,\
+                     VDWEnergyFactory, ElectrostaticEnergyFactory,\
+                     EnergyFunctionFactory, GradientFunctionFactory,\
+                     EnergyGradientFunctionFactory, HessianFunctionFactory
+from ..minimize import LBFGSMinimizer
+from ..instrument import Profiler
+
+PDB_FILENAME = "sardine/test/test_data/C2H6_ideal_trans_min_final.pdb"
+SF_FILENAME = "sardine/test/test_data/C2H6.sf"
+
+
+class TestProfiler(TestCase):
+    def setUp(self):
+        uf = UniverseFactory()
+        uf.load_atoms_from_file(PDB_FILENAME)
+        self.universe = uf.create_universe()
+        self.num_atoms = len(self.universe)
+        self.bond_energy = BondEnergyFactory()
+        self.bond_energy.load_bonds_from_file(SF_FILENAME)
+        self.angle_energy = AngleEnergyFactory()
+        self.angle_energy.load_angles_from_file(SF_FILENAME)
+        self.X = self.universe.get_coords().flatten() * 1.02
+
+    def test_counts_terms_and_evaluations(self):
+        profiler = Profiler(track_memory=True)
+        calls = []
+        profiler.add_callback(lambda name, elapsed, memory: calls.append(name))
+
+        egff = EnergyGradientFunctionFactory()
+        egff.add_energy_gradient_term(
+            'bonds', self.bond_energy.create_energy_and_gradient_func())
+        egff.add_energy_gradient_term(
+            'angles', self.angle_energy.create_energy_and_gradient_func())
+        energy_and_gradient_func = egff.create_energy_and_gradient_func(
+                                        ['bonds', 'angles'], self.num_atoms,
+                                        profiler=profiler)
+        unprofiled_func = egff.create_energy_and_gradient_func(
+                            ['bonds', 'angles'], self.num_atoms)
+        E, G = energy_and_gradient_func(self.X)
+        E_expected, G_expected = unprofiled_func(self.X)
+        self.assertTrue( allclose(E, E_expected) )
+        self.assertTrue( allclose(G, G_expected) )
+
+        minimizer = LBFGSMinimizer(gtol=1e-5)
+        minimizer.run_minimization(energy_and_gradient_func, None, self.X,
+                                   self.num_atoms, jac=True, profiler=profiler)
+        status = minimizer.get_status()
+        report = profiler.get_report()
+        num_evals = report['minimizer:energy_and_gradient'].num_calls
+        self.assertEqual( num_evals, status.num_energy_evals )
+        # one call before the minimization, and one more for the final
+        # gradient check unless the minimizer last evaluated that point
+        num_calls = report['energy_and_gradient'].num_calls
+        self.assertTrue( num_evals + 1 <= num_calls <= num_evals + 2 )
+        self.assertEqual( report['energy_and_gradient:bonds'].num_calls,
+                          num_calls )
+        self.assertEqual( report['geometry'].num_calls, num_calls )
+        self.assertEqual( report['minimization'].num_calls, 1 )
+        self.assertTrue( 0.0 <= report['minimizer_overhead'].total_time <=
+                         report['minimization'].total_time )
+        self.assertTrue( report['energy_and_gradient'].total_time >=
+                         report['energy_and_gradient:bonds'].total_time )
+        self.assertEqual( len(calls), sum(stats.num_calls for stats in
+                                          report.itervalues()) )
+        self.assertTrue( 'minimization' in profiler.report_to_str() )
+
+    def test_final_gradient_check_is_not_counted(self):
+        profiler = Profiler()
+        eff = EnergyFunctionFactory()
+        eff.add_energy_term('bonds',
+            self.bond_energy.create_energy_func(self.num_atoms))
+        gff = GradientFunctionFactory()
+        gff.add_gradient_term('bonds',
+            self.bond_energy.create_gradient_func(self.num_atoms))
+        energy_func = eff.create_energy_func(['bonds'], self.num_atoms)
+        gradient_func = gff.create_gradient_func(['bonds'], self.num_atoms)
+
+        minimizer = LBFGSMinimizer(gtol=1e-5)
+        minimizer.run_minimization(energy_func, gradient_func, self.X,
+                                   self.num_atoms, jac=False,
+                                   profiler=profiler)
+        status = minimizer.get_status()
+        report = profiler.get_report()
+        self.assertEqual( report['minimizer:gradient'].num_calls,
+                          status.num_gradient_evals )
+        self.assertEqual( report['minimizer:energy'].num_calls,
+                          status.num_energy_evals )
+
+    def test_nonbonded_terms_share_geometry(self):
+        for cutoff in (None, 6.0):
+            profiler = Profiler()
+            vdw_energy = VDWEnergyFactory()
+            vdw_energy.set_cutoff(cutoff)
+            coulomb_energy = ElectrostaticEnergyFactory()
+            coulomb_energy.set_charges(linspace(-0.3, 0.3, self.num_atoms))
+            coulomb_energy.set_cutoff(cutoff)
+            coulomb_energy.set_pair_list(vdw_energy.get_pair_list())
+            egff = EnergyGradientFunctionFactory()
+            egff.add_energy_gradient_term(
+                'vdw', vdw_energy.create_energy_and_gradient_func())
+            egff.add_energy_gradient_term(
+                'coulomb', coulomb_energy.create_energy_and_gradient_func())
+            term_names = ['vdw', 'coulomb']
+            energy_and_gradient_func = egff.create_energy_and_gradient_func(
+                                            term_names, self.num_atoms,
+                                            profiler=profiler)
+            batch_func = egff.create_batch_energy_and_gradient_func(
+                            term_names, self.num_atoms, profiler=profiler)
+            energy_and_gradient_func(self.X)
+            self.assertEqual( profiler.get_report()['geometry'].num_calls, 1 )
+            batch_func(array([self.X, self.X * 1.01]))
+            self.assertEqual( profiler.get_report()['geometry'].num_calls, 2 )
+
+    def test_counts_hessians(self):
+        profiler = Profiler()
+        hff = HessianFunctionFactory()
+        hff.add_hessian_term('bonds', self.bond_energy.create_hessian_func())
+        hff.add_hessian_term('angles', self.angle_energy.create_hessian_func())
+        hessian_func = hff.create_hessian_func(['bonds', 'angles'],
+                                               self.num_atoms, sparse=True,
+                                               profiler=profiler)
+        for i in xrange(3):
+            hessian_func(self.X)
+        report = profiler.get_report()
+        for name in ('hessian', 'hessian:bonds', 'hessian:angles',
+                     'hessian_assembly'):
+            self.assertEqual( report[name].num_calls, 3 )
+
+    def test_disabled_profiler_records_nothing(self):
+        profiler = Profiler()
+        profiler.enabled = False
+        eff = EnergyFunctionFactory()
+        eff.add_energy_term('bonds',
+            self.bond_energy.create_energy_func(self.num_atoms))
+        energy_func = eff.create_energy_func(['bonds'], self.num_atoms,
+                                             profiler=profiler)
+        energy_func(self.X)
+        self.assertEqual( profiler.get_report(), {} )
@@ -1,10 +1,17 @@
+import sys
+from StringIO import StringIO
 from unittest import TestCase
 from os.path import join
+from numpy import allclose, absolute, float32
+from numpy.random import RandomState
 from ..universe import UniverseFactory
 from ..energy import BondEnergyFactory, AngleEnergyFactory
 from ..energy import VDWEnergyFactory
-from ..energy import EnergyFunctionFactory, GradientFunctionFactory
-from ..minimize import BFGSMinimizer
+from ..energy import EnergyFunctionFactory, GradientFunctionFactory,\
+                     EnergyGradientFunctionFactory
+from ..minimize import BFGSMinimizer, MINIMIZERS, create_minimizer,\
+                       MAX_BFGS_ATOMS, LBFGSMinimizer, Minimizer,\
+                       FIREMinimizer
 from ..trajectory import save_trajectory_to_pdb
 
 
@@ -144,3 +151,166 @@ class TestVDWMinimization(TestCase):
         save_trajectory_to_pdb('vdw_minimization.pdb', trajectory,
                                self.universe, None)
         print "Wrote vdw_minimization.pdb"
+
+
+class TestFusedMinimization(TestCase):
+    def setUp(self):
+        pdb_filename = "sardine/test/test_data/triatomic_angle.pdb"
+        sf_filename = "sardine/test/test_data/triatomic_angle.sf"
+        uf = UniverseFactory()
+        uf.load_atoms_from_file(pdb_filename)
+        universe = uf.create_universe()
+        self.universe = universe
+
+        bond_energy_factory = BondEnergyFactory()
+        bond_energy_factory.load_bonds_from_file(sf_filename)
+        angle_energy_factory = AngleEnergyFactory()
+        angle_energy_factory.load_angles_from_file(sf_filename)
+
+        eff = EnergyFunctionFactory()
+        eff.add_energy_term('bonds', bond_energy_factory.create_energy_func(
+                                        num_atoms=len(universe)))
+        eff.add_energy_term('angles', angle_energy_factory.create_energy_func())
+        self.energy_func = eff.create_energy_func(['bonds', 'angles'],
+                                                  num_atoms=len(universe))
+
+        gff = GradientFunctionFactory()
+        gff.add_gradient_term('bonds', bond_energy_factory.create_gradient_func(
+                                        num_atoms=len(universe)))
+        gff.add_gradient_term('angles', angle_energy_factory.create_gradient_func())
+        self.gradient_func = gff.create_gradient_func(['bonds', 'angles'],
+                                                      num_atoms=len(universe))
+
+        egff = EnergyGradientFunctionFactory()
+        egff.add_energy_gradient_term(
+            'bonds', bond_energy_factory.create_energy_and_gradient_func())
+        egff.add_energy_gradient_term(
+            'angles', angle_energy_factory.create_energy_and_gradient_func())
+        self.energy_and_gradient_func = egff.create_energy_and_gradient_func(
+                                            ['bonds', 'angles'],
+                                            num_atoms=len(universe))
+
+    def test_fused_function_matches_separate_functions(self):
+        X = self.universe.get_coords().flatten()
+        E, G = self.energy_and_gradient_func(X)
+        self.assertTrue( allclose(E, self.energy_func(X)) )
+        self.assertTrue( allclose(G, self.gradient_func(X)) )
+
+    def test_minimizes_with_one_evaluation_per_point(self):
+        num_calls = {'E': 0, 'G': 0, 'EG': 0}
+        def counting_energy_func(X_vec):
+            num_calls['E'] += 1
+            return self.energy_func(X_vec)
+        def counting_gradient_func(X_vec):
+            num_calls['G'] += 1
+            return self.gradient_func(X_vec)
+        def counting_energy_and_gradient_func(X_vec):
+            num_calls['EG'] += 1
+            return self.energy_and_gradient_func(X_vec)
+
+        X = self.universe.get_coords().flatten()
+        X_expected, energy_expected = BFGSMinimizer().run_minimization(
+                                        counting_energy_func,
+                                        counting_gradient_func,
+                                        X, num_atoms=len(self.universe))
+        X_min, energy_min = BFGSMinimizer().run_minimization(
+                                counting_energy_and_gradient_func, None, X,
+                                num_atoms=len(self.universe), jac=True)
+        self.assertTrue( allclose(X_min, X_expected) )
+        self.assertTrue( allclose(energy_min, energy_expected) )
+        self.assertTrue( num_calls['EG'] <= max(num_calls['E'], num_calls['G']),
+                         num_calls )
+
+
+class TestMinimizerBackends(TestCase):
+    def setUp(self):
+        pdb_filename = "sardine/test/test_data/C2H6_ideal_trans_min_final.pdb"
+        sf_filename = "sardine/test/test_data/C2H6.sf"
+        uf = UniverseFactory()
+        uf.load_atoms_from_file(pdb_filename)
+        self.universe = uf.create_universe()
+
+        bond_energy_factory = BondEnergyFactory()
+        bond_energy_factory.load_bonds_from_file(sf_filename)
+        angle_energy_factory = AngleEnergyFactory()
+        angle_energy_factory.load_angles_from_file(sf_filename)
+        egff = EnergyGradientFunctionFactory()
+        egff.add_energy_gradient_term(
+            'bonds', bond_energy_factory.create_energy_and_gradient_func())
+        egff.add_energy_gradient_term(
+            'angles', angle_energy_factory.create_energy_and_gradient_func())
+        self.egff = egff
+        self.energy_and_gradient_func = egff.create_energy_and_gradient_func(
+                                            ['bonds', 'angles'],
+                                            num_atoms=len(self.universe))
+        self.X = self.universe.get_coords().flatten() + \
+                 RandomState(0).uniform(-0.1, 0.1, 3 * len(self.universe))
+
+    def test_backends_reach_same_minimum(self):
+        gtol = 1e-4
+        X_expected, energy_expected = BFGSMinimizer(gtol=gtol).run_minimization(
+                                        self.energy_and_gradient_func, None,
+                                        self.X, len(self.universe), jac=True)
+        for method in sorted(MINIMIZERS):
+            minimizer = create_minimizer(len(self.universe), method,
+                                         gtol=gtol, maxiter=5000)
+            X_min, energy_min = minimizer.run_minimization(
+                                    self.energy_and_gradient_func, None,
+                                    self.X, len(self.universe), jac=True,
+                                    save_trajectory=True)
+            status = minimizer.get_status()
+            self.assertTrue( status.converged, (method, status) )
+            self.assertTrue( status.max_gradient < gtol, (method, status) )
+            self.assertTrue( allclose(status.energy, energy_min) )
+            self.assertTrue( allclose(energy_min, energy_expected, atol=1e-6),
+                             (method, energy_min, energy_expected) )
+            E, G = self.energy_and_gradient_func(X_min)
+            self.assertTrue( allclose(E, energy_min) )
+            self.assertTrue( absolute(G).max() < gtol )
+            self.assertEqual( len(minimizer.get_trajectory()),
+                              status.num_iterations + 1 )
+            self.assertTrue( status.num_energy_evals >= status.num_iterations )
+
+    def test_single_precision_minimization(self):
+        gtol = 1e-2
+        X_expected, energy_expected = BFGSMinimizer(gtol=gtol).run_minimization(
+                                        self.energy_and_gradient_func, None,
+                                        self.X, len(self.universe), jac=True)
+        single_func = self.egff.create_energy_and_gradient_func(
+                        ['bonds', 'angles'], len(self.universe), dtype=float32)
+        minimizer = BFGSMinimizer(gtol=gtol)
+        X_min, energy_min = minimizer.run_minimization(
+                                single_func, None, self.X.astype(float32),
+                                len(self.universe), jac=True,
+                                save_trajectory=True, trajectory_dtype=float32)
+        self.assertTrue( minimizer.get_status().converged )
+        self.assertTrue( allclose(energy_min, energy_expected, atol=1e-4),
+                         (energy_min, energy_expected) )
+        self.assertEqual( minimizer.get_trajectory().get_coords().dtype,
+                          float32 )
+
+    def test_chooses_backend_by_size(self):
+        self.assertTrue( isinstance(create_minimizer(10), BFGSMinimizer) )
+        self.assertTrue( isinstance(create_minimizer(MAX_BFGS_ATOMS + 1),
+                                    LBFGSMinimizer) )
+
+    def test_backend_without_minimize_cannot_be_created(self):
+        class IncompleteMinimizer(Minimizer):
+            pass
+        self.assertRaises( TypeError, IncompleteMinimizer )
+
+    def test_noisy_fire_adds_no_evaluations(self):
+        energy_func = lambda X: self.energy_and_gradient_func(X)[0]
+        gradient_func = lambda X: self.energy_and_gradient_func(X)[1]
+        num_energy_evals = []
+        for noisy in (False, True):
+            minimizer = FIREMinimizer(gtol=1e-3, maxiter=50)
+            stdout = sys.stdout
+            sys.stdout = StringIO()
+            try:
+                minimizer.run_minimization(energy_func, gradient_func, self.X,
+                                           len(self.universe), noisy=noisy)
+            finally:
+                sys.stdout = stdout
+            num_energy_evals.append(minimizer.get_status().num_energy_evals)
+        self.assertEqual( num_energy_evals[0], num_energy_evals[1] )
@@ -0,0 +1,190 @@
+from unittest import TestCase
+from numpy import zeros_like, allclose, triu_indices, array
+from numpy.random import RandomState
+from numpy.linalg import norm
+from ..neighbor_list import NeighborList, AllPairsList, ExclusionList
+from ..energy import VDWEnergyFactory
+
+def brute_force_pairs(X, cutoff):
+    pairs = set()
+    for i in xrange(X.shape[0]):
+        for j in xrange(i+1, X.shape[0]):
+            if norm(X[i,:] - X[j,:]) < cutoff:
+                pairs.add( (i,j) )
+    return pairs
+
+def finite_difference_gradient(energy_func, X, h=1e-6):
+    G = zeros_like(X)
+    for i in xrange(X.shape[0]):
+        for j in xrange(X.shape[1]):
+            X_plus = X.copy()
+            X_minus = X.copy()
+            X_plus[i,j] += h
+            X_minus[i,j] -= h
+            G[i,j] = (energy_func(X_plus, None) -
+                      energy_func(X_minus, None)) / (2*h)
+    return G
+
+
+class TestNeighborList(TestCase):
+    def setUp(self):
+        self.X = RandomState(42).uniform(0.0, 15.0, size=(60,3))
+        self.cutoff = 5.0
+        self.skin = 1.0
+
+    def test_pairs_include_all_pairs_within_cutoff(self):
+        nbr_list = NeighborList(self.cutoff, self.skin)
+        I, J = nbr_list.get_pairs(self.X)
+        listed_pairs = set(zip(I, J))
+        expected_pairs = brute_force_pairs(self.X, self.cutoff + self.skin)
+        self.assertEqual(listed_pairs, expected_pairs)
+
+    def test_rebuilds_only_after_moving_half_the_skin(self):
+        nbr_list = NeighborList(self.cutoff, self.skin)
+        nbr_list.get_pairs(self.X)
+        X = self.X.copy()
+        X[0,0] += 0.4 * self.skin
+        nbr_list.get_pairs(X)
+        self.assertEqual(nbr_list.num_builds, 1)
+        X[0,0] += 0.2 * self.skin
+        nbr_list.get_pairs(X)
+        self.assertEqual(nbr_list.num_builds, 2)
+
+    def test_all_pairs_list_matches_upper_triangle(self):
+        I, J = AllPairsList().get_pairs(self.X)
+        expected_I, expected_J = triu_indices(self.X.shape[0], 1)
+        self.assertTrue( allclose(I, expected_I) and allclose(J, expected_J) )
+
+class TestVDWCutoff(TestCase):
+    def setUp(self):
+        # jittered 3x3x3 lattice, so that no two atoms are much closer
+        # than the well distance
+        grid = array([(i, j, k) for i in xrange(3) for j in xrange(3)
+                      for k in xrange(3)], dtype=float)
+        self.X = 3.4 * grid + RandomState(7).uniform(-0.3, 0.3, size=(27,3))
+        self.cutoff = 6.0
+
+    def create_vdw_energy(self, truncation):
+        vdw_energy = VDWEnergyFactory()
+        vdw_energy.set_well_distance(3.5)
+        vdw_energy.set_well_depth(1.0)
+        vdw_energy.set_cutoff(self.cutoff, skin=1.0, truncation=truncation)
+        return vdw_energy
+
+    def test_shifted_energy_matches_brute_force(self):
+        vdw_energy_func = self.create_vdw_energy('shift').create_energy_func()
+        E_cut = 1.0 * ((3.5/self.cutoff)**12 - 2*(3.5/self.cutoff)**6)
+        expected_E = 0.0
+        for i, j in brute_force_pairs(self.X, self.cutoff):
+            r = norm(self.X[i,:] - self.X[j,:])
+            expected_E += 1.0 * ((3.5/r)**12 - 2*(3.5/r)**6) - E_cut
+        E = vdw_energy_func(self.X, None)
+        self.assertTrue( allclose(E, expected_E), "%f\t%f" % (E, expected_E) )
+
+    def test_systems_keep_their_own_neighbor_lists(self):
+        X_other = RandomState(3).uniform(0.0, 12.0, size=(40,3))
+        vdw_energy = self.create_vdw_energy('shift')
+        other_vdw_energy = self.create_vdw_energy('shift')
+        vdw_energy_func = vdw_energy.create_energy_func()
+        other_vdw_energy_func = other_vdw_energy.create_energy_func()
+        for i in xrange(5):
+            vdw_energy_func(self.X, None)
+            other_vdw_energy_func(X_other, None)
+        nbr_list = vdw_energy.get_pair_list()
+        other_nbr_list = other_vdw_energy.get_pair_list()
+        self.assertTrue( nbr_list is not other_nbr_list )
+        self.assertEqual( nbr_list.num_builds, 1 )
+        self.assertEqual( other_nbr_list.num_builds, 1 )
+
+    def test_gradients_match_finite_difference(self):
+        for truncation in ('shift', 'switch'):
+            vdw_energy = self.create_vdw_energy(truncation)
+            vdw_energy_func = vdw_energy.create_energy_func()
+            vdw_gradient_func = vdw_energy.create_gradient_func()
+            G = vdw_gradient_func(self.X, None)
+            expected_G = finite_difference_gradient(vdw_energy_func, self.X)
+            self.assertTrue( allclose(G, expected_G, atol=1e-5),
+                             "%s\n%s\n%s" % (truncation, G, expected_G) )
+
+
+class TestExclusionList(TestCase):
+    def setUp(self):
+        # chain of 6 atoms with a side atom on the third
+        self.bonds = [(0, 1), (1, 2), (2, 3), (3, 4), (4, 5), (2, 6)]
+        self.num_atoms = 7
+        I, J = zip(*self.bonds)
+        self.exclusion_list = ExclusionList(array(I), array(J), self.num_atoms)
+        grid = array([(i, i % 2, 0.3 * i) for i in xrange(self.num_atoms)],
+                     dtype=float)
+        self.X = 1.5 * grid + RandomState(1).uniform(-0.2, 0.2, (7,3))
+
+    def get_bond_separations(self):
+        """
+        Fewest bonds between each pair of atoms, by breadth-first search.
+        """
+        neighbors = dict( (i, set()) for i in xrange(self.num_atoms) )
+        for i, j in self.bonds:
+            neighbors[i].add(j)
+            neighbors[j].add(i)
+        separations = {}
+        for start in xrange(self.num_atoms):
+            depth = {start: 0}
+            frontier = [start]
+            while frontier:
+                next_frontier = []
+                for i in frontier:
+                    for j in neighbors[i]:
+                        if j not in depth:
+                            depth[j] = depth[i] + 1
+                            next_frontier.append(j)
+                frontier = next_frontier
+            for j, d in depth.iteritems():
+                if start < j:
+                    separations[(start, j)] = d
+        return separations
+
+    def get_pairs(self, keys):
+        return set( (k // self.num_atoms, k % self.num_atoms) for k in keys )
+
+    def test_pairs_match_bond_separations(self):
+        separations = self.get_bond_separations()
+        self.assertEqual( self.get_pairs(self.exclusion_list.excluded_keys),
+                          set(p for p, d in separations.items() if d <= 2) )
+        self.assertEqual( self.get_pairs(self.exclusion_list.one_four_keys),
+                          set(p for p, d in separations.items() if d == 3) )
+
+    def test_pair_lists_leave_out_excluded_pairs(self):
+        excluded_keys = self.exclusion_list.get_excluded_keys()
+        excluded_pairs = self.get_pairs(excluded_keys)
+        I, J = AllPairsList(excluded_keys).get_pairs(self.X)
+        all_pairs = set(zip(*triu_indices(self.num_atoms, 1)))
+        self.assertEqual( set(zip(I, J)), all_pairs - excluded_pairs )
+        I, J = NeighborList(4.0, 0.5, excluded_keys).get_pairs(self.X)
+        self.assertEqual( set(zip(I, J)),
+                          brute_force_pairs(self.X, 4.5) - excluded_pairs )
+
+    def test_shared_pair_list_must_match_exclusions(self):
+        vdw_energy = VDWEnergyFactory()
+        vdw_energy.set_exclusions(self.exclusion_list)
+        self.assertRaises( AssertionError, vdw_energy.set_pair_list,
+                           AllPairsList() )
+        vdw_energy.set_pair_list(
+            AllPairsList(self.exclusion_list.get_excluded_keys()) )
+
+    def test_scaled_vdw_energy(self):
+        separations = self.get_bond_separations()
+        vdw_energy = VDWEnergyFactory()
+        vdw_energy.set_exclusions(self.exclusion_list, scale_14=0.5)
+        expected_E = 0.0
+        for (i, j), d in separations.iteritems():
+            if d >= 3:
+                r = norm(self.X[i,:] - self.X[j,:])
+                E = 0.1 * ((2.6/r)**12 - 2*(2.6/r)**6)
+                expected_E += 0.5 * E if d == 3 else E
+        vdw_energy_func = vdw_energy.create_energy_func()
+        E = vdw_energy_func(self.X, None)
+        self.assertTrue( allclose(E, expected_E), "%f\t%f" % (E, expected_E) )
+        G = vdw_energy.create_gradient_func()(self.X, None)
+        expected_G = finite_difference_gradient(vdw_energy_func, self.X)
+        self.assertTrue( allclose(G, expected_G, atol=1e-5),
+                         "\n%s\n%s" % (G, expected_G) )
@@ -0,0 +1,106 @@
+import os
+import tempfile
+from unittest import TestCase
+from numpy import allclose, pi
+from ..parsers import PdbParser, StructureParser
+
+PDB_FILENAME = "sardine/test/test_data/LJ10.pdb"
+SF_FILENAME = "sardine/test/test_data/C2H6.sf"
+TRIATOMIC_SF_FILENAME = "sardine/test/test_data/triatomic.sf"
+
+
+class TestPdbColumns(TestCase):
+    def setUp(self):
+        parser = PdbParser()
+        self.atoms = list(parser.iter_atoms_in_pdb_file(PDB_FILENAME))
+        self.columns = parser.read_pdb_columns(PDB_FILENAME)
+        self.mmap_columns = parser.read_pdb_columns(PDB_FILENAME,
+                                                    use_mmap=True)
+
+    def test_columns_match_atom_iterator(self):
+        for columns in (self.columns, self.mmap_columns):
+            self.assertEqual( columns['coords'].shape, (len(self.atoms), 3) )
+            self.assertTrue( allclose(columns['coords'],
+                                      [(a.x, a.y, a.z) for a in self.atoms]) )
+            for name in ('mass', 'charge', 'radius'):
+                self.assertTrue( allclose(columns[name],
+                                          [getattr(a, name) for a in self.atoms]) )
+            for name in ('serial_num', 'res_num', 'atom_name', 'res_name',
+                         'chain_id'):
+                self.assertEqual( list(columns[name]),
+                                  [getattr(a, name) for a in self.atoms] )
+
+
+class TestStructureArrays(TestCase):
+    def setUp(self):
+        self.parser = StructureParser()
+
+    def test_arrays_match_record_iterators(self):
+        structure = self.parser.read_sf_file(SF_FILENAME)
+        bonds = list(self.parser.iter_bonds_in_sf_file(SF_FILENAME))
+        angles = list(self.parser.iter_angles_in_sf_file(SF_FILENAME))
+        self.assertEqual( structure['bond_serial_nums'].tolist(),
+                          [[b.serial_num_1, b.serial_num_2] for b in bonds] )
+        self.assertTrue( allclose(structure['bond_force_consts'],
+                                  [b.force_const for b in bonds]) )
+        self.assertTrue( allclose(structure['bond_r_0s'],
+                                  [b.r_0 for b in bonds]) )
+        self.assertEqual( structure['angle_serial_nums'].tolist(),
+                          [[a.serial_num_1, a.serial_num_2, a.serial_num_3]
+                           for a in angles] )
+        self.assertTrue( allclose(structure['angle_force_consts'],
+                                  [a.force_const for a in angles]) )
+        self.assertTrue( allclose(structure['angle_theta_0s'],
+                                  [a.theta_0 for a in angles]) )
+        self.assertTrue( allclose(structure['vdw_params'][0],
+                                  self.parser.get_first_vdw_in_sf_file(SF_FILENAME)) )
+
+    def test_dihedral_records(self):
+        fd, filename = tempfile.mkstemp(suffix=".sf")
+        with os.fdopen(fd, 'w') as f:
+            f.write("BOND\t1\t2\t635.8\t1.54\n"
+                    "TORSION\t3\t1\t2\t6\t0.16\t3\t0.0\n"
+                    "TORSION\t4\t1\t2\t7\t0.25\t1\t180.0\n"
+                    "IMPROPER\t1\t2\t3\t4\t20.0\t35.3\n")
+        try:
+            structure = self.parser.read_sf_file(filename)
+            torsions = list(self.parser.iter_torsions_in_sf_file(filename))
+            impropers = list(self.parser.iter_impropers_in_sf_file(filename))
+        finally:
+            os.remove(filename)
+        self.assertEqual( structure['torsion_serial_nums'].tolist(),
+                          [list(t[0:4]) for t in torsions] )
+        for key, field in (('torsion_force_consts', 'force_const'),
+                           ('torsion_periodicities', 'periodicity'),
+                           ('torsion_phases', 'phase')):
+            self.assertTrue( allclose(structure[key],
+                                      [getattr(t, field) for t in torsions]) )
+        self.assertEqual( structure['improper_serial_nums'].tolist(),
+                          [list(t[0:4]) for t in impropers] )
+        self.assertTrue( allclose(structure['improper_force_consts'], [20.0]) )
+        self.assertTrue( allclose(structure['improper_psi_0s'],
+                                  [impropers[0].psi_0]) )
+        self.assertTrue( allclose(structure['torsion_phases'], [0.0, pi]) )
+
+    def test_typed_vdw_records(self):
+        fd, filename = tempfile.mkstemp(suffix=".sf")
+        with os.fdopen(fd, 'w') as f:
+            f.write("VDW\tC\t3.4\t0.1\n"
+                    "VDW\t2.6\t0.1\n"
+                    "VDW\tH\t2.4\t0.02\n")
+        try:
+            structure = self.parser.read_sf_file(filename)
+            first_vdw = self.parser.get_first_vdw_in_sf_file(filename)
+        finally:
+            os.remove(filename)
+        self.assertTrue( allclose(structure['vdw_params'], [[2.6, 0.1]]) )
+        self.assertTrue( allclose(first_vdw, (2.6, 0.1)) )
+        self.assertEqual( list(structure['vdw_type_names']), ['C', 'H'] )
+        self.assertTrue( allclose(structure['vdw_type_params'],
+                                  [[3.4, 0.1], [2.4, 0.02]]) )
+
+    def test_missing_records_give_empty_arrays(self):
+        structure = self.parser.read_sf_file(TRIATOMIC_SF_FILENAME)
+        self.assertEqual( structure['torsion_serial_nums'].shape, (0, 4) )
+        self.assertEqual( structure['angle_serial_nums'].shape, (0, 3) )
+        self.assertEqual( structure['vdw_params'].shape, (0, 2) )
@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from numpy import allclose, arange, float32, may_share_memory
+from ..universe import UniverseFactory
+from ..energy import BondEnergyFactory, EnergyGradientFunctionFactory
+from ..minimize import BFGSMinimizer
+from ..trajectory import universe_to_str, connect_records_to_str,\
+                         save_trajectory_to_pdb, Trajectory,\
+                         DCDTrajectoryWriter, read_dcd_coords,\
+                         load_trajectory_memmap, load_dcd_memmap
+
+PDB_FILENAME = "sardine/test/test_data/C2H6_ideal_trans_min_final.pdb"
+SF_FILENAME = "sardine/test/test_data/C2H6.sf"
+
+
+def reference_universe_str(universe, coords):
+    my_str = ""
+    for i, atom in enumerate(universe):
+        x, y, z = (coords[i,0], coords[i,1], coords[i,2])
+        my_str += "ATOM  %5d %4s %3s %1c%4d    %8.3f%8.3f%8.3f%6.2f%6.2f%6.1f%6.2f%6.2f \n" % \
+        ( atom.serial_num, atom.atom_name, atom.res_name, atom.chain_id,
+          atom.res_num, x, y, z, atom.charge, 0.00, atom.mass, atom.radius,
+          atom.charge )
+    return my_str
+
+
+class TestTrajectoryOutput(TestCase):
+    def setUp(self):
+        uf = UniverseFactory()
+        uf.load_atoms_from_file(PDB_FILENAME)
+        self.universe = uf.create_universe()
+        self.bond_energy_factory = BondEnergyFactory()
+        self.bond_energy_factory.load_bonds_from_file(SF_FILENAME)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_pdb_formatter_matches_per_atom_formatting(self):
+        coords = self.universe.get_coords() + 0.123
+        self.assertEqual( universe_to_str(self.universe, coords),
+                          reference_universe_str(self.universe, coords) )
+
+    def test_pdb_trajectory(self):
+        trajectory = Trajectory()
+        coords = self.universe.get_coords()
+        for i in xrange(3):
+            trajectory.add_frame(coords + i)
+        filename = os.path.join(self.tmp_dir, "traj.pdb")
+        save_trajectory_to_pdb(filename, trajectory, self.universe,
+                               self.bond_energy_factory)
+        with open(filename) as f:
+            pdb_str = f.read()
+        expected = ""
+        for i in xrange(3):
+            expected += "HEADER Coordinates at Frame %d\n" % i
+            expected += reference_universe_str(self.universe, coords + i)
+            if i == 0:
+                expected += connect_records_to_str(self.bond_energy_factory)
+            expected += "END\n"
+        self.assertEqual( pdb_str, expected )
+
+    def test_dcd_round_trip_with_stride(self):
+        num_atoms = len(self.universe)
+        frames = arange(5 * num_atoms * 3, dtype=float).reshape((5, num_atoms, 3))
+        filename = os.path.join(self.tmp_dir, "traj.dcd")
+        with DCDTrajectoryWriter(filename, num_atoms, stride=2) as writer:
+            for frame in frames:
+                writer.write_frame(frame)
+        coords = read_dcd_coords(filename)
+        self.assertEqual( coords.dtype, float32 )
+        self.assertEqual( coords.shape, (3, num_atoms, 3) )
+        self.assertTrue( allclose(coords, frames[::2]) )
+
+    def test_minimizer_streams_frames(self):
+        num_atoms = len(self.universe)
+        egff = EnergyGradientFunctionFactory()
+        egff.add_energy_gradient_term('bonds',
+            self.bond_energy_factory.create_energy_and_gradient_func(num_atoms))
+        energy_and_gradient_func = egff.create_energy_and_gradient_func(
+                                        ['bonds'], num_atoms=num_atoms)
+        X = (self.universe.get_coords() * 1.05).flatten()
+        filename = os.path.join(self.tmp_dir, "min.dcd")
+        minimizer = BFGSMinimizer()
+        with DCDTrajectoryWriter(filename, num_atoms) as writer:
+            minimizer.run_minimization(energy_and_gradient_func, None, X,
+                                       num_atoms, save_trajectory=True,
+                                       jac=True, trajectory_writer=writer)
+        trajectory = minimizer.get_trajectory()
+        coords = read_dcd_coords(filename)
+        self.assertEqual( len(coords), len(trajectory) )
+        for frame, dcd_frame in zip(trajectory, coords):
+            self.assertTrue( allclose(frame.coords, dcd_frame, atol=1e-4) )
+
+
+class TestTrajectoryStore(TestCase):
+    def setUp(self):
+        self.num_atoms = 4
+        self.frames = arange(40 * self.num_atoms * 3, dtype=float).reshape(
+                        (40, self.num_atoms, 3))
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def check_trajectory(self, trajectory, frames):
+        self.assertEqual( len(trajectory), len(frames) )
+        self.assertTrue( allclose(trajectory.get_coords(), frames) )
+        self.assertTrue( allclose(trajectory[-1].coords, frames[-1]) )
+        for frame, expected in zip(trajectory, frames):
+            self.assertTrue( allclose(frame.coords, expected) )
+
+    def test_frames_grow_in_memory(self):
+        trajectory = Trajectory()
+        for frame in self.frames:
+            trajectory.add_frame(frame)
+        self.check_trajectory(trajectory, self.frames)
+        self.assertFalse( trajectory.on_disk )
+
+    def test_slices_are_views(self):
+        trajectory = Trajectory(self.num_atoms)
+        for frame in self.frames:
+            trajectory.add_frame(frame)
+        every_third = trajectory[1::3]
+        self.check_trajectory(every_third, self.frames[1::3])
+        self.assertTrue( may_share_memory(every_third.get_coords(),
+                                          trajectory.get_coords()) )
+        self.assertTrue( may_share_memory(trajectory[5].coords,
+                                          trajectory.get_coords()) )
+        # adding to a slice copies it rather than writing into the parent
+        every_third.add_frame(self.frames[0])
+        self.check_trajectory(trajectory, self.frames)
+        self.assertEqual( len(every_third), len(self.frames[1::3]) + 1 )
+
+    def test_spills_to_memmap(self):
+        filename = os.path.join(self.tmp_dir, "traj.bin")
+        frame_bytes = self.num_atoms * 3 * 8
+        trajectory = Trajectory(filename=filename,
+                                max_memory_bytes=20 * frame_bytes)
+        for i, frame in enumerate(self.frames):
+            trajectory.add_frame(frame)
+            self.assertEqual( trajectory.on_disk, i >= 16 )
+        trajectory.close()
+        self.check_trajectory(trajectory, self.frames)
+        self.assertEqual( os.path.getsize(filename),
+                          len(self.frames) * frame_bytes )
+        loaded = load_trajectory_memmap(filename, self.num_atoms)
+        self.check_trajectory(loaded, self.frames)
+
+    def test_dcd_memmap(self):
+        filename = os.path.join(self.tmp_dir, "traj.dcd")
+        with DCDTrajectoryWriter(filename, self.num_atoms) as writer:
+            for frame in self.frames:
+                writer.write_frame(frame)
+        trajectory = load_dcd_memmap(filename)
+        self.check_trajectory(trajectory, self.frames)
+        self.check_trajectory(trajectory[::4], self.frames[::4])
@@ -7,7 +7,8 @@ from os.path import exists
 from unittest import TestCase
 from numpy import array, sqrt, dot, diagflat, allclose, zeros, repeat
 from ..universe import UniverseFactory
-from ..energy import BondEnergyFactory, EnergyFunctionFactory
+from ..energy import BondEnergyFactory, EnergyFunctionFactory,\
+                     HessianFunctionFactory
 from ..nma import compute_hessian, compute_force_constant_matrix,\
                   compute_normal_modes
 from ..const import CM_CONVERSION_FACTOR
@@ -36,6 +37,10 @@ class TestTriatomicNMA(TestCase):
         eff = EnergyFunctionFactory()
         eff.add_energy_term('bonds', bond_energy_func)
         self.energy_func = eff.create_energy_func(['bonds'], num_atoms=len(universe))
+        hff = HessianFunctionFactory()
+        hff.add_hessian_term('bonds', bond_energy.create_hessian_func())
+        self.hessian_func = hff.create_hessian_func(['bonds'],
+                                                    num_atoms=len(universe))
 
         H = zeros((9,9))
         H[0,0] = k
@@ -79,3 +84,23 @@ class TestTriatomicNMA(TestCase):
         print mode_freqs
         self.assertTrue( allclose(mode_freqs, self.expected_mode_freqs, atol=1e-04),
                          msg="\n%s\n%s" % (mode_freqs, self.expected_mode_freqs) )
+
+    def test_computes_correct_analytic_hessian(self):
+        X = self.universe.get_coords()
+        H = self.hessian_func(X.flatten())
+        self.assertTrue( allclose(H, self.expected_H),
+                         msg="\n%s\n%s" % (H, self.expected_H) )
+
+    def test_mass_weighting_by_vector_matches_matrix_product(self):
+        M_vec = self.universe.get_inv_sqrt_mass_vector()
+        F = compute_force_constant_matrix(self.expected_H, M_vec)
+        self.assertTrue( allclose(F, self.expected_F),
+                         msg="\n%s\n%s" % (F, self.expected_F) )
+
+        all_modes = compute_normal_modes(F, discard_trans_and_rot=True)
+        lowest_modes = compute_normal_modes(F, discard_trans_and_rot=True,
+                                            num_modes=2)
+        self.assertEqual( len(lowest_modes.get_frequencies()), 2 )
+        # the first remaining mode has zero frequency, so compare the second
+        self.assertTrue( allclose(lowest_modes.get_frequencies()[1],
+                                  all_modes.get_frequencies()[1]) )
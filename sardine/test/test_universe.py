@@ -20,3 +20,54 @@ class TestUniverse(TestCase):
         self.assertEqual(X.ndim, 2)
         self.assertEqual(X.shape[0], len(self.universe))
         self.assertEqual(X.shape[1], 3)
+
+    def test_atoms_without_serial_num_are_numbered(self):
+        af = AtomFactory()
+        uf = UniverseFactory()
+        uf.add_atom( af.create_atom(x=0., y=0, z=0, mass=1.0, charge=0.0,
+                                    radius=1.0) )
+        uf.add_atom( af.create_atom(x=1., y=0, z=0, mass=1.0, charge=0.0,
+                                    radius=1.0) )
+        universe = uf.create_universe()
+        self.assertEqual( list(universe.get_serial_nums()), [1, 2] )
+
+    def test_empty_factory_creates_empty_universe(self):
+        universe = UniverseFactory().create_universe()
+        self.assertEqual( len(universe), 0 )
+        self.assertEqual( universe.get_coords().shape, (0, 3) )
+        self.assertEqual( len(universe.get_inv_sqrt_mass_vector()), 0 )
+
+    def test_coords_are_views_of_universe_storage(self):
+        X = self.universe.get_coords()
+        X_vec = self.universe.get_coord_vector()
+        self.assertTrue( X_vec.base is X or X_vec.base is X.base )
+        X_vec[0] = 5.0
+        self.assertEqual( self.universe.get_coords()[0,0], 5.0 )
+
+
+class TestUniverseColumns(TestCase):
+    def setUp(self):
+        columns = {'coords': array([[0., 0., 0.], [1., 0., 0.], [2., 0., 0.]]),
+                   'mass': array([12.0, 1.0, 1.0]),
+                   'charge': array([-0.2, 0.1, 0.1]),
+                   'radius': array([1.75, 1.0, 1.0]),
+                   'serial_num': array([10, 30, 20]),
+                   'res_num': array([1, 1, 1]),
+                   'atom_name': array(['C', 'H1', 'H2']),
+                   'res_name': array(['A', 'A', 'A']),
+                   'chain_id': array(['A', 'A', 'A'])}
+        uf = UniverseFactory()
+        uf.add_columns(columns)
+        self.universe = uf.create_universe()
+
+    def test_maps_serial_nums_to_indices(self):
+        self.assertEqual( list(self.universe.get_indices([20, 10, 30])),
+                          [2, 0, 1] )
+        self.assertEqual( self.universe.get_index(30), 1 )
+
+    def test_iterates_over_atoms(self):
+        atoms = list(self.universe)
+        self.assertEqual( len(atoms), 3 )
+        self.assertEqual( atoms[1].atom_name, 'H1' )
+        self.assertEqual( atoms[2].serial_num, 20 )
+        self.assertTrue( allclose(self.universe.get_masses(), [12.0, 1.0, 1.0]) )
@@ -1,47 +1,370 @@
 import os.path
 from collections import namedtuple
+from numpy import array, asarray, zeros, fromfile, fromstring, float32,\
+                  memmap
+
+# fixed-width ATOM record, split around the coordinates
+PDB_ATOM_PREFIX_FORMAT = "ATOM  %5d %4s %3s %1c%4d    "
+PDB_COORDS_FORMAT = "%8.3f%8.3f%8.3f"
+PDB_ATOM_SUFFIX_FORMAT = "%6.2f%6.2f%6.1f%6.2f%6.2f \n"
+
+# CHARMM DCD header constants
+DCD_MAGIC = b'CORD'
+DCD_CHARMM_VERSION = 24
+DCD_TITLE_LENGTH = 80
+
 
 def save_trajectory_to_pdb(filename, trajectory, universe, bond_energy):
-    with open(filename, 'w') as f:
-        for frame_num, frame in enumerate(trajectory):
-            f.write("HEADER Coordinates at Frame %d\n" % frame_num)
-            f.write("%s" % universe_to_str(universe, frame.coords))
-            if frame_num == 0:
-                f.write("%s" % connect_records_to_str(bond_energy))
-            f.write("END\n")
-
-def universe_to_str(universe, coords):
-    my_str = ""
-    for i, atom in enumerate(universe):
-        x, y, z = (coords[i,0], coords[i,1], coords[i,2])
-        my_str += "ATOM  %5d %4s %3s %1c%4d    %8.3f%8.3f%8.3f%6.2f%6.2f%6.1f%6.2f%6.2f \n" % \
-        ( atom.serial_num, atom.atom_name, atom.res_name, atom.chain_id,
-          atom.res_num, x, y, z, atom.charge, 0.00, atom.mass, atom.radius,
-          atom.charge )
-    return my_str
+    with PdbTrajectoryWriter(filename, universe, bond_energy) as writer:
+        for frame in trajectory:
+            writer.write_frame(frame.coords)
+
+def create_pdb_frame_template(universe):
+    """
+    Format string for one frame of `universe` as ATOM records. Everything
+    but the coordinates is formatted once here, so a frame is written
+    with a single `template % tuple(coords.ravel())`.
+    """
+    records = []
+    for atom in universe:
+        prefix = PDB_ATOM_PREFIX_FORMAT % \
+            ( atom.serial_num, atom.atom_name, atom.res_name, atom.chain_id,
+              atom.res_num )
+        suffix = PDB_ATOM_SUFFIX_FORMAT % \
+            ( atom.charge, 0.00, atom.mass, atom.radius, atom.charge )
+        records.append( prefix.replace('%', '%%') + PDB_COORDS_FORMAT +
+                        suffix.replace('%', '%%') )
+    return "".join(records)
+
+def universe_to_str(universe, coords, template=None):
+    if template is None:
+        template = create_pdb_frame_template(universe)
+    return template % tuple( asarray(coords, dtype=float).ravel() )
 
 def connect_records_to_str(bond_energy):
-    my_str = ""
-    if bond_energy:
-        for bond in bond_energy:
-            my_str += "CONNECT %d %d\n" % (bond.serial_num_1, bond.serial_num_2)
-    return my_str
+    if not bond_energy:
+        return ""
+    return "".join( "CONNECT %d %d\n" % (bond.serial_num_1, bond.serial_num_2)
+                    for bond in bond_energy )
+
+
+class PdbTrajectoryWriter(object):
+    """
+    Streams frames to a multi-model pdb file as they are produced.
+
+    Parameters
+    ----------
+    filename : str
+    universe : Universe
+    bond_energy : BondEnergyFactory, optional
+        Bonds written as CONNECT records after the first frame.
+    stride : int, optional
+        Write only every `stride`-th frame passed to `write_frame`.
+    """
+    def __init__(self, filename, universe, bond_energy=None, stride=1):
+        super(PdbTrajectoryWriter, self).__init__()
+        self.f = open(filename, 'w')
+        self.template = create_pdb_frame_template(universe)
+        self.connect_str = connect_records_to_str(bond_energy)
+        self.stride = stride
+        self.num_frames_seen = 0
+        self.num_frames_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_frame(self, coords):
+        frame_num = self.num_frames_seen
+        self.num_frames_seen += 1
+        if frame_num % self.stride:
+            return
+        self.f.write("HEADER Coordinates at Frame %d\n" % frame_num)
+        self.f.write(self.template % tuple( asarray(coords, dtype=float).ravel() ))
+        if self.num_frames_written == 0:
+            self.f.write(self.connect_str)
+        self.f.write("END\n")
+        self.num_frames_written += 1
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
+
+
+def write_fortran_record(f, data):
+    marker = array([len(data)], dtype='<i4').tostring()
+    f.write(marker)
+    f.write(data)
+    f.write(marker)
+
+def read_fortran_record(f):
+    size = fromfile(f, dtype='<i4', count=1)
+    assert len(size) == 1, "Truncated DCD record"
+    data = f.read(size[0])
+    end_size = fromfile(f, dtype='<i4', count=1)
+    assert len(end_size) == 1 and end_size[0] == size[0], \
+        "Corrupt DCD record"
+    return data
+
+
+class DCDTrajectoryWriter(object):
+    """
+    Streams frames to a CHARMM/NAMD-style DCD file: a short header, then
+    each frame as float32 x, y and z arrays. Nothing but the current frame
+    is held in memory, and the files can be read by common viewers.
+
+    Parameters
+    ----------
+    filename : str
+    num_atoms : int
+    stride : int, optional
+        Write only every `stride`-th frame passed to `write_frame`.
+    title : str, optional
+    """
+    def __init__(self, filename, num_atoms, stride=1,
+                 title="Created by sardine"):
+        super(DCDTrajectoryWriter, self).__init__()
+        self.f = open(filename, 'wb')
+        self.num_atoms = num_atoms
+        self.stride = stride
+        self.num_frames_seen = 0
+        self.num_frames_written = 0
+        self.write_header(title)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_header(self, title):
+        control = zeros(20, dtype='<i4')
+        control[1] = 0 # first step
+        control[2] = self.stride # steps between frames
+        control[19] = DCD_CHARMM_VERSION
+        write_fortran_record(self.f, DCD_MAGIC + control.tostring())
+        title = title.ljust(DCD_TITLE_LENGTH)[:DCD_TITLE_LENGTH]
+        write_fortran_record(self.f, array([1], dtype='<i4').tostring() +
+                                     title.encode('ascii'))
+        write_fortran_record(self.f,
+                             array([self.num_atoms], dtype='<i4').tostring())
+
+    def write_frame(self, coords):
+        frame_num = self.num_frames_seen
+        self.num_frames_seen += 1
+        if frame_num % self.stride:
+            return
+        coords = asarray(coords, dtype='<f4').reshape((self.num_atoms, 3))
+        for k in xrange(3):
+            write_fortran_record(self.f, coords[:,k].tostring())
+        self.num_frames_written += 1
+
+    def close(self):
+        if self.f.closed:
+            return
+        # the frame count sits right after the magic number in the header
+        self.f.seek(8)
+        self.f.write(array([self.num_frames_written], dtype='<i4').tostring())
+        self.f.close()
+
+def read_dcd_coords(filename):
+    """
+    All frames of a DCD file written by DCDTrajectoryWriter as a float32
+    (num_frames, num_atoms, 3) array.
+    """
+    with open(filename, 'rb') as f:
+        header = read_fortran_record(f)
+        assert header[:4] == DCD_MAGIC, "%s is not a DCD file" % filename
+        control = fromstring(header[4:], dtype='<i4')
+        has_unit_cell = control[10] != 0
+        read_fortran_record(f) # title
+        num_atoms = fromstring(read_fortran_record(f), dtype='<i4')[0]
+        body = f.read()
+    # every frame is the same number of 4-byte words: an optional unit cell
+    # record (6 doubles) then x, y and z records, each with two markers
+    cell_words = 14 if has_unit_cell else 0
+    frame_words = cell_words + 3 * (num_atoms + 2)
+    num_frames = len(body) // (4 * frame_words)
+    words = fromstring(body[:4 * frame_words * num_frames], dtype='<f4')
+    words = words.reshape((num_frames, frame_words))[:,cell_words:]
+    xyz = words.reshape((num_frames, 3, num_atoms + 2))[:,:,1:-1]
+    coords = xyz.transpose((0, 2, 1)).astype(float32)
+    return coords
 
 TrajectoryFrame = namedtuple("TrajectoryFrame", ['coords'])
 
+# initial number of frames allocated by a growable trajectory
+INITIAL_FRAME_CAPACITY = 16
+
+
 class Trajectory(object):
-    """docstring for Trajectory"""
-    def __init__(self):
+    """
+    Frames stored in one contiguous (num_frames, num_atoms, 3) array.
+
+    The array is preallocated and grows by doubling, so adding a frame is
+    a copy into free space. It can live in RAM or in a `numpy.memmap`
+    file: with `filename` and no `max_memory_bytes` it is file-backed
+    from the start; with both it stays in RAM until it would outgrow
+    `max_memory_bytes` and then spills to the file.
+
+    Indexing returns a TrajectoryFrame whose coordinates are a view, and
+    slicing (with any step) returns a Trajectory viewing the same frames;
+    neither copies coordinates.
+
+    Parameters
+    ----------
+    num_atoms : int, optional
+        Taken from the first frame if not given.
+    filename : str, optional
+        File backing the frames as a raw memmap.
+    max_memory_bytes : int, optional
+        Size above which frames spill from RAM to `filename`.
+    dtype : dtype, optional
+    """
+    def __init__(self, num_atoms=None, filename=None, max_memory_bytes=None,
+                 dtype=float):
         super(Trajectory, self).__init__()
-        self.frames = []
+        self.num_atoms = num_atoms
+        self.filename = filename
+        self.max_memory_bytes = max_memory_bytes
+        self.dtype = dtype
+        self.frame_array = None
+        self.num_frames = 0
+        self.owns_array = False
+        self.on_disk = False
+
+    @classmethod
+    def from_array(cls, coords):
+        """
+        Trajectory viewing an existing (num_frames, num_atoms, 3) array,
+        e.g. a memmap. Frames added later are copied into new storage.
+        """
+        trajectory = cls(num_atoms=coords.shape[1], dtype=coords.dtype)
+        trajectory.frame_array = coords
+        trajectory.num_frames = len(coords)
+        return trajectory
 
     def __len__(self):
-        return len(self.frames)
+        return self.num_frames
 
     def __iter__(self):
-        for frame in self.frames:
-            yield frame
+        for i in xrange(self.num_frames):
+            yield TrajectoryFrame(self.frame_array[i])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Trajectory.from_array(self.get_coords()[index])
+        if index < 0:
+            index += self.num_frames
+        if not 0 <= index < self.num_frames:
+            raise IndexError("frame %d out of range" % index)
+        return TrajectoryFrame(self.frame_array[index])
+
+    def get_coords(self):
+        """
+        (num_frames, num_atoms, 3) view of all frames.
+        """
+        if self.frame_array is None:
+            return zeros((0, self.num_atoms or 0, 3), dtype=self.dtype)
+        return self.frame_array[:self.num_frames]
+
+    def get_frame_bytes(self):
+        return self.num_atoms * 3 * dtype_itemsize(self.dtype)
+
+    def uses_file(self, capacity):
+        if self.filename is None:
+            return False
+        return self.on_disk or self.max_memory_bytes is None or \
+               capacity * self.get_frame_bytes() > self.max_memory_bytes
+
+    def allocate(self, capacity):
+        old_array = self.frame_array
+        # a file we already own keeps its frames when it grows
+        keeps_frames = self.on_disk and self.owns_array
+        if self.uses_file(capacity):
+            self.frame_array = self.map_file(capacity, keeps_frames)
+            self.on_disk = True
+        else:
+            self.frame_array = zeros((capacity, self.num_atoms, 3),
+                                     dtype=self.dtype)
+        if old_array is not None and not keeps_frames:
+            self.frame_array[:self.num_frames] = old_array[:self.num_frames]
+        self.owns_array = True
+
+    def map_file(self, capacity, keep_contents):
+        """
+        Size the backing file to `capacity` frames and map it.
+        """
+        if isinstance(self.frame_array, memmap):
+            self.frame_array.flush()
+        with open(self.filename, 'r+b' if keep_contents else 'w+b') as f:
+            f.truncate(capacity * self.get_frame_bytes())
+        return memmap(self.filename, dtype=self.dtype, mode='r+',
+                      shape=(capacity, self.num_atoms, 3))
 
     def add_frame(self, coords):
-        trajectory_frame = TrajectoryFrame(coords)
-        self.frames.append(trajectory_frame)
+        coords = asarray(coords)
+        if self.num_atoms is None:
+            self.num_atoms = coords.size // 3
+        if self.frame_array is None:
+            self.allocate(INITIAL_FRAME_CAPACITY)
+        elif not self.owns_array or self.num_frames == len(self.frame_array):
+            self.allocate(max(2 * self.num_frames, INITIAL_FRAME_CAPACITY))
+        self.frame_array[self.num_frames] = coords.reshape((self.num_atoms, 3))
+        self.num_frames += 1
+
+    def close(self):
+        """
+        Trim a file-backed trajectory to its frames and flush it, so it
+        can be reopened with `load_trajectory_memmap`.
+        """
+        if self.on_disk and isinstance(self.frame_array, memmap):
+            self.frame_array.flush()
+            self.frame_array = None
+            with open(self.filename, 'r+b') as f:
+                f.truncate(self.num_frames * self.get_frame_bytes())
+            if self.num_frames:
+                self.frame_array = memmap(self.filename, dtype=self.dtype,
+                                          mode='r+',
+                                          shape=(self.num_frames,
+                                                 self.num_atoms, 3))
+
+def dtype_itemsize(dtype):
+    return zeros(0, dtype=dtype).itemsize
+
+def load_trajectory_memmap(filename, num_atoms, dtype=float, mode='r'):
+    """
+    Map a raw trajectory file written by a file-backed Trajectory without
+    reading it into memory.
+    """
+    frame_bytes = num_atoms * 3 * dtype_itemsize(dtype)
+    num_frames = os.path.getsize(filename) // frame_bytes
+    if num_frames == 0:
+        return Trajectory(num_atoms=num_atoms, dtype=dtype)
+    coords = memmap(filename, dtype=dtype, mode=mode,
+                    shape=(num_frames, num_atoms, 3))
+    return Trajectory.from_array(coords)
+
+def load_dcd_memmap(filename):
+    """
+    Map the frames of a DCD file written by DCDTrajectoryWriter as a
+    float32 Trajectory, without reading them into memory.
+    """
+    with open(filename, 'rb') as f:
+        header = read_fortran_record(f)
+        assert header[:4] == DCD_MAGIC, "%s is not a DCD file" % filename
+        assert fromstring(header[4:], dtype='<i4')[10] == 0, \
+            "DCD files with unit cells are not supported"
+        read_fortran_record(f) # title
+        num_atoms = fromstring(read_fortran_record(f), dtype='<i4')[0]
+        offset = f.tell()
+    frame_words = 3 * (num_atoms + 2)
+    num_frames = (os.path.getsize(filename) - offset) // (4 * frame_words)
+    if num_frames == 0:
+        return Trajectory(num_atoms=num_atoms, dtype=float32)
+    words = memmap(filename, dtype='<f4', mode='r', offset=offset,
+                   shape=(num_frames, 3, num_atoms + 2))
+    # drop the record markers around each of x, y and z; still a view
+    return Trajectory.from_array(words[:,:,1:-1].transpose((0, 2, 1)))
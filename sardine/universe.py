@@ -1,57 +1,206 @@
-from numpy import array, zeros, zeros_like, sqrt, diagflat, repeat
+from numpy import array, zeros, zeros_like, sqrt, diagflat, repeat, argsort,\
+                  searchsorted, asarray, ascontiguousarray, concatenate
+from .atom import Atom
 from .parsers import PdbParser
+from .cache import read_with_cache
+
+# per-atom columns of a Universe, besides the (N, 3) coordinates
+ATOM_COLUMNS = ('mass', 'charge', 'radius', 'serial_num', 'res_num',
+                'atom_name', 'res_name', 'chain_id')
+
+def atoms_to_columns(atoms):
+    """
+    Pack a sequence of Atom namedtuples into a dict of column arrays,
+    with the coordinates under 'coords' as an (N, 3) array.
+    """
+    columns = {}
+    columns['coords'] = array([(a.x, a.y, a.z) for a in atoms],
+                              dtype=float).reshape((-1, 3))
+    for name in ATOM_COLUMNS:
+        columns[name] = array([getattr(a, name) for a in atoms])
+    return columns
+
+def concatenate_columns(column_blocks):
+    """
+    Join several dicts of column arrays, in order, into one.
+    """
+    columns = {}
+    for name in ('coords',) + ATOM_COLUMNS:
+        columns[name] = concatenate([c[name] for c in column_blocks])
+    return columns
+
 
 class UniverseFactory(object):
     """docstring for UniverseFactory"""
     def __init__(self):
         self.atoms = []
+        self.column_blocks = []
         self.pdb_parser = PdbParser()
 
+    def get_num_atoms(self):
+        num_atoms = len(self.atoms)
+        for c in self.column_blocks:
+            num_atoms += len(c['coords'])
+        return num_atoms
+
     def add_atom(self, atom):
         """docstring"""
         if atom.serial_num is None:
-            atom.serial_num = len(self.atoms)
+            atom = atom._replace(serial_num=self.get_num_atoms() + 1)
         self.atoms.append(atom)
 
-    def create_universe(self):
-        return Universe(self.atoms)
+    def add_columns(self, columns):
+        """
+        Add a block of atoms given as column arrays: 'coords' (N, 3) plus
+        one length-N array per name in ATOM_COLUMNS.
+        """
+        self.flush_atoms()
+        self.column_blocks.append(columns)
 
-    def load_atoms_from_file(self, filename):
+    def flush_atoms(self):
+        if self.atoms:
+            self.column_blocks.append( atoms_to_columns(self.atoms) )
+            self.atoms = []
+
+    def create_universe(self, dtype=float):
+        """
+        Universe of the added atoms, with coordinates stored as `dtype`.
+        """
+        self.flush_atoms()
+        if not self.column_blocks:
+            columns = atoms_to_columns([])
+        elif len(self.column_blocks) == 1:
+            columns = self.column_blocks[0]
+        else:
+            columns = concatenate_columns(self.column_blocks)
+        return Universe(columns, dtype)
+
+    def load_atoms_from_file(self, filename, use_mmap=False, use_cache=False,
+                             cache_dir=None):
+        """
+        Add the atoms of a .pdb file. With `use_cache`, the parsed columns
+        are kept in a compiled .npz file (see `sardine.cache`) and reused
+        for as long as the pdb file is unchanged.
+        """
         if filename.endswith(".pdb"):
-            for a in self.pdb_parser.iter_atoms_in_pdb_file(filename):
-                self.add_atom(a)
+            read_func = lambda f: self.pdb_parser.read_pdb_columns(f, use_mmap)
+            if use_cache:
+                columns = read_with_cache(filename, read_func, cache_dir)
+            else:
+                columns = read_func(filename)
+            self.add_columns(columns)
         else:
             print "Expected a .pdb file, got %s" % filename
             return
 
 
 class Universe(object):
-    """docstring for Universe"""
-    def __init__(self, atoms):
-        self.atoms = atoms
+    """
+    Atoms stored as a structure of arrays: one contiguous array per
+    attribute (coordinates, masses, charges, radii, names, ...) instead
+    of one object per atom.
+
+    Parameters
+    ----------
+    columns : dict
+        'coords' as an (N, 3) array plus one length-N array per name in
+        ATOM_COLUMNS.
+    dtype : dtype, optional
+        Storage type of the coordinates; float32 halves their footprint.
+        Masses and the matrices derived from them stay float64.
+    """
+    def __init__(self, columns, dtype=float):
+        self.coord_array = ascontiguousarray(columns['coords'], dtype=dtype)
+        self.coord_array = self.coord_array.reshape((-1, 3))
+        self.mass_array = ascontiguousarray(columns['mass'], dtype=float)
+        self.charge_array = ascontiguousarray(columns['charge'], dtype=float)
+        self.radius_array = ascontiguousarray(columns['radius'], dtype=float)
+        self.serial_num_array = asarray(columns['serial_num'], dtype=int)
+        self.res_num_array = asarray(columns['res_num'], dtype=int)
+        self.atom_name_array = asarray(columns['atom_name'])
+        self.res_name_array = asarray(columns['res_name'])
+        self.chain_id_array = asarray(columns['chain_id'])
         self.initialize_matrices()
+        self.initialize_serial_num_index()
 
     def __len__(self):
-        return len(self.atoms)
+        return len(self.coord_array)
 
     def __iter__(self):
-        for a in self.atoms:
-            yield a
+        for i in xrange(len(self)):
+            yield self.get_atom(i)
+
+    def get_atom(self, i):
+        """
+        Atom `i` as an Atom namedtuple. Built on request; the universe
+        itself only stores the columns.
+        """
+        x, y, z = self.coord_array[i]
+        return Atom(x, y, z, self.mass_array[i], self.charge_array[i],
+                    self.radius_array[i], self.serial_num_array[i],
+                    self.res_num_array[i], self.atom_name_array[i],
+                    self.res_name_array[i], self.chain_id_array[i])
 
     def initialize_matrices(self):
-        masses = [a.mass for a in self.atoms]
-        coords = [(a.x, a.y, a.z) for a in self.atoms]
-        charges = [a.charge for a in self.atoms]
-        radii = [a.radius for a in self.atoms]
-        self.mass_array = array(masses)
-        self.coord_array = array(coords)
-        self.charge_array = array(charges)
-        self.radius_array = array(radii)
-        inv_sqrt_diag = 1./sqrt( repeat(self.mass_array, 3) )
-        self.M = diagflat(inv_sqrt_diag)
+        self.inv_sqrt_mass_vector = 1./sqrt( repeat(self.mass_array, 3) )
+        # the dense (3N, 3N) mass matrix is only built if asked for
+        self.M = None
+
+    def initialize_serial_num_index(self):
+        self.serial_num_order = argsort(self.serial_num_array, kind='mergesort')
+        self.sorted_serial_nums = self.serial_num_array[self.serial_num_order]
+
+    def get_indices(self, serial_nums):
+        """
+        0-based array indices of the atoms with the given serial numbers.
+        """
+        serial_nums = asarray(serial_nums)
+        positions = searchsorted(self.sorted_serial_nums, serial_nums)
+        positions = positions.clip(0, len(self) - 1)
+        found = self.sorted_serial_nums[positions] == serial_nums
+        assert found.all(), "Unknown serial numbers %s" % serial_nums[~found]
+        return self.serial_num_order[positions]
+
+    def get_index(self, serial_num):
+        return int( self.get_indices([serial_num])[0] )
 
     def get_inv_sqrt_mass_matrix(self):
+        if self.M is None:
+            self.M = diagflat(self.inv_sqrt_mass_vector)
         return self.M
 
+    def get_inv_sqrt_mass_vector(self):
+        """
+        Diagonal of the inverse square root mass matrix, one entry per
+        coordinate.
+        """
+        return self.inv_sqrt_mass_vector
+
     def get_coords(self):
+        """
+        (N, 3) coordinate array. This is the universe's own storage, not
+        a copy.
+        """
         return self.coord_array
+
+    def get_coord_vector(self):
+        """
+        Flattened (3N,) view of the coordinates, as taken by the energy
+        and gradient functions.
+        """
+        return self.coord_array.reshape(-1)
+
+    def get_masses(self):
+        return self.mass_array
+
+    def get_charges(self):
+        return self.charge_array
+
+    def get_radii(self):
+        return self.radius_array
+
+    def get_serial_nums(self):
+        return self.serial_num_array
+
+    def get_atom_names(self):
+        return self.atom_name_array
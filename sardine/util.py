@@ -1,6 +1,17 @@
-from numpy import arccos, radians, degrees, pi, dot, isnan, allclose, seterr
+import struct
+import zipfile
+from numpy import arccos, radians, degrees, pi, dot, isnan, allclose, seterr,\
+                  sqrt, bincount, arctan2, cross, arange, newaxis,\
+                  broadcast_arrays, zeros, memmap
+from numpy.lib import format as npy_format
 from numpy.linalg import norm
 from scipy.spatial.distance import pdist, squareform
+from scipy.sparse import coo_matrix
+
+# fixed part of a zip local file header; the last two fields are the
+# lengths of the file name and extra field that follow it
+ZIP_LOCAL_HEADER_FORMAT = '<4s5H3L2H'
+ZIP_LOCAL_HEADER_SIZE = struct.calcsize(ZIP_LOCAL_HEADER_FORMAT)
 
 # numpy complains when arg to arccos is out of bounds, but the
 # isnan conditional takes care of that, so we'll supress these warnings
@@ -14,6 +25,69 @@ def compute_distance_matrix_from_vector(D_vec):
     """docstring for compute_distance_matrix"""
     return squareform( D_vec )
 
+def compute_pair_vectors(X, I, J):
+    """
+    Displacements `X[J] - X[I]` and their lengths for the pairs (I, J).
+    `X` is (N, 3), or (num_frames, N, 3) for the pairs in every frame.
+    """
+    dX = X[...,J,:] - X[...,I,:]
+    r = sqrt( (dX * dX).sum(axis=-1) )
+    return dX, r
+
+def accumulate_rows(G, I, V):
+    """
+    Add each row of `V` to row `I[n]` of `G`, summing repeated indices.
+    With a leading frame axis, `G` is (num_frames, num_rows, k) and `V`
+    (num_frames, len(I), k), and the same `I` applies to every frame.
+    """
+    if G.ndim == 3:
+        assert G.flags.c_contiguous, "Gradient array must be contiguous"
+        num_frames, num_rows, k = G.shape
+        frame_offsets = (arange(num_frames) * num_rows)[:,newaxis]
+        # a view of G, so accumulating into it updates G
+        G_flat = G.reshape((num_frames * num_rows, k))
+        accumulate_rows(G_flat, (frame_offsets + I).ravel(),
+                        V.reshape((-1, k)))
+        return G
+    num_rows = G.shape[0]
+    for c in xrange(G.shape[1]):
+        G[:,c] += bincount(I, weights=V[:,c], minlength=num_rows)
+    return G
+
+def assemble_hessian(rows, cols, blocks, num_atoms):
+    """
+    Sum 3x3 blocks into a dense (3N, 3N) Hessian.
+
+    Parameters
+    ----------
+    rows, cols : ndarray of int
+        Atom indices of each block.
+    blocks : ndarray, shape (num_blocks, 3, 3)
+        Second derivatives d2E/dx_row dx_col. Repeated (row, col) pairs
+        are summed.
+    """
+    n = 3 * num_atoms
+    xyz = arange(3)
+    R = 3 * rows[:,newaxis,newaxis] + xyz[newaxis,:,newaxis]
+    C = 3 * cols[:,newaxis,newaxis] + xyz[newaxis,newaxis,:]
+    flat_inds = (R * n + C).ravel()
+    H = bincount(flat_inds, weights=blocks.ravel(), minlength=n*n)
+    return H.reshape((n, n))
+
+def assemble_sparse_hessian(rows, cols, blocks, num_atoms):
+    """
+    Sum 3x3 blocks into a sparse (3N, 3N) Hessian in CSR format. Takes the
+    same arguments as `assemble_hessian`, but memory grows with the number
+    of blocks rather than with N^2.
+    """
+    n = 3 * num_atoms
+    xyz = arange(3)
+    R, C = broadcast_arrays(3 * rows[:,newaxis,newaxis] + xyz[newaxis,:,newaxis],
+                            3 * cols[:,newaxis,newaxis] + xyz[newaxis,newaxis,:])
+    H = coo_matrix( (blocks.ravel(), (R.ravel(), C.ravel())), shape=(n, n) )
+    # converting to CSR sums the entries of repeated blocks
+    return H.tocsr()
+
 def compute_angle(u, v):
     """docstring for compute_angle"""
     cos_theta = dot(u, v) / (norm(u) * norm(v))
@@ -26,6 +100,63 @@ def compute_angle(u, v):
             theta = pi
     return theta
 
+def compute_angles(U, V):
+    """
+    Angles between the rows of `U` and `V`, which may carry leading frame
+    axes.
+
+    Uses atan2(|u x v|, u.v), which stays accurate near 0 and pi where
+    arccos of the normalized dot product loses precision or goes out
+    of bounds.
+
+    Returns
+    -------
+    theta : ndarray
+        Angle in radians for each row.
+    sin_theta, cos_theta : ndarray
+        Sine and cosine of each angle.
+    """
+    UxV = cross(U, V)
+    cross_length = sqrt( (UxV * UxV).sum(axis=-1) )
+    dot_UV = (U * V).sum(axis=-1)
+    theta = arctan2(cross_length, dot_UV)
+    length_product = sqrt( (U * U).sum(axis=-1) * (V * V).sum(axis=-1) )
+    return theta, cross_length / length_product, dot_UV / length_product
+
+def compute_dihedrals(F, G, H, gradient=False):
+    """
+    Dihedral angles of atom quadruples (i, j, k, l) given the bond vectors
+    F = x_i - x_j, G = x_j - x_k and H = x_l - x_k, which may carry leading
+    frame axes.
+
+    The angle is atan2 of the two projections of the plane normals,
+    following Blondel and Karplus, J. Comput. Chem. 17, 1132 (1996), whose
+    gradient has no singularity at 0 or pi.
+
+    Returns
+    -------
+    phi : ndarray
+        Dihedral angle in radians, in (-pi, pi].
+    dphi_dx : tuple of ndarray, only with `gradient`
+        d(phi)/dx of atoms i, j, k and l, each of the shape of `F`.
+    """
+    A = cross(F, G)
+    B = cross(H, G)
+    G_length = sqrt( (G * G).sum(axis=-1) )
+    phi = arctan2( (cross(B, A) * G).sum(axis=-1) / G_length,
+                   (A * B).sum(axis=-1) )
+    if not gradient:
+        return phi
+    A_sq = (A * A).sum(axis=-1)
+    B_sq = (B * B).sum(axis=-1)
+    FG = (F * G).sum(axis=-1)
+    HG = (H * G).sum(axis=-1)
+    dphi_dF = -(G_length / A_sq)[...,newaxis] * A
+    dphi_dH = (G_length / B_sq)[...,newaxis] * B
+    dphi_dG = (FG / (A_sq * G_length))[...,newaxis] * A - \
+              (HG / (B_sq * G_length))[...,newaxis] * B
+    return phi, (dphi_dF, dphi_dG - dphi_dF, -dphi_dG - dphi_dH, dphi_dH)
+
 def deg2rad(angle):
     """docstring for deg2rad"""
     return radians(angle)
@@ -40,3 +171,43 @@ def coords_2d_to_1d(X):
 def coords_1d_to_2d(X):
     num_atoms = len(X) / 3
     return X.reshape((num_atoms, 3))
+
+def load_npz_memmap(filename, mode='r'):
+    """
+    Memory-map every array of an uncompressed .npz file, as written by
+    `numpy.savez`. The members of such an archive are stored as-is, so
+    each array is mapped at its offset in the zip file instead of being
+    read.
+
+    Returns
+    -------
+    arrays : dict of numpy.memmap
+    """
+    arrays = {}
+    with open(filename, 'rb') as f:
+        archive = zipfile.ZipFile(f)
+        for info in archive.infolist():
+            assert info.compress_type == zipfile.ZIP_STORED, \
+                "%s in %s is compressed" % (info.filename, filename)
+            # the local header repeats the name and may differ in extras
+            f.seek(info.header_offset)
+            local_header = struct.unpack(ZIP_LOCAL_HEADER_FORMAT,
+                                         f.read(ZIP_LOCAL_HEADER_SIZE))
+            name_length, extra_length = local_header[-2:]
+            f.seek(info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_length +
+                   extra_length)
+            version = npy_format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = npy_format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = npy_format.read_array_header_2_0(f)
+            name = info.filename
+            if name.endswith('.npy'):
+                name = name[:-len('.npy')]
+            if 0 in shape:
+                arrays[name] = zeros(shape, dtype=dtype)
+                continue
+            arrays[name] = memmap(filename, dtype=dtype, mode=mode,
+                                  offset=f.tell(), shape=shape,
+                                  order='F' if fortran_order else 'C')
+    return arrays